@@ -2,19 +2,41 @@
 # -*- coding: utf-8 -*-
 
 from .batch import Batch
-from .serialize import HDF5Dataset, SerializeMixin, TorchDataset, TransformableDataset, save_hdf5, save_torch
-from .window import DenseWindow, SparseWindow, Window
+from .cache import CachedDataset, PersistentCachedDataset, hash_config
+from .serialize import (
+    HDF5Dataset,
+    MMapDataset,
+    PackedDataset,
+    SerializeMixin,
+    TorchDataset,
+    TransformableDataset,
+    save_hdf5,
+    save_mmap,
+    save_packed,
+    save_torch,
+)
+from .stream import StreamingDataset
+from .window import DenseWindow, SparseWindow, Window, WindowedDataset
 
 
 __all__ = [
     "Batch",
+    "CachedDataset",
+    "PersistentCachedDataset",
+    "hash_config",
     "SerializeMixin",
     "DenseWindow",
     "SparseWindow",
     "Window",
+    "WindowedDataset",
     "HDF5Dataset",
     "save_hdf5",
     "save_torch",
+    "save_packed",
+    "save_mmap",
     "TorchDataset",
+    "PackedDataset",
+    "MMapDataset",
+    "StreamingDataset",
     "TransformableDataset",
 ]
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import multiprocessing.context
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from torch import Tensor
+from torch.utils.data import Dataset
+
+from .serialize import TransformableDataset
+
+
+class CachedDataset(Dataset):
+    r"""Wraps a :class:`TransformableDataset` with a bounded least recently used (LRU) cache of
+    loaded examples. Examples are cached as returned by :func:`TransformableDataset.load_example`,
+    i.e. before any transforms are applied, so random augmentations still run on every access.
+
+    Two cache locations are supported:
+        * ``shared=False`` - Examples are held in the memory of each process. When used with
+          :class:`torch.utils.data.DataLoader` and ``num_workers > 0``, each worker maintains its own cache
+          of up to ``max_bytes``.
+        * ``shared=True`` - Examples are written to a directory on a memory backed filesystem
+          (``/dev/shm`` when available) that is shared by all workers, bounding total memory use to
+          approximately ``max_bytes``. Eviction order is approximate, as recency is tracked by file
+          modification times.
+
+    Hit, miss, and eviction counts are shared by all workers and are available through :attr:`stats`.
+    Counters are shared with processes that inherit them, i.e. DataLoader workers under any start method.
+    When pickled in any other way, the copy continues from the current counts with counters of its own.
+
+    .. warning::
+        Transforms receive the cached tensors. Transforms that modify their inputs in place will corrupt
+        the cache unless ``clone=True``.
+
+    Args:
+        dataset (TransformableDataset): The dataset to cache. Must override
+            :func:`TransformableDataset.load_example`.
+        max_bytes (int): The maximum size of the cache in bytes. Sizes are computed from the size of tensor
+            data, i.e. ``numel() * element_size()``, or from serialized size when ``shared=True``.
+            Examples larger than ``max_bytes`` are never cached.
+        shared (bool, optional): If True, share a single cache between processes.
+        cache_dir (str, optional): Directory to use for the shared cache. By default a temporary directory
+            is created and is removed when this dataset is garbage collected.
+        clone (bool, optional): If True, clone cached tensors before passing them to transforms.
+
+    Example::
+
+        >>> ds = TorchDataset("foo", transform=random_crop)
+        >>> ds = CachedDataset(ds, max_bytes=8 * 1024 ** 3, shared=True)
+        >>> ...
+        >>> log.info("Cache stats: %s", ds.stats)
+    """
+
+    def __init__(
+        self,
+        dataset: TransformableDataset,
+        max_bytes: int,
+        shared: bool = False,
+        cache_dir: Optional[str] = None,
+        clone: bool = False,
+    ):
+        super().__init__()
+        if not isinstance(dataset, TransformableDataset):
+            raise TypeError(f"Expected dataset to be a TransformableDataset, found {type(dataset)}")
+        if type(dataset).load_example is TransformableDataset.load_example:
+            raise TypeError(f"{type(dataset).__name__} must override load_example() to be cached")
+        if int(max_bytes) <= 0:
+            raise ValueError(f"max_bytes must be >= 1, got {max_bytes}")
+        self.dataset = dataset
+        self.max_bytes = int(max_bytes)
+        self.shared = bool(shared)
+        self.clone = bool(clone)
+
+        # counters live in shared memory so that stats from DataLoader workers are visible in the main process
+        self._hits = mp.Value("q", 0)
+        self._misses = mp.Value("q", 0)
+        self._evictions = mp.Value("q", 0)
+
+        if self.shared:
+            self._owner_pid = os.getpid() if cache_dir is None else None
+            if cache_dir is None:
+                root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+                cache_dir = tempfile.mkdtemp(prefix="combustion_cache_", dir=root)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_dir = cache_dir
+            self._nbytes = mp.Value("q", 0)
+        else:
+            self.cache_dir = None
+            self._cache: OrderedDict[int, Tuple[List[Any], int]] = OrderedDict()
+            self._local_nbytes = 0
+
+    def __repr__(self):
+        rep = f"CachedDataset({self.dataset}, max_bytes={self.max_bytes}"
+        if self.shared:
+            rep += f", cache_dir={self.cache_dir}"
+        rep += ")"
+        return rep
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        if pos < 0:
+            pos += len(self)
+        example = self._get(pos)
+        if example is None:
+            _increment(self._misses)
+            example = self.dataset.load_example(pos)
+            self._put(pos, example)
+        else:
+            _increment(self._hits)
+
+        if self.clone:
+            example = [x.clone() if isinstance(x, Tensor) else x for x in example]
+        return self.dataset.apply_transforms(list(example))
+
+    def __getstate__(self):
+        # shared counters can only be pickled while spawning a process, where they remain shared.
+        # otherwise they are pickled as plain values and replaced with new counters when unpickled
+        state = self.__dict__.copy()
+        if multiprocessing.context.get_spawning_popen() is None:
+            for name in _COUNTERS:
+                if name in state:
+                    state[name] = state[name].value
+        # copies never remove the shared cache directory
+        state["_owner_pid"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name in _COUNTERS:
+            if isinstance(state.get(name), int):
+                state[name] = mp.Value("q", state[name])
+        self.__dict__.update(state)
+
+    def __del__(self):
+        # only the process that created the shared cache directory removes it
+        if getattr(self, "_owner_pid", None) == os.getpid():
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        r"""Returns a dictionary of cache statistics, summed over all processes.
+
+        The following keys are included:
+            * ``hits`` - Number of accesses served from the cache
+            * ``misses`` - Number of accesses that loaded from the wrapped dataset
+            * ``evictions`` - Number of examples removed to stay within ``max_bytes``
+            * ``nbytes`` - Current size of the cache. When ``shared=False``, this is the size of the
+              cache in the calling process only.
+        """
+        nbytes = self._nbytes.value if self.shared else self._local_nbytes
+        return {
+            "hits": self._hits.value,
+            "misses": self._misses.value,
+            "evictions": self._evictions.value,
+            "nbytes": nbytes,
+        }
+
+    def clear(self) -> None:
+        r"""Removes all examples from the cache. Statistics are not reset."""
+        if self.shared:
+            with self._nbytes.get_lock():
+                for filename in os.listdir(self.cache_dir):
+                    _remove(os.path.join(self.cache_dir, filename))
+                self._nbytes.value = 0
+        else:
+            self._cache.clear()
+            self._local_nbytes = 0
+
+    def _get(self, pos: int) -> Optional[List[Any]]:
+        if not self.shared:
+            if pos not in self._cache:
+                return None
+            self._cache.move_to_end(pos)
+            return self._cache[pos][0]
+
+        target = self._cache_file(pos)
+        try:
+            example = torch.load(target, map_location="cpu")
+        except FileNotFoundError:
+            return None
+
+        # mark as recently used, unless another process evicted it since loading
+        try:
+            os.utime(target)
+        except FileNotFoundError:
+            pass
+        return example
+
+    def _put(self, pos: int, example: List[Any]) -> None:
+        nbytes = _example_nbytes(example)
+        if nbytes > self.max_bytes:
+            return
+
+        if not self.shared:
+            self._cache[pos] = (example, nbytes)
+            self._local_nbytes += nbytes
+            while self._local_nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._cache.popitem(last=False)
+                self._local_nbytes -= evicted_bytes
+                _increment(self._evictions)
+            return
+
+        # write to a temporary file and rename so readers never see a partial example
+        # the shared cache is sized by serialized file size, which is close to the size of tensor data
+        target = self._cache_file(pos)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            torch.save(example, f)
+            nbytes = f.tell()
+
+        with self._nbytes.get_lock():
+            if os.path.exists(target):
+                _remove(tmp)
+                return
+            os.replace(tmp, target)
+            self._nbytes.value += nbytes
+            if self._nbytes.value > self.max_bytes:
+                self._evict_shared()
+
+    def _evict_shared(self) -> None:
+        # called with the size lock held. evicts oldest files until 90% full so eviction scans are amortized
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".pth"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        target_bytes = int(self.max_bytes * 0.9)
+        for _, size, path in files:
+            if self._nbytes.value <= target_bytes:
+                break
+            if _remove(path):
+                self._nbytes.value -= size
+                _increment(self._evictions)
+
+    def _cache_file(self, pos: int) -> str:
+        return os.path.join(self.cache_dir, f"{pos}.pth")
+
+
+class PersistentCachedDataset(TransformableDataset):
+    r"""Wraps a dataset with a persistent on-disk cache, such that each example of the wrapped dataset
+    is computed at most once across epochs and across runs. This is intended for caching the deterministic
+    prefix of a transform pipeline. The wrapped dataset should produce the output of all deterministic
+    transforms, while random augmentations should be given to this dataset's ``transform``,
+    ``target_transform``, or ``transforms`` arguments where they run on every access.
+
+    Cached examples are addressed by ``key`` and example index. The key should uniquely identify the
+    wrapped dataset and its deterministic transforms, such as a hash of the configuration used to create them
+    (see :func:`hash_config`). Changing the configuration then results in a new key, and examples are recomputed
+    rather than read from a stale cache.
+
+    Examples are stored in the packed format used by :func:`save_packed`. Each process appends to its own
+    shard file under ``{path}/{key}``, along with an index giving the example index, offset, and size of each
+    example. Examples written by other processes are discovered by rereading these indices, which happens when
+    a process first accesses the dataset and at most every ``refresh_interval`` seconds thereafter on a miss.
+
+    .. warning::
+        The wrapped dataset must be deterministic. Any random transforms applied by the wrapped dataset
+        will be cached, and will not be recomputed.
+
+    Args:
+        dataset (Dataset): The dataset to cache, producing the output of deterministic transforms.
+        path (str): Root directory of the cache.
+        key (str): Identifies the contents of ``dataset``. Examples are stored under ``{path}/{key}``.
+        refresh_interval (float, optional): Minimum time in seconds between rereading cache indices on a miss.
+        transform (optional, callable): Transform to be applied to data tensors after loading.
+        target_transform (optional, callable): Transform to be applied to label tensors after loading.
+        transforms (optional, callable): Transform to be applied to each example after loading,
+            i.e. both data and labels. The transform should accept as many positional arguments
+            as there are tensors in an example.
+
+    Example::
+
+        >>> ds = ImageFolder("images", transform=Compose([Resize(512), ToTensor()]))
+        >>> key = hash_config({"root": "images", "size": 512})
+        >>> ds = PersistentCachedDataset(ds, "/scratch/cache", key, transform=RandomCrop(256))
+    """
+    _RECORD = struct.Struct("<qqq")
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        path: str,
+        key: str,
+        refresh_interval: float = 60.0,
+        transform: Optional[Callable[[Tensor], Any]] = None,
+        target_transform: Optional[Callable[[Tensor], Any]] = None,
+        transforms: Optional[Callable[[Any], Any]] = None,
+    ):
+        super().__init__(transform, target_transform, transforms)
+        if not str(key):
+            raise ValueError("key must be a non-empty str")
+        self.dataset = dataset
+        self.key = str(key)
+        self.path = os.path.join(path, self.key)
+        self.refresh_interval = float(refresh_interval)
+        os.makedirs(self.path, exist_ok=True)
+
+        # maps example index -> (shard filename, offset, nbytes)
+        self._entries: Dict[int, Tuple[str, int, int]] = {}
+        self._index_offsets: Dict[str, int] = {}
+        self._last_refresh = 0.0
+        self._reset_handles()
+        self._refresh()
+
+    def __repr__(self):
+        rep = f"PersistentCachedDataset({self.dataset}, path={self.path}, cached={len(self._entries)}"
+        rep += self._transform_repr()
+        rep += ")"
+        return rep
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        return self.apply_transforms(self.load_example(pos))
+
+    def __getstate__(self):
+        # file handles cannot be pickled, so they are reopened by each process
+        state = self.__dict__.copy()
+        state["_readers"] = {}
+        state["_writer"] = None
+        state["_pid"] = None
+        return state
+
+    def __del__(self):
+        if getattr(self, "_pid", None) == os.getpid():
+            self._close()
+
+    def load_example(self, pos: int) -> List[Any]:
+        if pos < 0:
+            pos += len(self)
+        if os.getpid() != self._pid:
+            # handles inherited across a fork belong to the parent
+            self._reset_handles()
+            self._refresh()
+
+        entry = self._entries.get(pos)
+        if entry is None and time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self._refresh()
+            entry = self._entries.get(pos)
+
+        if entry is not None:
+            return self._read(*entry)
+
+        example = self.dataset[pos]
+        example = [example] if isinstance(example, Tensor) else list(example)
+        self._write(pos, example)
+        return example
+
+    def _reset_handles(self) -> None:
+        self._readers = {}
+        self._writer = None
+        self._pid = os.getpid()
+
+    def _close(self) -> None:
+        for f in self._readers.values():
+            f.close()
+        if self._writer is not None:
+            for f in self._writer[1:]:
+                f.close()
+        self._readers = {}
+        self._writer = None
+
+    def _refresh(self) -> None:
+        # reads only the complete records appended to each index since the last refresh
+        self._last_refresh = time.monotonic()
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".index"):
+                continue
+            offset = self._index_offsets.get(filename, 0)
+            with open(os.path.join(self.path, filename), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            num_records = len(data) // self._RECORD.size
+            shard = filename[: -len(".index")] + ".pack"
+            for pos, example_offset, nbytes in self._RECORD.iter_unpack(data[: num_records * self._RECORD.size]):
+                self._entries.setdefault(pos, (shard, example_offset, nbytes))
+            self._index_offsets[filename] = offset + num_records * self._RECORD.size
+
+    def _read(self, shard: str, offset: int, nbytes: int) -> List[Any]:
+        if shard not in self._readers:
+            self._readers[shard] = open(os.path.join(self.path, shard), "rb")
+        f = self._readers[shard]
+        f.seek(offset)
+        return torch.load(io.BytesIO(f.read(nbytes)), map_location="cpu")
+
+    def _write(self, pos: int, example: List[Any]) -> None:
+        # each process appends to its own shard, so writers never contend for a file
+        if self._writer is None:
+            name = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+            shard = open(os.path.join(self.path, f"{name}.pack"), "ab")
+            index = open(os.path.join(self.path, f"{name}.index"), "ab")
+            self._writer = (f"{name}.pack", shard, index)
+        name, shard, index = self._writer
+
+        buf = io.BytesIO()
+        torch.save(example, buf)
+        offset = shard.tell()
+        shard.write(buf.getbuffer())
+        shard.flush()
+
+        # index record is written after the example, so a reader never sees a record for incomplete data
+        index.write(self._RECORD.pack(pos, offset, buf.tell()))
+        index.flush()
+        self._entries[pos] = (name, offset, buf.tell())
+
+
+def hash_config(config: Any, length: int = 16) -> str:
+    r"""Computes a stable hash of a configuration, suitable for use as a :class:`PersistentCachedDataset` key.
+
+    Args:
+        config (DictConfig, dict, list, or str): The configuration to hash. :class:`omegaconf.DictConfig`
+            inputs are resolved before hashing. Other inputs are serialized as JSON with sorted keys.
+        length (int, optional): Number of hex characters in the returned hash.
+
+    Returns:
+        Hex string hash of ``config``
+    """
+    if isinstance(config, (DictConfig, ListConfig)):
+        config = OmegaConf.to_container(config, resolve=True)
+    if not isinstance(config, str):
+        config = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()[:length]
+
+
+_COUNTERS = ("_hits", "_misses", "_evictions", "_nbytes")
+
+
+def _example_nbytes(example: List[Any]) -> int:
+    return sum(x.element_size() * x.numel() for x in example if isinstance(x, Tensor))
+
+
+def _increment(value) -> None:
+    with value.get_lock():
+        value.value += 1
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+__all__ = ["CachedDataset", "PersistentCachedDataset", "hash_config"]
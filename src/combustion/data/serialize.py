@@ -3,17 +3,22 @@
 from __future__ import annotations
 
 import glob
+import io
 import itertools
+import math
+import multiprocessing as mp
 import os
 import warnings
 from pathlib import Path
-from typing import Any, Callable, Iterable, Optional, Tuple, Union
+from queue import Empty
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from progress.bar import Bar, ChargingBar
 from progress.spinner import Spinner
 from torch import Tensor
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 
 
 try:
@@ -33,7 +38,12 @@ def save_hdf5(
     shard_size: Optional[int] = None,
     verbose: bool = True,
     bar: Bar = _DefaultBar,
-) -> None:
+    num_workers: int = 0,
+    chunks: Optional[Union[bool, int, Tuple[int, ...]]] = None,
+    compression: Optional[str] = None,
+    compression_opts: Optional[Any] = None,
+    write_batch_size: int = 32,
+) -> str:
     r"""Saves the contents of the dataset to one or more HDF5 files.
 
     .. warning::
@@ -67,47 +77,67 @@ def save_hdf5(
             Must be a positive int.
         verbose (bool, optional): If False, do not print progress updates during saving.
         bar (:class:`progress.bar.Bar`, optional): Progress bar class
+        num_workers (int, optional): If greater than 0, shards are written in parallel by a pool of
+            ``num_workers`` processes, each reading its shard's index range from the dataset.
+            Requires a map-style dataset that can be pickled.
+        chunks (bool, int, or tuple of ints, optional): Chunk shape of each HDF5 dataset. An int gives the
+            number of whole examples per chunk, while ``True`` or a tuple is passed to
+            :func:`h5py.Group.create_dataset`. By default data is stored contiguously unless
+            ``compression`` is given, in which case h5py chooses a chunk shape.
+        compression (str, optional): Compression filter to apply, such as ``"gzip"`` or ``"lzf"``.
+        compression_opts (optional): Options for the compression filter, such as the ``gzip`` level.
+        write_batch_size (int, optional): Number of examples to buffer in memory before writing
+            to the file in a single call.
+
+    .. note::
+        Each HDF5 dataset is created with the dtype of the first example's tensor, so that
+        integer data such as ``uint8`` images is not stored as floating point.
     """
     _check_h5py()
+    if write_batch_size <= 0:
+        raise ValueError(f"write_batch_size must be >= 1, got {write_batch_size}")
+    shard_kwargs = {
+        "chunks": chunks,
+        "compression": compression,
+        "compression_opts": compression_opts,
+        "write_batch_size": write_batch_size,
+    }
     if num_shards is not None and shard_size is not None:
         raise ValueError("num_shards is incompatible with shard_size, please use one or the other")
     if num_shards is not None and num_shards <= 0:
         raise ValueError(f"num_shards must be >= 1, got {num_shards}")
     if shard_size is not None and shard_size <= 0:
         raise ValueError(f"shard_size must be >= 1, got {shard_size}")
-    if shard_size is None and not hasattr(dataset, "__len__"):
-        raise ValueError("shard_size is required for datasets with no len() method")
+    if not hasattr(dataset, "__len__"):
+        raise ValueError("save_hdf5 requires a dataset with a len() method")
+    _check_num_workers(dataset, num_workers)
 
-    # calculate num shards / shard size
+    # calculate shard index ranges
     if num_shards is None and shard_size is None:
-        num_shards = 1
-        shard_size = len(dataset)
-    elif num_shards is not None:
-        num_shards = int(num_shards)
-        shard_size = len(dataset) // num_shards
-    elif shard_size is not None:
-        shard_size = int(shard_size)
-        num_shards = len(dataset) // shard_size
+        ranges = [(0, len(dataset))]
+    else:
+        ranges = _shard_ranges(len(dataset), num_shards, shard_size)
 
     # write shards
-    files = set()
-    if num_shards == 1:
-        f = _write_shard(path, iter(dataset), shard_size, verbose=verbose)
-        files.add(f)
+    if len(ranges) == 1:
+        files = [_write_shard(path, iter(dataset), len(dataset), verbose=verbose, **shard_kwargs)]
     else:
-        if not verbose:
+        if verbose:
             bar = bar(f"Writing to {path}", max=len(dataset))
         else:
             bar = None
 
-        # slice dataset iterator for multi-sharding
-        slices = [(x * shard_size, (x + 1) * shard_size) for x in range(num_shards)]
-        for shard_index, (low, high) in enumerate(slices, start=1):
-            data = itertools.islice(iter(dataset), low, high)
-            f = _write_shard(path, data, shard_size, shard_index, verbose=False)
-            files.add(f)
-            if bar is not None:
-                bar.next()
+        if num_workers > 0:
+            tasks = [(dataset, path, low, high, i, shard_kwargs) for i, (low, high) in enumerate(ranges, start=1)]
+            files = _run_parallel(_write_shard_range, tasks, num_workers, bar)
+        else:
+            # consume a single iterator rather than restarting iteration for each shard
+            it = _track_progress(iter(dataset), bar)
+            files = []
+            for shard_index, (low, high) in enumerate(ranges, start=1):
+                data = itertools.islice(it, high - low)
+                files.append(_write_shard(path, data, high - low, shard_index, verbose=False, **shard_kwargs))
+
         if bar is not None:
             bar.finish()
 
@@ -121,6 +151,7 @@ def save_torch(
     prefix: Union[str, Callable[[int, Any], str]] = "example_",
     verbose: bool = True,
     bar: Bar = _DefaultBar,
+    num_workers: int = 0,
 ) -> None:
     r"""Saves the contents of the dataset to multiple files using :func:`torch.save`.
 
@@ -144,6 +175,10 @@ def save_torch(
 
         bar (:class:`progress.bar.Bar`, optional): Progress bar class
 
+        num_workers (int, optional): If greater than 0, examples are written in parallel by a pool of
+            ``num_workers`` processes, each reading a contiguous index range from the dataset.
+            Requires a map-style dataset that can be pickled, along with a picklable ``prefix``.
+
     .. Example:
         >>> str_prefix = "example_"
         >>> save_torch(ds, path="root", prefix=str_prefix)
@@ -154,6 +189,7 @@ def save_torch(
         >>> # creates files root/class_{label_id}/example_{index}.pth
 
     """
+    _check_num_workers(dataset, num_workers)
     path = Path(path)
     path.mkdir(parents=True, exist_ok=True)
 
@@ -165,21 +201,192 @@ def save_torch(
     else:
         bar = None
 
-    for i, example in enumerate(dataset):
-        if isinstance(prefix, str):
-            target = Path(path, f"{prefix}{i}.pth")
+    if num_workers > 0:
+        ranges = _shard_ranges(len(dataset), num_shards=num_workers)
+        tasks = [(dataset, path, prefix, low, high) for low, high in ranges]
+        _run_parallel(_save_torch_range, tasks, num_workers, bar)
+    else:
+        for i, example in enumerate(_track_progress(iter(dataset), bar)):
+            _save_torch_example(path, prefix, i, example)
+
+    if bar is not None:
+        bar.finish()
+
+
+def save_packed(
+    dataset: Dataset,
+    path: str,
+    num_shards: Optional[int] = None,
+    shard_size: Optional[int] = None,
+    verbose: bool = True,
+    bar: Bar = _DefaultBar,
+    num_workers: int = 0,
+) -> str:
+    r"""Saves the contents of the dataset to one or more packed shard files.
+
+    Each example is serialized with :func:`torch.save` and appended to a shard file.
+    The shard and byte range of every example is recorded in an index file, allowing
+    :class:`PackedDataset` to seek directly to any example without listing the contents of ``path``.
+    This avoids creating one file per example as in :func:`save_torch`, which can be
+    costly on network filesystems for large datasets.
+
+    The following files will be created in directory ``path``:
+        * ``shard_{index}.pack`` - Concatenated serialized examples, one file per shard
+        * ``index.pack`` - An index giving the shard, offset, and size in bytes of each example
+
+    Args:
+        dataset (Dataset): The dataset to save.
+
+        path (str): The directory to save to. Ex ``foo/bar``.
+
+        num_shards (int, optional): If given, `num_shards` files will be created, each
+            containing ``1 / num_shards`` of the dataset. Exclusive with ``shard_size``.
+            Must be a positive int.
+
+        shard_size (int, optional): If given, multiple files will be created such that
+            each file contains at most ``shard_size`` examples. Exclusive with ``num_shards``.
+            Must be a positive int.
+
+        verbose (bool, optional): If False, do not print progress updates during saving.
+
+        bar (:class:`progress.bar.Bar`, optional): Progress bar class
+
+        num_workers (int, optional): If greater than 0, shards are written in parallel by a pool of
+            ``num_workers`` processes, each reading its shard's index range from the dataset.
+            Requires a map-style dataset that can be pickled.
+    """
+    if num_shards is not None and shard_size is not None:
+        raise ValueError("num_shards is incompatible with shard_size, please use one or the other")
+    if num_shards is not None and num_shards <= 0:
+        raise ValueError(f"num_shards must be >= 1, got {num_shards}")
+    if shard_size is not None and shard_size <= 0:
+        raise ValueError(f"shard_size must be >= 1, got {shard_size}")
+    if num_shards is not None and not hasattr(dataset, "__len__"):
+        raise ValueError("num_shards requires a dataset with a len() method")
+    _check_num_workers(dataset, num_workers)
+
+    if num_shards is not None:
+        shard_size = max(math.ceil(len(dataset) / int(num_shards)), 1)
+    elif shard_size is not None:
+        shard_size = int(shard_size)
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    if verbose:
+        if hasattr(dataset, "__len__"):
+            bar = bar(f"Writing to {path}", max=len(dataset))
         else:
-            example_prefix = prefix(i, example)
-            if not isinstance(example_prefix, str):
-                raise ValueError(f"Callable `prefix` must return a str, got {type(example_prefix)}")
-            target = Path(path, f"{example_prefix}.pth")
+            bar = Spinner(f"Writing to {path}")
+    else:
+        bar = None
+
+    shards = []
+    index = []
+    if num_workers > 0:
+        if shard_size is not None:
+            ranges = _shard_ranges(len(dataset), shard_size=shard_size)
+        else:
+            ranges = _shard_ranges(len(dataset), num_shards=num_workers)
+        shards = [f"shard_{i}.pack" for i in range(len(ranges))]
+        tasks = [(dataset, Path(path, name), low, high) for name, (low, high) in zip(shards, ranges)]
+        for shard_index, entries in enumerate(_run_parallel(_write_packed_range, tasks, num_workers, bar)):
+            index += [(shard_index, offset, nbytes) for offset, nbytes in entries]
+    else:
+        # consume a single iterator, starting a new shard when the current one is full
+        it = _track_progress(iter(dataset), bar)
+        while True:
+            target = Path(path, f"shard_{len(shards)}.pack")
+            source = itertools.islice(it, shard_size) if shard_size is not None else it
+            entries = _write_packed_shard(target, source)
+            if not entries and shards:
+                os.remove(target)
+                break
+            index += [(len(shards), offset, nbytes) for offset, nbytes in entries]
+            shards.append(target.name)
+            if shard_size is None or len(entries) < shard_size:
+                break
+
+    if bar is not None:
+        bar.finish()
+
+    index = torch.tensor(index, dtype=torch.long).view(-1, 3)
+    torch.save({"shards": shards, "index": index}, Path(path, PackedDataset.INDEX_FILE))
+    return path
+
+
+def save_mmap(
+    dataset: Dataset,
+    path: str,
+    verbose: bool = True,
+    bar: Bar = _DefaultBar,
+) -> str:
+    r"""Saves the contents of a dataset with fixed-shape examples to a directory of memory-mappable arrays.
+
+    Each tensor in an example tuple is stored as one contiguous array of shape :math:`(N, *)` in
+    the NumPy ``.npy`` format, using the same ``data_{i}`` naming as :func:`save_hdf5`. Examples
+    can then be read by :class:`MMapDataset` as zero-copy views of the memory mapped files.
+
+    .. note::
+        All examples must have the same number of tensors, and each tensor must have the same
+        shape and dtype across examples. The shape and dtype are determined from the first example.
+
+    Args:
+        dataset (Dataset): The dataset to save. Must have a ``len()`` method.
+
+        path (str): The directory to save to. Ex ``foo/bar``.
+
+        verbose (bool, optional): If False, do not print progress updates during saving.
+
+        bar (:class:`progress.bar.Bar`, optional): Progress bar class
+    """
+    if not hasattr(dataset, "__len__"):
+        raise ValueError("save_mmap requires a dataset with a len() method")
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    if verbose:
+        bar = bar(f"Writing to {path}", max=len(dataset))
+    else:
+        bar = None
+
+    arrays = []
+    num_examples = len(dataset)
+    for example_index, example in enumerate(dataset):
+        example = (example,) if isinstance(example, Tensor) else example
+        example = [torch.as_tensor(t).cpu().numpy() for t in example]
+
+        # allocate output files using the first example
+        if not arrays:
+            for i, array in enumerate(example):
+                target = Path(path, f"{MMapDataset.KEY_PREFIX}{i}.npy")
+                shape = (num_examples, *array.shape)
+                arrays.append(np.lib.format.open_memmap(str(target), mode="w+", dtype=array.dtype, shape=shape))
+
+        if len(example) != len(arrays):
+            raise ValueError(f"Expected {len(arrays)} tensors in example {example_index}, found {len(example)}")
+        if example_index >= num_examples:
+            raise ValueError(f"Dataset yielded more than len(dataset)={num_examples} examples")
+
+        for i, (dest, array) in enumerate(zip(arrays, example)):
+            if dest.shape[1:] != array.shape:
+                raise ValueError(
+                    f"Expected tensor {i} of example {example_index} to have shape {tuple(dest.shape[1:])}, "
+                    f"found {tuple(array.shape)}"
+                )
+            dest[example_index, ...] = array
 
-        target.parent.mkdir(parents=True, exist_ok=True)
-        torch.save(example, target)
         if bar is not None:
             bar.next()
+
+    for array in arrays:
+        array.flush()
+    del arrays
+
     if bar is not None:
         bar.finish()
+    return path
 
 
 class SerializeMixin:
@@ -195,6 +402,8 @@ class SerializeMixin:
         shard_size: Optional[int] = None,
         prefix: str = "example_",
         verbose: bool = True,
+        num_workers: int = 0,
+        **kwargs,
     ) -> None:
         r"""Saves the contents of the dataset to disk. See :func:`save_hdf5` and :func:`save_torch`
         respectively for more information on how saving functions for HDF5 or Torch files.
@@ -205,37 +414,61 @@ class SerializeMixin:
 
         Args:
             path (str): The filepath to save to. Ex `foo/bar.h5`
-            fmt (str, optional): The format to save in. Should be one of ``hdf5``, ``torch``.
+            fmt (str, optional): The format to save in. Should be one of ``hdf5``, ``torch``, ``packed``, ``mmap``.
             num_shards (int, optional): If given, `num_shards` files will be created, each
                 containing ``1 / num_shards`` of the dataset. Exclusive with ``shard_size``.
-                Must be a positive int. Only has an effect when ``fmt`` is ``"hdf5"``.
+                Must be a positive int. Only has an effect when ``fmt`` is ``"hdf5"`` or ``"packed"``.
             shard_size (int, optional): If given, multiple files will be created such that
                 each file contains ``shard_size`` examples. Exclusive with ``num_shards``.
-                Must be a positive int. Only has an effect when ``fmt`` is ``"hdf5"``.
+                Must be a positive int. Only has an effect when ``fmt`` is ``"hdf5"`` or ``"packed"``.
             prefix (str, optional): Passted to :func:`save_torch` if ``fmt`` is ``"hdf5"``
             verbose (bool, optional): If False, do not print progress updates during saving.
+            num_workers (int, optional): Number of processes used to write in parallel. Only has an effect
+                when ``fmt`` is ``"hdf5"``, ``"torch"``, or ``"packed"``.
+            **kwargs: Forwarded to :func:`save_hdf5` when ``fmt`` is ``"hdf5"``, e.g. to set ``compression``.
         """
+        if kwargs and fmt != "hdf5":
+            raise TypeError(f"Unexpected keyword arguments for fmt={fmt}: {list(kwargs.keys())}")
+
         if fmt == "hdf5":
-            return save_hdf5(self, path=path, num_shards=num_shards, shard_size=shard_size, verbose=verbose)
+            return save_hdf5(
+                self,
+                path=path,
+                num_shards=num_shards,
+                shard_size=shard_size,
+                verbose=verbose,
+                num_workers=num_workers,
+                **kwargs,
+            )
         elif fmt == "torch":
-            return save_torch(self, path=path, prefix=prefix, verbose=verbose)
+            return save_torch(self, path=path, prefix=prefix, verbose=verbose, num_workers=num_workers)
+        elif fmt == "packed":
+            return save_packed(
+                self,
+                path=path,
+                num_shards=num_shards,
+                shard_size=shard_size,
+                verbose=verbose,
+                num_workers=num_workers,
+            )
+        elif fmt == "mmap":
+            return save_mmap(self, path=path, verbose=verbose)
         else:
-            raise ValueError(f"Expected fmt to be one of 'hdf5', 'torch': found {fmt}")
+            raise ValueError(f"Expected fmt to be one of 'hdf5', 'torch', 'packed', 'mmap': found {fmt}")
 
     @staticmethod
     def load(
         path: str,
         fmt: Optional[str] = None,
         **kwargs,
-    ) -> Union[TorchDataset, HDF5Dataset]:
+    ) -> Union[TorchDataset, HDF5Dataset, PackedDataset, MMapDataset]:
         r"""
-        Loads the contents of a dataset previously saved with `save()`, returning a :class:`HDF5Dataset`.
+        Loads the contents of a dataset previously saved with `save()`.
 
-        .. warning::
-            Using HDF5 in a parallel / multithreaded manner poses additional challenges that have
-            not yet been overcome. As such, using a :class:`HDF5Dataset` with
-            :class:`torch.utils.data.DataLoader` when ``num_workers > 1`` will yield incorrect data.
-            For in situations where multiple threads will be used, prefer saving with ``fmt="torch"``.
+        .. note::
+            A :class:`HDF5Dataset` opens its file lazily in each process that reads from it, making it safe
+            to use with :class:`torch.utils.data.DataLoader` when ``num_workers > 1``. Sharing a single
+            :class:`HDF5Dataset` between threads of one process is not supported.
             See `Parallel HDF5 <http://docs.h5py.org/en/stable/mpi.html>`_ for more details.
 
         .. note::
@@ -249,11 +482,13 @@ class SerializeMixin:
             path (str): The filepath to load from. See `HDF5Dataset.load()` for more details
             fmt (str, optional): The expected type of data to load. By default the data type is inferred
                 from the file extensions found in ``path``. HDF5 files are matched by the ``.h5`` extension,
+                packed files are matched by the presence of an ``index.pack`` file, memory mapped files
+                are matched by the presence of a ``data_0.npy`` file,
                 and Torch files are matched by the ``.pth`` extension.
                 If a mix of ``hdf5`` and ``pth`` files are present in ``path``, ``fmt`` can be used
                 to ensure only the desired file types are loaded.
-            **kwargs:  Forwarded to the constructors for :class:`HDF5Dataset` or :class:`TorchDataset`,
-                depending on what dataset is constructed.
+            **kwargs:  Forwarded to the constructors for :class:`HDF5Dataset`, :class:`TorchDataset`,
+                :class:`PackedDataset`, or :class:`MMapDataset` depending on what dataset is constructed.
         """
         pth_pattern = os.path.join(path, "*.pth")
 
@@ -262,10 +497,18 @@ class SerializeMixin:
             return HDF5Dataset(path, **kwargs)
         elif fmt == "torch":
             return TorchDataset(path, **kwargs)
+        elif fmt == "packed":
+            return PackedDataset(path, **kwargs)
+        elif fmt == "mmap":
+            return MMapDataset(path, **kwargs)
 
-        # try hdf5 first if present, then try torch
+        # try hdf5 first if present, then try packed / mmap, then try torch
         elif ".h5" in str(path) or "hdf5" in str(path):
             return HDF5Dataset(path, **kwargs)
+        elif os.path.isfile(os.path.join(path, PackedDataset.INDEX_FILE)):
+            return PackedDataset(path, **kwargs)
+        elif os.path.isfile(os.path.join(path, f"{MMapDataset.KEY_PREFIX}0.npy")):
+            return MMapDataset(path, **kwargs)
         elif list(glob.glob(pth_pattern)):
             return TorchDataset(path, **kwargs)
 
@@ -320,6 +563,20 @@ class TransformableDataset(Dataset):
     def __repr__(self):
         return f"TransformableDataset({self._transform_repr()})"
 
+    def load_example(self, pos: int) -> List[Any]:
+        r"""Loads the example at index ``pos`` without applying any transforms. Datasets that support
+        random access should implement this method such that ``__getitem__`` is equivalent to
+        ``self.apply_transforms(self.load_example(pos))``. This allows wrappers such as
+        :class:`CachedDataset` to store examples before any random transforms are applied.
+
+        Args:
+            pos (int): The index of the example to load
+
+        Returns:
+            List of the tensors that make up the example
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not implement load_example()")
+
     def apply_transforms(self, tensors: Iterable[Tensor]) -> Union[Tensor, Tuple[Tensor, ...]]:
         r"""Applies transforms to an iterable of tensors
 
@@ -368,6 +625,12 @@ class HDF5Dataset(TransformableDataset, SerializeMixin):
         This class is intended for use with HDF5 files produced by Combustion's save methods.
         It may work with other HDF5 files, but this has not been verified yet.
 
+    .. note::
+        The underlying :class:`h5py.File` is opened on first access rather than in ``__init__``,
+        and is reopened whenever the dataset is accessed from a new process. This allows use with
+        :class:`torch.utils.data.DataLoader` when ``num_workers > 1``, as each worker holds its own handle
+        rather than one inherited across a fork.
+
     Args:
         path (str): The filepath to load from. When loading a sharded dataset, `path` should
             point to the virtual dataset master file. Ex ``"foo/bar.h5"``
@@ -390,27 +653,58 @@ class HDF5Dataset(TransformableDataset, SerializeMixin):
         _check_h5py()
 
         # ensure private vars to avoid conflicts when loading keys from dataset
-        self._hdf5_file = h5py.File(path, "r")
-        self._keys = self._hdf5_file.keys()
+        # file is only opened here to read metadata, handles used for reading are opened per process
+        self._hdf5_path = path
+        self._hdf5_handle = None
+        self._hdf5_pid = None
+        with h5py.File(path, "r") as f:
+            self._keys = list(f.keys())
+            lengths = [len(f[k]) for k in self._keys]
+            attrs = dict(f.attrs.items())
+        assert len(set(lengths)) <= 1, "all lengths equal"
+        self._length = lengths[0] if lengths else 0
 
         # set attributes that were attached to serialized dataset
-        for key, value in self._hdf5_file.attrs.items():
+        for key, value in attrs.items():
             setattr(self, key, value)
 
     def __repr__(self):
-        rep = f"HDF5Dataset({self._hdf5_file}, keys={list(self._keys)}, len={len(self)}"
+        rep = f"HDF5Dataset({self._hdf5_path}, keys={list(self._keys)}, len={len(self)}"
         rep += self._transform_repr()
         rep += ")"
         return rep
 
     def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
-        tensors = [torch.from_numpy(self._hdf5_file[k][pos]) for k in self._keys]
-        return self.apply_transforms(tensors)
+        return self.apply_transforms(self.load_example(pos))
+
+    def load_example(self, pos: int) -> List[Tensor]:
+        if pos < -len(self) or pos >= len(self):
+            raise IndexError(f"{pos}")
+        f = self._hdf5_file
+        return [torch.from_numpy(f[k][pos]) for k in self._keys]
 
     def __len__(self):
-        lengths = [len(self._hdf5_file[k]) for k in self._keys]
-        assert len(set(lengths)) == 1, "all lengths equal"
-        return lengths[0]
+        return self._length
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, so they are reopened by each process
+        state = self.__dict__.copy()
+        state["_hdf5_handle"] = None
+        state["_hdf5_pid"] = None
+        return state
+
+    def __del__(self):
+        # only close handles opened by this process, as a handle inherited across a fork belongs to the parent
+        if getattr(self, "_hdf5_handle", None) is not None and self._hdf5_pid == os.getpid():
+            self._hdf5_handle.close()
+
+    @property
+    def _hdf5_file(self) -> "h5py.File":
+        pid = os.getpid()
+        if self._hdf5_handle is None or self._hdf5_pid != pid:
+            self._hdf5_handle = h5py.File(self._hdf5_path, "r")
+            self._hdf5_pid = pid
+        return self._hdf5_handle
 
 
 class TorchDataset(TransformableDataset, SerializeMixin):
@@ -460,13 +754,16 @@ class TorchDataset(TransformableDataset, SerializeMixin):
         return rep
 
     def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        return self.apply_transforms(self.load_example(pos))
+
+    def load_example(self, pos: int) -> List[Tensor]:
         if pos < 0 or pos > len(self):
             raise IndexError(f"{pos}")
         if self.length_override is not None:
             pos = pos % len(self.files)
         target = self.files[pos]
         example = torch.load(target, map_location="cpu")
-        return self.apply_transforms(list(example))
+        return list(example)
 
     def __len__(self):
         if self.length_override is not None:
@@ -475,7 +772,170 @@ class TorchDataset(TransformableDataset, SerializeMixin):
             return len(self.files)
 
 
-def _write_shard(path, source, shard_size, shard_index=None, verbose=True, bar=_DefaultBar):
+class PackedDataset(TransformableDataset, SerializeMixin):
+    r"""Dataset used to read examples saved with :func:`save_packed`. See :class:`SerializeMixin` for more details.
+
+    Examples are located using the index written alongside the shard files, so reading example ``pos``
+    requires a single seek and read in the appropriate shard. Shard file handles are opened lazily
+    and are reopened in each process, making this dataset safe to use with
+    :class:`torch.utils.data.DataLoader` when ``num_workers > 1``.
+
+    Args:
+        path (str): The path to the saved dataset. Like :class:`TorchDataset`, ``path`` is a directory.
+        transform (optional, callable): Transform to be applied to data tensors.
+        target_transform (optional, callable): Transform to be applied to label tensors. If
+            given, the loaded dataset must produce
+        transforms (optional, callable): Transform to be applied to the output of ``__getitem__``,
+            i.e. both data and labels. The transform should accept as many positional arguments
+            as ``__getitem__`` returns.
+    """
+    INDEX_FILE: str = "index.pack"
+
+    def __init__(
+        self,
+        path: str,
+        transform: Optional[Callable[[Tensor], Any]] = None,
+        target_transform: Optional[Callable[[Tensor], Any]] = None,
+        transforms: Optional[Callable[[Any], Any]] = None,
+    ):
+        super().__init__(transform, target_transform, transforms)
+        self.path = path
+        index_file = os.path.join(path, self.INDEX_FILE)
+        if not os.path.isfile(index_file):
+            raise FileNotFoundError(f"Could not find packed dataset index {index_file}")
+        index = torch.load(index_file, map_location="cpu")
+        self.shards = [os.path.join(path, s) for s in index["shards"]]
+        self._index = index["index"]
+        self._handles = {}
+        self._pid = None
+
+    def __repr__(self):
+        rep = f"PackedDataset({self.path}, shards={len(self.shards)}, len={len(self)}"
+        rep += self._transform_repr()
+        rep += ")"
+        return rep
+
+    def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        return self.apply_transforms(self.load_example(pos))
+
+    def load_example(self, pos: int) -> List[Tensor]:
+        if pos < -len(self) or pos >= len(self):
+            raise IndexError(f"{pos}")
+        shard, offset, nbytes = self._index[pos].tolist()
+        f = self._get_handle(shard)
+        f.seek(offset)
+        example = torch.load(io.BytesIO(f.read(nbytes)), map_location="cpu")
+        return [example] if isinstance(example, Tensor) else list(example)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getstate__(self):
+        # file handles cannot be pickled, so they are reopened by each process
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        state["_pid"] = None
+        return state
+
+    def __del__(self):
+        for f in getattr(self, "_handles", {}).values():
+            f.close()
+
+    def _get_handle(self, shard: int):
+        # handles inherited across a fork share a file offset, so drop them and reopen
+        pid = os.getpid()
+        if self._pid != pid:
+            self._handles = {}
+            self._pid = pid
+        if shard not in self._handles:
+            self._handles[shard] = open(self.shards[shard], "rb")
+        return self._handles[shard]
+
+
+class MMapDataset(TransformableDataset, SerializeMixin):
+    r"""Dataset used to read examples saved with :func:`save_mmap`. See :class:`SerializeMixin` for more details.
+
+    Each ``data_{i}.npy`` file in ``path`` is memory mapped, and examples are returned as
+    :func:`torch.from_numpy` views into the mapped arrays. No copy is made when reading an example,
+    and :class:`torch.utils.data.DataLoader` workers share the operating system's page cache
+    rather than each holding a private copy of the data.
+
+    .. note::
+        Arrays are mapped in copy-on-write mode. Writing to a returned tensor (e.g. with an in-place
+        transform) will not alter the files on disk, but will create a private copy of the affected pages.
+
+    Args:
+        path (str): The path to the saved dataset. Like :class:`TorchDataset`, ``path`` is a directory.
+        transform (optional, callable): Transform to be applied to data tensors.
+        target_transform (optional, callable): Transform to be applied to label tensors. If
+            given, the loaded dataset must produce
+        transforms (optional, callable): Transform to be applied to the output of ``__getitem__``,
+            i.e. both data and labels. The transform should accept as many positional arguments
+            as ``__getitem__`` returns.
+    """
+    KEY_PREFIX: str = "data_"
+
+    def __init__(
+        self,
+        path: str,
+        transform: Optional[Callable[[Tensor], Any]] = None,
+        target_transform: Optional[Callable[[Tensor], Any]] = None,
+        transforms: Optional[Callable[[Any], Any]] = None,
+    ):
+        super().__init__(transform, target_transform, transforms)
+        self.path = path
+        self.files = []
+        while os.path.isfile(os.path.join(path, f"{self.KEY_PREFIX}{len(self.files)}.npy")):
+            self.files.append(os.path.join(path, f"{self.KEY_PREFIX}{len(self.files)}.npy"))
+        if not self.files:
+            raise FileNotFoundError(f"Could not find {self.KEY_PREFIX}0.npy in path {path}")
+
+        lengths = {len(x) for x in self._get_arrays()}
+        if len(lengths) != 1:
+            raise RuntimeError(f"Expected all arrays in {path} to have equal length, found lengths {lengths}")
+        self._length = lengths.pop()
+
+    def __repr__(self):
+        rep = f"MMapDataset({self.path}, keys={len(self.files)}, len={len(self)}"
+        rep += self._transform_repr()
+        rep += ")"
+        return rep
+
+    def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        return self.apply_transforms(self.load_example(pos))
+
+    def load_example(self, pos: int) -> List[Tensor]:
+        if pos < -len(self) or pos >= len(self):
+            raise IndexError(f"{pos}")
+        return [torch.from_numpy(x[pos]) for x in self._get_arrays()]
+
+    def __len__(self):
+        return self._length
+
+    def __getstate__(self):
+        # pickling a memmap copies its contents, so each process maps the files itself
+        state = self.__dict__.copy()
+        state.pop("_arrays", None)
+        return state
+
+    def _get_arrays(self) -> Tuple[np.ndarray, ...]:
+        if getattr(self, "_arrays", None) is None:
+            self._arrays = tuple(np.load(f, mmap_mode="c") for f in self.files)
+        return self._arrays
+
+
+def _write_shard(
+    path,
+    source,
+    shard_size,
+    shard_index=None,
+    verbose=True,
+    bar=_DefaultBar,
+    chunks=None,
+    compression=None,
+    compression_opts=None,
+    write_batch_size=32,
+):
     if shard_index is not None:
         path, ext = os.path.splitext(path)
         path = path + f"_{shard_index}" + ext
@@ -489,15 +949,33 @@ def _write_shard(path, source, shard_size, shard_index=None, verbose=True, bar=_
         bar = None
 
     with h5py.File(path, "w") as f:
+        # examples are buffered and written write_batch_size at a time to reduce the number of HDF5 calls
+        buffers = {}
+        start = 0
         for example_index, example in enumerate(source):
             example = (example,) if isinstance(example, Tensor) else example
             for i, tensor in enumerate(example):
+                array = torch.as_tensor(tensor).cpu().numpy()
                 key = f"data_{i}"
                 if key not in f.keys():
-                    f.create_dataset(key, (shard_size, *tensor.shape))
-                f[key][example_index, ...] = tensor
-                if bar is not None:
-                    bar.next()
+                    f.create_dataset(
+                        key,
+                        (shard_size, *array.shape),
+                        dtype=array.dtype,
+                        chunks=_get_chunks(chunks, shard_size, array.shape),
+                        compression=compression,
+                        compression_opts=compression_opts,
+                    )
+                buffers.setdefault(key, []).append(array)
+
+            if example_index + 1 - start >= write_batch_size:
+                _flush_buffers(f, buffers, start)
+                start = example_index + 1
+
+            if bar is not None:
+                bar.next()
+
+        _flush_buffers(f, buffers, start)
 
         if bar is not None:
             bar.finish()
@@ -508,18 +986,44 @@ def _write_shard(path, source, shard_size, shard_index=None, verbose=True, bar=_
     return path
 
 
+def _get_chunks(chunks, shard_size, shape):
+    # ints give the number of whole examples per chunk, other values are passed to h5py as is
+    if isinstance(chunks, int) and not isinstance(chunks, bool):
+        if chunks <= 0:
+            raise ValueError(f"chunks must be >= 1 when given as an int, got {chunks}")
+        # chunks cannot be larger than the dataset
+        return (max(min(chunks, shard_size), 1), *shape)
+    return chunks
+
+
+def _flush_buffers(f, buffers, start):
+    for key, buf in buffers.items():
+        if buf:
+            f[key][start : start + len(buf), ...] = np.stack(buf)
+            buf.clear()
+
+
 def _finalize_master(dataset, path, files):
     # create virtual dataset as master for multiple shards
+    # shards are concatenated along the example dimension in the order given by files
+    # shards are referenced by name relative to the master, which shares their directory
     if len(files) > 1:
-        first_file = next(iter(files))
-        data_keys = [k for k in h5py.File(first_file, "r").keys() if "data_" in k]
+        with h5py.File(files[0], "r") as f:
+            data_keys = [k for k in f.keys() if "data_" in k]
         with h5py.File(path, "w") as f:
             for key in data_keys:
-                data_shape = h5py.File(first_file, "r")[key].shape
-                layout = h5py.VirtualLayout(shape=(len(files),) + data_shape)
-                for i, filename in enumerate(files):
-                    vsource = h5py.VirtualSource(filename, key, shape=data_shape)
-                    layout[i, ...] = vsource
+                sources = []
+                for filename in files:
+                    with h5py.File(filename, "r") as shard:
+                        source_name = os.path.basename(filename)
+                        sources.append(h5py.VirtualSource(source_name, key, shape=shard[key].shape))
+                        dtype = shard[key].dtype
+                num_examples = sum(x.shape[0] for x in sources)
+                layout = h5py.VirtualLayout(shape=(num_examples,) + sources[0].shape[1:], dtype=dtype)
+                offset = 0
+                for vsource in sources:
+                    layout[offset : offset + vsource.shape[0], ...] = vsource
+                    offset += vsource.shape[0]
                 f.create_virtual_dataset(key, layout, fillvalue=0)
 
     # set object attributes on master
@@ -534,6 +1038,96 @@ def _finalize_master(dataset, path, files):
     return path
 
 
+def _shard_ranges(
+    length: int, num_shards: Optional[int] = None, shard_size: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    # splits range(length) into contiguous (low, high) ranges, with a smaller final range if needed
+    if num_shards is not None:
+        shard_size = math.ceil(length / int(num_shards))
+    shard_size = max(int(shard_size), 1)
+    ranges = [(low, min(low + shard_size, length)) for low in range(0, length, shard_size)]
+    return ranges or [(0, 0)]
+
+
+def _check_num_workers(dataset, num_workers):
+    if num_workers < 0:
+        raise ValueError(f"num_workers must be >= 0, got {num_workers}")
+    if num_workers > 0 and (isinstance(dataset, IterableDataset) or not hasattr(dataset, "__len__")):
+        raise ValueError("num_workers > 0 requires a map-style dataset with a len() method")
+
+
+def _track_progress(source, bar=None):
+    for example in source:
+        if bar is not None:
+            bar.next()
+        yield example
+
+
+def _iter_range(dataset, low, high, queue=None):
+    for i in range(low, high):
+        example = dataset[i]
+        if queue is not None:
+            queue.put(1)
+        yield example
+
+
+def _run_parallel(fn, tasks, num_workers, bar=None):
+    # runs fn(*task, queue) for each task in a process pool, returning results in task order
+    # workers put a count into queue for each example read, which is used to advance the progress bar
+    ctx = mp.get_context()
+    with ctx.Manager() as manager:
+        queue = manager.Queue()
+        with ctx.Pool(min(num_workers, len(tasks))) as pool:
+            result = pool.starmap_async(fn, [(*task, queue) for task in tasks])
+            while not result.ready() or not queue.empty():
+                try:
+                    count = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                if bar is not None:
+                    bar.next(count)
+            return result.get()
+
+
+def _write_shard_range(dataset, path, low, high, shard_index, shard_kwargs, queue=None):
+    source = _iter_range(dataset, low, high, queue)
+    return _write_shard(path, source, high - low, shard_index, verbose=False, **shard_kwargs)
+
+
+def _save_torch_example(path, prefix, i, example):
+    if isinstance(prefix, str):
+        target = Path(path, f"{prefix}{i}.pth")
+    else:
+        example_prefix = prefix(i, example)
+        if not isinstance(example_prefix, str):
+            raise ValueError(f"Callable `prefix` must return a str, got {type(example_prefix)}")
+        target = Path(path, f"{example_prefix}.pth")
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(example, target)
+
+
+def _save_torch_range(dataset, path, prefix, low, high, queue=None):
+    for i, example in enumerate(_iter_range(dataset, low, high, queue), start=low):
+        _save_torch_example(path, prefix, i, example)
+
+
+def _write_packed_shard(target, source) -> List[Tuple[int, int]]:
+    # appends each serialized example to target, returning (offset, nbytes) for each example
+    entries = []
+    with open(target, "wb") as f:
+        for example in source:
+            buf = io.BytesIO()
+            torch.save(example, buf)
+            entries.append((f.tell(), buf.tell()))
+            f.write(buf.getbuffer())
+    return entries
+
+
+def _write_packed_range(dataset, target, low, high, queue=None):
+    return _write_packed_shard(target, _iter_range(dataset, low, high, queue))
+
+
 def _check_h5py():
     if h5py is None:
         raise ImportError(
@@ -544,4 +1138,15 @@ def _check_h5py():
     warnings.warn("hdf5 support is deprecated", DeprecationWarning)
 
 
-__all__ = ["save_hdf5", "save_torch", "SerializeMixin", "HDF5Dataset", "TorchDataset", "TransformableDataset"]
+__all__ = [
+    "save_hdf5",
+    "save_torch",
+    "save_packed",
+    "save_mmap",
+    "SerializeMixin",
+    "HDF5Dataset",
+    "TorchDataset",
+    "PackedDataset",
+    "MMapDataset",
+    "TransformableDataset",
+]
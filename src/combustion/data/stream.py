@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import io
+import os
+import random
+import warnings
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
+
+import torch
+import torch.distributed as dist
+from torch import Tensor
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .serialize import PackedDataset, TransformableDataset, _check_h5py
+
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class StreamingDataset(IterableDataset, TransformableDataset):
+    r"""Iterable dataset that reads serialized shards sequentially. This is a streaming companion to
+    :class:`PackedDataset` and :class:`HDF5Dataset` for situations where random access is costly.
+
+    Shards are read from start to finish, and are partitioned across :class:`torch.utils.data.DataLoader`
+    workers and distributed ranks such that no two workers read the same shard. Approximate shuffling is
+    provided by shuffling the order of shards and by drawing examples at random from an in-memory
+    buffer of size ``shuffle_buffer``.
+
+    The following formats are supported:
+        * ``"packed"`` - Directories created by :func:`save_packed`. Each ``shard_{index}.pack`` file is one shard.
+        * ``"hdf5"`` - Files created by :func:`save_hdf5`. When ``path`` is a virtual dataset master file,
+          each source file is one shard. Otherwise ``path`` is a single shard.
+
+    .. note::
+        Shards are the unit of work assigned to each worker. When the total number of workers across all
+        ranks exceeds the number of shards, some workers will produce no examples.
+
+    .. note::
+        Call :func:`set_epoch` at the start of each epoch to vary the shuffled order across epochs,
+        as with :class:`torch.utils.data.distributed.DistributedSampler`.
+
+    Args:
+        path (str): Path to the saved dataset, as would be given to :func:`SerializeMixin.load`.
+        fmt (str, optional): The format of the saved dataset. Should be one of ``"packed"``, ``"hdf5"``.
+            By default the format is inferred from ``path``.
+        shuffle_buffer (int, optional): Size of the buffer used to shuffle examples. By default examples
+            are not shuffled within shards.
+        shuffle_shards (bool, optional): If True, shuffle the order in which shards are read.
+        seed (int, optional): Seed for shuffling. Must be the same on all ranks.
+        rank (int, optional): Distributed rank of this process. Defaults to the rank of the default process
+            group if :mod:`torch.distributed` is initialized, or 0 otherwise.
+        world_size (int, optional): Number of distributed ranks. Defaults to the size of the default process
+            group if :mod:`torch.distributed` is initialized, or 1 otherwise.
+        read_size (int, optional): Number of examples read per call when reading HDF5 shards.
+        transform (optional, callable): Transform to be applied to data tensors.
+        target_transform (optional, callable): Transform to be applied to label tensors. If
+            given, the loaded dataset must produce
+        transforms (optional, callable): Transform to be applied to each example, i.e. both data and labels.
+            The transform should accept as many positional arguments as there are tensors in an example.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fmt: Optional[str] = None,
+        shuffle_buffer: int = 0,
+        shuffle_shards: bool = True,
+        seed: int = 42,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        read_size: int = 256,
+        transform: Optional[Callable[[Tensor], Any]] = None,
+        target_transform: Optional[Callable[[Tensor], Any]] = None,
+        transforms: Optional[Callable[[Any], Any]] = None,
+    ):
+        super().__init__(transform, target_transform, transforms)
+        if int(shuffle_buffer) < 0:
+            raise ValueError(f"shuffle_buffer must be >= 0, got {shuffle_buffer}")
+        if int(read_size) <= 0:
+            raise ValueError(f"read_size must be >= 1, got {read_size}")
+
+        if fmt is None:
+            if ".h5" in str(path) or "hdf5" in str(path):
+                fmt = "hdf5"
+            elif os.path.isfile(os.path.join(path, PackedDataset.INDEX_FILE)):
+                fmt = "packed"
+            else:
+                raise FileNotFoundError(f"Could not find a target to load in path {path}")
+
+        self.path = path
+        self.fmt = fmt
+        self.shuffle_buffer = int(shuffle_buffer)
+        self.shuffle_shards = bool(shuffle_shards)
+        self.seed = int(seed)
+        self.read_size = int(read_size)
+        self.epoch = 0
+
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if not 0 <= rank < world_size:
+            raise ValueError(f"Expected 0 <= rank < world_size, found rank={rank}, world_size={world_size}")
+        self.rank = rank
+        self.world_size = world_size
+
+        if fmt == "packed":
+            self._shards, self._lengths = self._find_packed_shards(path)
+        elif fmt == "hdf5":
+            self._shards, self._lengths = self._find_hdf5_shards(path)
+        else:
+            raise ValueError(f"Expected fmt to be one of 'packed', 'hdf5': found {fmt}")
+
+    def __repr__(self):
+        rep = f"StreamingDataset({self.path}, fmt={self.fmt}, shards={len(self._shards)}"
+        if self.shuffle_buffer:
+            rep += f", shuffle_buffer={self.shuffle_buffer}"
+        rep += self._transform_repr()
+        rep += ")"
+        return rep
+
+    def __len__(self):
+        r"""Returns the number of examples that will be produced by this rank, summed over all workers."""
+        return sum(self._lengths[i] for i in self._assigned_shards(self.rank, 0, 1))
+
+    def __iter__(self) -> Iterator[Union[Tensor, Tuple[Tensor, ...]]]:
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        shards = self._assigned_shards(self.rank, worker_id, num_workers)
+        if not shards:
+            warnings.warn(
+                f"Worker {worker_id} of rank {self.rank} was assigned no shards. "
+                f"Consider using fewer workers or more than {len(self._shards)} shards."
+            )
+
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        examples = (example for i in shards for example in self._read_shard(i))
+        if self.shuffle_buffer:
+            examples = _shuffle_buffer(examples, self.shuffle_buffer, rng)
+
+        for example in examples:
+            yield self.apply_transforms(list(example))
+
+    def set_epoch(self, epoch: int) -> None:
+        r"""Sets the epoch used to seed shuffling, ensuring a different order each epoch.
+
+        Args:
+            epoch (int): The current epoch
+        """
+        self.epoch = int(epoch)
+
+    def _assigned_shards(self, rank: int, worker_id: int, num_workers: int) -> List[int]:
+        # every rank/worker computes the same shard order, then takes a disjoint stride of it
+        order = list(range(len(self._shards)))
+        if self.shuffle_shards:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(order)
+        rank_shards = order[rank :: self.world_size]
+        return rank_shards[worker_id::num_workers]
+
+    def _read_shard(self, i: int) -> Iterator[Tuple[Tensor, ...]]:
+        if self.fmt == "packed":
+            return self._read_packed_shard(*self._shards[i])
+        return self._read_hdf5_shard(self._shards[i])
+
+    @staticmethod
+    def _find_packed_shards(path: str) -> Tuple[List[Any], List[int]]:
+        index = torch.load(os.path.join(path, PackedDataset.INDEX_FILE), map_location="cpu")
+        entries = index["index"]
+        shards, lengths = [], []
+        for shard_index, name in enumerate(index["shards"]):
+            shard_entries = entries[entries[:, 0] == shard_index, 1:]
+            shard_entries = shard_entries[shard_entries[:, 0].argsort()]
+            shards.append((os.path.join(path, name), shard_entries))
+            lengths.append(len(shard_entries))
+        return shards, lengths
+
+    @staticmethod
+    def _read_packed_shard(filename: str, entries: Tensor) -> Iterator[Tuple[Tensor, ...]]:
+        with open(filename, "rb", buffering=1 << 20) as f:
+            for offset, nbytes in entries.tolist():
+                if f.tell() != offset:
+                    f.seek(offset)
+                example = torch.load(io.BytesIO(f.read(nbytes)), map_location="cpu")
+                yield (example,) if isinstance(example, Tensor) else tuple(example)
+
+    @staticmethod
+    def _find_hdf5_shards(path: str) -> Tuple[List[Any], List[int]]:
+        _check_h5py()
+        with h5py.File(path, "r") as f:
+            keys = list(f.keys())
+            if not keys:
+                return [], []
+            first = f[keys[0]]
+            if not first.is_virtual:
+                return [path], [len(first)]
+            # virtual sources are ordered by their position in the master
+            sources = sorted(first.virtual_sources(), key=lambda x: x.vspace.get_select_bounds()[0][0])
+            files = [StreamingDataset._resolve_source(path, x.file_name) for x in sources]
+
+        lengths = []
+        for filename in files:
+            with h5py.File(filename, "r") as f:
+                lengths.append(len(f[keys[0]]))
+        return files, lengths
+
+    @staticmethod
+    def _resolve_source(path: str, file_name: str) -> str:
+        # sources are named relative to the master file, though older masters may store the path as written
+        resolved = os.path.join(os.path.dirname(path), file_name)
+        if not os.path.isfile(resolved) and os.path.isfile(file_name):
+            return file_name
+        return resolved
+
+    def _read_hdf5_shard(self, filename: str) -> Iterator[Tuple[Tensor, ...]]:
+        with h5py.File(filename, "r") as f:
+            keys = list(f.keys())
+            length = len(f[keys[0]])
+            for low in range(0, length, self.read_size):
+                high = min(low + self.read_size, length)
+                blocks = [torch.from_numpy(f[k][low:high]) for k in keys]
+                for i in range(high - low):
+                    yield tuple(block[i] for block in blocks)
+
+
+def _shuffle_buffer(examples: Iterator[Any], size: int, rng: random.Random) -> Iterator[Any]:
+    # fill the buffer, then yield a random element and replace it with the next incoming example
+    buf = []
+    for example in examples:
+        if len(buf) < size:
+            buf.append(example)
+            continue
+        i = rng.randrange(size)
+        yield buf[i]
+        buf[i] = example
+    rng.shuffle(buf)
+    yield from buf
+
+
+__all__ = ["StreamingDataset"]
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from itertools import islice
-from typing import Generator, Iterable, Tuple
+from typing import Generator, Iterable, Optional, Tuple, Union
 
 import torch
 from torch import Tensor
+from torch.utils.data import Dataset
 
 
 class Window(ABC):
@@ -71,13 +73,81 @@ class Window(ABC):
             frames = [torch.as_tensor(f) for f in frames]
             labels = [torch.as_tensor(l) for l in labels]
             frames = torch.stack(frames, depth_dim).refine_names("D", "H", "W")
-            label = labels[midpoint].refine_names("H", "W")
+            label = labels[list(indices).index(midpoint)].refine_names("H", "W")
             yield frames.align_to("C", "D", "H", "W"), label.align_to("C", "H", "W")
 
     def __repr__(self):
         name = self.__class__.__name__
         return f"{name}(before={self.before}, after={self.after})"
 
+    def unfold(
+        self, frames: Tensor, labels: Optional[Tensor] = None, dim: int = -3
+    ) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+        r"""Applies the window to an already stacked tensor of frames, returning every window at once.
+        This is a vectorized alternative to :func:`__call__` for inputs that fit in memory as a single tensor.
+
+        For frames of shape :math:`(T, H, W)` or :math:`(C, T, H, W)` and a window of depth :math:`D`, the
+        output will be of shape :math:`(N, D, H, W)` or :math:`(N, C, D, H, W)` respectively, where
+        :math:`N` is given by :func:`estimate_size`. When the window indices are evenly spaced, as is the case
+        for :class:`DenseWindow` or a :class:`SparseWindow` with ``before == after``, the result is a
+        strided view of ``frames`` and no copy is made. Otherwise, the selected frames are copied.
+
+        Args:
+
+            frames (:class:`torch.Tensor`):
+                Stacked frames to be windowed
+
+            labels (:class:`torch.Tensor`, optional):
+                Stacked labels with a time dimension matching that of ``frames``. If given, the labels
+                of the center frame of each window are also returned, with the time dimension moved to the
+                front. I.e. for labels of shape :math:`(C, T, H, W)` the result will be of shape :math:`(N, C, H, W)`.
+
+            dim (int, optional):
+                The time dimension of ``frames`` and ``labels``
+
+        Returns:
+            Tensor of windowed frames, or a tuple of windowed frames and center frame labels if ``labels``
+            is given.
+
+        Shape
+            * ``frames`` - :math:`(*, T, *)`
+            * ``labels`` - :math:`(*, T, *)`
+            * Output - :math:`(N, *, D, *)`, :math:`(N, *)`
+        """
+        label_dim = dim % labels.ndim if labels is not None else None
+        dim = dim % frames.ndim
+        span = self.before + self.after + 1
+        num_frames = frames.shape[dim]
+        if num_frames < span:
+            raise ValueError(f"Expected at least {span} frames along dim {dim}, found {num_frames}")
+        if labels is not None and labels.shape[label_dim] != num_frames:
+            raise ValueError(f"Expected {num_frames} labels along dim {label_dim}, found {labels.shape[label_dim]}")
+
+        # unfold gives a (..., N, ..., span) view, from which the window's frames are selected
+        windows = frames.unfold(dim, span, 1)
+        offsets = [x - self.indices(self.before)[0] for x in self.indices(self.before)]
+        steps = {b - a for a, b in zip(offsets, offsets[1:])}
+        if offsets != list(range(span)):
+            if len(steps) == 1 and offsets[0] == 0:
+                windows = windows[..., :: steps.pop()]
+            else:
+                windows = windows[..., offsets]
+
+        # move window index to the front and depth to the original time dimension
+        order = list(range(windows.ndim - 1))
+        order.pop(dim)
+        order = [dim] + order[:dim] + [windows.ndim - 1] + order[dim:]
+        windows = windows.permute(*order)
+
+        if labels is None:
+            return windows
+
+        labels = labels.narrow(label_dim, self.before, windows.shape[0])
+        order = list(range(labels.ndim))
+        order.pop(label_dim)
+        labels = labels.permute(label_dim, *order)
+        return windows, labels
+
     @abstractmethod
     def indices(self, pos: int) -> Tuple[int, ...]:
         r"""Given an index ``pos``, return a tuple of indices that are
@@ -93,7 +163,7 @@ class Window(ABC):
         """
         low = pos - self.before
         high = pos + self.after
-        return tuple(set(range(low, high)))
+        return tuple(range(low, high))
 
     def estimate_size(self, num_frames: int) -> int:
         r"""Given a number of examples in the un-windowed input,
@@ -140,7 +210,7 @@ class DenseWindow(Window):
         """
         low = pos - self.before
         high = pos + self.after
-        return tuple(set(range(low, high + 1)))
+        return tuple(range(low, high + 1))
 
 
 class SparseWindow(Window):
@@ -177,4 +247,118 @@ class SparseWindow(Window):
         return sorted(tuple(set([low, pos, high])))
 
 
-__all__ = ["Window", "DenseWindow", "SparseWindow"]
+class WindowedDataset(Dataset):
+    r"""Map-style dataset that applies a :class:`Window` to either stacked frames or another map-style dataset
+    of frames, allowing windowed data to be shuffled and split across workers without materializing every window.
+
+    When ``source`` is a :class:`torch.Tensor`, windows are computed with :func:`Window.unfold`, so indexing
+    the dataset returns a view of the input frames rather than constructing each window from individual frames.
+    For frames of shape :math:`(C, T, H, W)`, each example will be a tuple of frames of shape
+    :math:`(C, D, H, W)` and, if ``labels`` are given, the center frame's label of shape :math:`(C, H, W)`.
+
+    When ``source`` is a map-style dataset, each example of ``source`` is taken to be a single frame, or a
+    ``(frame, label)`` tuple as with :func:`Window.__call__`. The length of this dataset is given by
+    :func:`Window.estimate_size`, and accessing a window loads only the frames given by :func:`Window.indices`.
+    Frames are stacked along ``dim``, such that frames of shape :math:`(H, W)` give windows of shape
+    :math:`(D, H, W)`. Recently loaded frames are held in a small cache so that neighboring windows,
+    which share most of their frames, do not reload them.
+
+    Args:
+
+        source (:class:`torch.Tensor` or :class:`torch.utils.data.Dataset`):
+            Stacked frames of shape :math:`(T, H, W)` or :math:`(C, T, H, W)`, or a map-style dataset of frames
+
+        window (:class:`Window`):
+            The window to apply
+
+        labels (:class:`torch.Tensor`, optional):
+            Stacked labels with a time dimension matching that of ``source``. Only valid when
+            ``source`` is a tensor.
+
+        dim (int, optional):
+            The time dimension of ``source`` and ``labels`` when stacked
+
+        cache_size (int, optional):
+            Number of frames to cache when ``source`` is a dataset. Defaults to the span of the window,
+            ``max(indices) - min(indices) + 1``, so that frames shared by a :class:`SparseWindow` and its
+            neighbors are reused when windows are read in order. Set to 0 to disable caching.
+    """
+
+    def __init__(
+        self,
+        source: Union[Tensor, Dataset],
+        window: Window,
+        labels: Optional[Tensor] = None,
+        dim: int = -3,
+        cache_size: Optional[int] = None,
+    ):
+        super().__init__()
+        self.window = window
+        self.dim = dim
+        if isinstance(source, Tensor):
+            self.dataset = None
+            result = window.unfold(source, labels, dim)
+            if labels is None:
+                self._frames, self._labels = result, None
+            else:
+                self._frames, self._labels = result
+        else:
+            if labels is not None:
+                raise ValueError("labels should only be given when source is a Tensor")
+            if not hasattr(source, "__getitem__") or not hasattr(source, "__len__"):
+                raise TypeError(f"Expected source to be a Tensor or map-style dataset, found {type(source)}")
+            self.dataset = source
+            if cache_size is None:
+                indices = window.indices(window.before)
+                cache_size = max(indices) - min(indices) + 1
+            self.cache_size = int(cache_size)
+            if self.cache_size < 0:
+                raise ValueError(f"cache_size must be >= 0, got {cache_size}")
+            self._cache: OrderedDict = OrderedDict()
+
+    def __repr__(self):
+        return f"WindowedDataset(window={self.window}, len={len(self)})"
+
+    def __len__(self):
+        if self.dataset is None:
+            return self._frames.shape[0]
+        return max(self.window.estimate_size(len(self.dataset)), 0)
+
+    def __getitem__(self, pos: int) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+        if pos < -len(self) or pos >= len(self):
+            raise IndexError(f"{pos}")
+        if pos < 0:
+            pos += len(self)
+
+        if self.dataset is None:
+            if self._labels is None:
+                return self._frames[pos]
+            return self._frames[pos], self._labels[pos]
+
+        center = pos + self.window.before
+        indices = list(self.window.indices(center))
+        examples = [self._get_frame(i) for i in indices]
+        if isinstance(examples[0], Tensor):
+            return torch.stack(examples, self.dim)
+        frames = torch.stack([x[0] for x in examples], self.dim)
+        return frames, examples[indices.index(center)][1]
+
+    def _get_frame(self, index: int) -> Union[Tensor, Tuple[Tensor, ...]]:
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        example = self.dataset[index]
+        if isinstance(example, Tensor):
+            example = torch.as_tensor(example)
+        else:
+            example = tuple(torch.as_tensor(x) for x in example)
+
+        if self.cache_size:
+            self._cache[index] = example
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return example
+
+
+__all__ = ["Window", "DenseWindow", "SparseWindow", "WindowedDataset"]
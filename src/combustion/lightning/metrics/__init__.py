@@ -3,6 +3,7 @@
 
 from .auroc import AUROC, BoxAUROC
 from .average_precision import BoxAveragePrecision
+from .mean_average_precision import BoxMeanAveragePrecision
 
 
-__all__ = ["AUROC", "BoxAveragePrecision", "BoxAUROC"]
+__all__ = ["AUROC", "BoxAveragePrecision", "BoxAUROC", "BoxMeanAveragePrecision"]
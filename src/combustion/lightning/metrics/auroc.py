@@ -8,7 +8,7 @@ from pytorch_lightning.metrics import Metric
 from pytorch_lightning.metrics.functional import auroc
 from torch import Tensor
 
-from .bbox_metric import BoxClassificationMetric
+from .bbox_metric import BoxClassificationMetric, _cat_state
 
 
 class AUROC(Metric):
@@ -36,16 +36,17 @@ class AUROC(Metric):
         super().__init__(compute_on_step, dist_sync_on_step, process_group, dist_sync_fn)
 
         self.pos_label = int(pos_label)
-        self.add_state("pred", default=torch.empty(0), dist_reduce_fx="cat")
-        self.add_state("true", default=torch.empty(0), dist_reduce_fx="cat")
+        # states are lists of per-step chunks, concatenated once at compute time
+        self.add_state("pred", default=[], dist_reduce_fx="cat")
+        self.add_state("true", default=[], dist_reduce_fx="cat")
 
     def update(self, preds: Tensor, target: Tensor):
         assert preds.shape == target.shape
-        self.pred = torch.cat([self.pred, preds])
-        self.true = torch.cat([self.true, target])
+        self.pred.append(preds)
+        self.true.append(target)
 
     def compute(self):
-        return auroc(self.pred, self.true, pos_label=self.pos_label)
+        return auroc(_cat_state(self.pred), _cat_state(self.true), pos_label=self.pos_label)
 
 
 class BoxAUROC(BoxClassificationMetric):
@@ -69,6 +70,10 @@ class BoxAUROC(BoxClassificationMetric):
             If given, only include the top ``pred_box_limit`` predicted boxes (by score)
             in the calculation.
 
+        num_bins (int, optional):
+            If given, compute AUROC from score histograms with ``num_bins`` bins using fixed
+            memory. By default AUROC is computed exactly.
+
         compute_on_step: See :class:`pytorch_lightning.metrics.Metric`
         dist_sync_on_step: See :class:`pytorch_lightning.metrics.Metric`
         process_group: See :class:`pytorch_lightning.metrics.Metric`
@@ -80,7 +85,20 @@ class BoxAUROC(BoxClassificationMetric):
     """
 
     def compute(self):
-        if self.binary_target.sum() == self.binary_target.numel():
-            return torch.tensor(float("nan"), device=self.pred_score.device)
+        if self.num_bins is not None:
+            return self._binned_auroc()
+
+        pred_score, _, binary_target = self._exact_state()
+        if binary_target.sum() == binary_target.numel():
+            return torch.tensor(float("nan"), device=pred_score.device)
+
+        return auroc(pred_score, binary_target)
+
+    def _binned_auroc(self) -> Tensor:
+        tp, fp = self._cumulative_counts()
+        if fp[-1] == 0:
+            return torch.tensor(float("nan"), device=tp.device)
 
-        return auroc(self.pred_score, self.binary_target)
+        tpr = torch.cat([tp.new_zeros(1), tp / tp[-1].clamp_min(1)])
+        fpr = torch.cat([fp.new_zeros(1), fp / fp[-1]])
+        return torch.trapz(tpr, fpr)
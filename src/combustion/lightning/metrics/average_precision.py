@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 
+import torch
 from pytorch_lightning.metrics.functional import average_precision
+from torch import Tensor
 
 from .bbox_metric import BoxClassificationMetric
 
@@ -27,6 +29,10 @@ class BoxAveragePrecision(BoxClassificationMetric):
             If given, only include the top ``pred_box_limit`` predicted boxes (by score)
             in the calculation.
 
+        num_bins (int, optional):
+            If given, compute average precision from score histograms with ``num_bins`` bins
+            using fixed memory. By default average precision is computed exactly.
+
         compute_on_step: See :class:`pytorch_lightning.metrics.Metric`
         dist_sync_on_step: See :class:`pytorch_lightning.metrics.Metric`
         process_group: See :class:`pytorch_lightning.metrics.Metric`
@@ -38,4 +44,16 @@ class BoxAveragePrecision(BoxClassificationMetric):
     """
 
     def compute(self):
-        return average_precision(self.pred_score, self.binary_target, pos_label=1)
+        if self.num_bins is not None:
+            return self._binned_average_precision()
+        pred_score, _, binary_target = self._exact_state()
+        return average_precision(pred_score, binary_target, pos_label=1)
+
+    def _binned_average_precision(self) -> Tensor:
+        tp, fp = self._cumulative_counts()
+        precision = tp / (tp + fp).clamp_min(1)
+        recall = tp / tp[-1].clamp_min(1)
+
+        # bins without any boxes contribute no change in recall
+        recall_delta = torch.cat([recall[:1], recall[1:] - recall[:-1]])
+        return (recall_delta * precision).sum()
@@ -3,7 +3,7 @@
 
 
 from abc import ABC
-from typing import Any, Callable, Optional
+from typing import Any, Callable, List, Optional, Tuple, Union
 
 import torch
 from pytorch_lightning.metrics import Metric
@@ -11,6 +11,7 @@ from torch import Tensor
 
 from combustion.util import check_dimension, check_is_tensor, check_ndim_match
 from combustion.vision import CategoricalLabelIoU, split_bbox_scores_class, split_box_target
+from combustion.vision.bbox import PAD_VALUE
 
 
 class BoxClassificationMetric(Metric, ABC):
@@ -33,7 +34,13 @@ class BoxClassificationMetric(Metric, ABC):
 
         pred_box_limit (int, optional):
             If given, only include the top ``pred_box_limit`` predicted boxes (by score)
-            in the calculation.
+            in the calculation. For batched inputs, the limit is applied to each example.
+
+        num_bins (int, optional):
+            If given, accumulate counts of positive and negative boxes in ``num_bins`` equal width
+            score bins over :math:`[0, 1]` rather than storing the score of every box. Memory use and
+            synchronization cost are then fixed regardless of the number of boxes, at the cost of
+            treating scores within the same bin as ties. By default the exact scores are stored.
 
         compute_on_step: See :class:`pytorch_lightning.metrics.Metric`
         dist_sync_on_step: See :class:`pytorch_lightning.metrics.Metric`
@@ -41,8 +48,10 @@ class BoxClassificationMetric(Metric, ABC):
         dist_sync_fn: See :class:`pytorch_lightning.metrics.Metric`
 
     Shapes:
-        * ``pred`` - :math:`(N, 6)` in form :math:`(x_1, y_1, x_2, y_2, \text{score}, \text{type})`
-        * ``target`` - :math:`(N, 5)` in form :math:`(x_1, y_1, x_2, y_2, \text{type})`
+        * ``pred`` - :math:`(N, 6)` or :math:`(B, N, 6)` in form :math:`(x_1, y_1, x_2, y_2, \text{score}, \text{type})`
+        * ``target`` - :math:`(N, 5)` or :math:`(B, N, 5)` in form :math:`(x_1, y_1, x_2, y_2, \text{type})`
+
+        Batched inputs should be padded with ``-1``, as produced by :func:`combustion.vision.batch_box_target`.
     """
 
     def __init__(
@@ -51,6 +60,7 @@ class BoxClassificationMetric(Metric, ABC):
         iou_threshold: float = 0.5,
         true_positive_limit: bool = True,
         pred_box_limit: Optional[int] = None,
+        num_bins: Optional[int] = None,
         compute_on_step: bool = True,
         dist_sync_on_step: bool = False,
         process_group: Optional[Any] = None,
@@ -60,16 +70,25 @@ class BoxClassificationMetric(Metric, ABC):
             compute_on_step=compute_on_step,
             dist_sync_on_step=dist_sync_on_step,
             process_group=process_group,
+            dist_sync_fn=dist_sync_fn,
         )
 
         self.pos_label = float(pos_label) if pos_label is not None else None
         self.iou_threshold = float(iou_threshold)
         self.true_positive_limit = bool(true_positive_limit)
         self.pred_box_limit = pred_box_limit
-
-        self.add_state("pred_score", default=torch.empty(0), dist_reduce_fx="cat")
-        self.add_state("target_class", default=torch.empty(0), dist_reduce_fx="cat")
-        self.add_state("binary_target", default=torch.empty(0), dist_reduce_fx="cat")
+        if num_bins is not None and int(num_bins) < 1:
+            raise ValueError(f"Expected num_bins >= 1, found {num_bins}")
+        self.num_bins = int(num_bins) if num_bins is not None else None
+
+        if self.num_bins is not None:
+            self.add_state("positive_hist", default=torch.zeros(self.num_bins, dtype=torch.long), dist_reduce_fx="sum")
+            self.add_state("negative_hist", default=torch.zeros(self.num_bins, dtype=torch.long), dist_reduce_fx="sum")
+        else:
+            # states are lists of per-step chunks, concatenated once at compute time
+            self.add_state("pred_score", default=[], dist_reduce_fx="cat")
+            self.add_state("target_class", default=[], dist_reduce_fx="cat")
+            self.add_state("binary_target", default=[], dist_reduce_fx="cat")
 
     def update(self, pred: torch.Tensor, target: torch.Tensor):
         """
@@ -88,21 +107,49 @@ class BoxClassificationMetric(Metric, ABC):
 
         # restrict the number of predicted boxes to the top K highest confidence boxes
         if self.pred_box_limit is not None and pred.shape[-2] > self.pred_box_limit:
-            indices = pred[..., -2].argsort()
-            pred = pred[indices, ...]
-            assert pred.shape[-2] <= self.pred_box_limit
+            indices = pred[..., -2].topk(self.pred_box_limit, dim=-1).indices
+            pred = pred.gather(-2, indices.unsqueeze(-1).expand(*indices.shape, pred.shape[-1]))
 
         # restrict pred and target to class of interest
+        # batched inputs are padded rather than indexed to preserve the batch dimension
         if self.pos_label is not None:
             pred_keep = pred[..., -1] == self.pos_label
-            pred = pred[pred_keep]
             target_keep = target[..., -1] == self.pos_label
-            target = target[target_keep]
+            if pred.ndim == 3:
+                pred = pred.masked_fill(~pred_keep.unsqueeze(-1), PAD_VALUE)
+                target = target.masked_fill(~target_keep.unsqueeze(-1), PAD_VALUE)
+            else:
+                pred = pred[pred_keep]
+                target = target[target_keep]
 
         pred_score, target_class, binary_target = self.get_pred_target_pairs(pred, target)
-        self.pred_score = torch.cat([self.pred_score, pred_score])
-        self.target_class = torch.cat([self.target_class, target_class])
-        self.binary_target = torch.cat([self.binary_target, binary_target])
+        if self.num_bins is not None:
+            self._update_hist(pred_score, binary_target)
+            return
+
+        self.pred_score.append(pred_score)
+        self.target_class.append(target_class)
+        self.binary_target.append(binary_target)
+
+    def _exact_state(self) -> Tuple[Tensor, Tensor, Tensor]:
+        r"""Returns the concatenated ``pred_score``, ``target_class`` and ``binary_target`` states.
+        Only valid when ``num_bins`` is not given.
+        """
+        return _cat_state(self.pred_score), _cat_state(self.target_class), _cat_state(self.binary_target)
+
+    def _update_hist(self, pred_score: Tensor, binary_target: Tensor) -> None:
+        bins = pred_score.mul(self.num_bins).long().clamp_(min=0, max=self.num_bins - 1)
+        binary_target = binary_target.bool()
+        self.positive_hist += torch.bincount(bins[binary_target], minlength=self.num_bins)
+        self.negative_hist += torch.bincount(bins[~binary_target], minlength=self.num_bins)
+
+    def _cumulative_counts(self) -> Tuple[Tensor, Tensor]:
+        r"""Returns the number of true positive and false positive boxes with a score in or above each
+        score bin, ordered by decreasing score threshold. Only valid when ``num_bins`` is given.
+        """
+        tp = self.positive_hist.flip(0).cumsum(dim=0).float()
+        fp = self.negative_hist.flip(0).cumsum(dim=0).float()
+        return tp, fp
 
     def get_pred_target_pairs(
         self,
@@ -154,3 +201,12 @@ class BoxClassificationMetric(Metric, ABC):
         assert target_out.ndim == 1
         assert pred_out.shape == target_out.shape
         return pred_out, target_out.long(), binary_target
+
+
+def _cat_state(state: Union[Tensor, List[Tensor]]) -> Tensor:
+    # list states are concatenated by distributed sync, but remain lists of chunks otherwise
+    if isinstance(state, Tensor):
+        return state
+    if not state:
+        return torch.empty(0)
+    return torch.cat(state, dim=0)
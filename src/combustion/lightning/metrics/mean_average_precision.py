@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+import torch
+from pytorch_lightning.metrics import Metric
+from torch import Tensor
+
+from combustion.util import check_dimension, check_is_tensor, check_ndim_match
+from combustion.vision import box_iou, split_bbox_scores_class, split_box_target
+from combustion.vision.bbox import PAD_VALUE
+
+
+class BoxMeanAveragePrecision(Metric):
+    r"""Computes COCO style mean average precision over multiple classes and intersection over union
+    thresholds using anchor boxes. The IoU between predicted and target boxes is computed once for
+    each update and shared by all classes and thresholds.
+
+    Predicted boxes are matched to target boxes as in the COCO evaluation. In order of decreasing
+    score, each predicted box is matched to the unmatched target box of the same class with highest
+    IoU, provided that IoU meets the threshold. Matching is repeated independently for each threshold,
+    with all thresholds and examples in a batch matched in parallel. Crowd annotations are not supported.
+
+    Counts of true and false positives are accumulated in ``num_bins`` equal width score bins
+    over :math:`[0, 1]` for each class and threshold, so memory use and synchronization cost
+    do not grow with the number of boxes. Average precision is computed from the interpolated
+    precision / recall curve, where precision at each recall is the maximum precision at any
+    equal or greater recall.
+
+    Args:
+        num_classes (int):
+            Number of box classes. Boxes with a class outside of :math:`[0, \text{num\_classes})`
+            are ignored.
+
+        iou_thresholds (iterable of floats, optional):
+            Intersection over union thresholds on the interval :math:`(0, 1]` for a prediction to
+            be considered a true positive. Defaults to COCO thresholds :math:`0.50, 0.55, \dots, 0.95`.
+
+        num_bins (int):
+            Number of score bins used to accumulate true and false positives.
+
+        pred_box_limit (int, optional):
+            If given, only include the top ``pred_box_limit`` predicted boxes (by score)
+            of each example in the calculation.
+
+        compute_on_step: See :class:`pytorch_lightning.metrics.Metric`
+        dist_sync_on_step: See :class:`pytorch_lightning.metrics.Metric`
+        process_group: See :class:`pytorch_lightning.metrics.Metric`
+        dist_sync_fn: See :class:`pytorch_lightning.metrics.Metric`
+
+    Returns:
+        Tuple of mean average precision over all classes and thresholds, and average precision
+        for each class averaged over thresholds. Classes with no target boxes have an average
+        precision of ``nan`` and are excluded from the mean.
+
+    Shapes:
+        * ``pred`` - :math:`(N, 6)` or :math:`(B, N, 6)` in form :math:`(x_1, y_1, x_2, y_2, \text{score}, \text{type})`
+        * ``target`` - :math:`(N, 5)` or :math:`(B, N, 5)` in form :math:`(x_1, y_1, x_2, y_2, \text{type})`
+        * Output - :math:`()` and :math:`(C)` where :math:`C` is ``num_classes``
+
+        Batched inputs should be padded with ``-1``, as produced by :func:`combustion.vision.batch_box_target`.
+
+    Example::
+
+        >>> metric = BoxMeanAveragePrecision(num_classes=80)
+        >>> for pred, target in loader:
+        >>>     metric.update(pred, target)
+        >>> mean_ap, class_ap = metric.compute()
+    """
+
+    def __init__(
+        self,
+        num_classes: int,
+        iou_thresholds: Optional[Iterable[float]] = None,
+        num_bins: int = 100,
+        pred_box_limit: Optional[int] = None,
+        compute_on_step: bool = True,
+        dist_sync_on_step: bool = False,
+        process_group: Optional[Any] = None,
+        dist_sync_fn: Callable = None,
+    ):
+        super().__init__(
+            compute_on_step=compute_on_step,
+            dist_sync_on_step=dist_sync_on_step,
+            process_group=process_group,
+            dist_sync_fn=dist_sync_fn,
+        )
+        if int(num_classes) < 1:
+            raise ValueError(f"Expected num_classes >= 1, found {num_classes}")
+        if int(num_bins) < 1:
+            raise ValueError(f"Expected num_bins >= 1, found {num_bins}")
+        if iou_thresholds is None:
+            iou_thresholds = [0.5 + 0.05 * i for i in range(10)]
+        iou_thresholds = torch.tensor([float(x) for x in iou_thresholds])
+        if not iou_thresholds.numel() or not ((iou_thresholds > 0) & (iou_thresholds <= 1)).all():
+            raise ValueError(f"Expected iou_thresholds on the interval (0, 1], found {iou_thresholds.tolist()}")
+
+        self.num_classes = int(num_classes)
+        self.num_bins = int(num_bins)
+        self.pred_box_limit = pred_box_limit
+        self.register_buffer("iou_thresholds", iou_thresholds)
+
+        hist_shape = (len(iou_thresholds), self.num_classes, self.num_bins)
+        self.add_state("true_positive_hist", default=torch.zeros(hist_shape, dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("false_positive_hist", default=torch.zeros(hist_shape, dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("num_targets", default=torch.zeros(self.num_classes, dtype=torch.long), dist_reduce_fx="sum")
+
+    def update(self, pred: Tensor, target: Tensor):
+        check_is_tensor(pred, "pred")
+        check_is_tensor(target, "target")
+        check_ndim_match(pred, target, "pred", "target")
+        check_dimension(pred, -1, 6, "pred")
+        check_dimension(target, -1, 5, "target")
+
+        # restrict the number of predicted boxes to the top K highest confidence boxes
+        if self.pred_box_limit is not None and pred.shape[-2] > self.pred_box_limit:
+            indices = pred[..., -2].topk(self.pred_box_limit, dim=-1).indices
+            pred = pred.gather(-2, indices.unsqueeze(-1).expand(*indices.shape, pred.shape[-1]))
+
+        # unbatched inputs are treated as a batch of one, and padded boxes are masked
+        if pred.ndim == 2:
+            pred, target = pred.unsqueeze(0), target.unsqueeze(0)
+        pred_valid = (pred != PAD_VALUE).any(dim=-1)
+        true_valid = (target != PAD_VALUE).any(dim=-1)
+        pred_boxes, pred_scores, pred_cls = split_bbox_scores_class(pred)
+        true_boxes, true_cls = split_box_target(target)
+
+        # IoU is computed once and shared by all classes / thresholds
+        ious = box_iou(pred_boxes, true_boxes)
+        same_class = pred_cls == true_cls.transpose(-1, -2)
+        ious.masked_fill_(~(same_class & pred_valid.unsqueeze(-1) & true_valid.unsqueeze(-2)), 0)
+        tp = self._greedy_match(ious, pred_scores[..., 0], self.iou_thresholds)
+
+        pred_keep = pred_valid & self._valid_class(pred_cls)
+        tp = tp[pred_keep]
+        pred_scores = pred_scores[..., 0][pred_keep]
+        pred_cls = pred_cls[..., 0][pred_keep].long()
+
+        # histogram index for each (threshold, class, score bin)
+        num_thresholds = self.iou_thresholds.numel()
+        bins = pred_scores.mul(self.num_bins).long().clamp_(min=0, max=self.num_bins - 1)
+        threshold_offset = torch.arange(num_thresholds, device=bins.device) * self.num_classes
+        index = (threshold_offset + pred_cls.unsqueeze(-1)) * self.num_bins + bins.unsqueeze(-1)
+
+        size = num_thresholds * self.num_classes * self.num_bins
+        self.true_positive_hist += torch.bincount(index[tp], minlength=size).view_as(self.true_positive_hist)
+        self.false_positive_hist += torch.bincount(index[~tp], minlength=size).view_as(self.false_positive_hist)
+
+        true_cls = true_cls[..., 0][true_valid & self._valid_class(true_cls)].long()
+        self.num_targets += torch.bincount(true_cls, minlength=self.num_classes)
+
+    def compute(self) -> Tuple[Tensor, Tensor]:
+        # cumulative counts in order of decreasing score threshold
+        tp = self.true_positive_hist.flip(-1).cumsum(dim=-1).float()
+        fp = self.false_positive_hist.flip(-1).cumsum(dim=-1).float()
+        num_targets = self.num_targets.float()
+
+        precision = tp / (tp + fp).clamp_min(1)
+        recall = tp / num_targets.view(1, -1, 1).clamp_min(1)
+
+        # interpolate precision as the max precision at any lower score threshold (greater recall)
+        precision = precision.flip(-1).cummax(dim=-1).values.flip(-1)
+
+        # bins without any boxes contribute no change in recall
+        recall_delta = torch.cat([recall[..., :1], recall[..., 1:] - recall[..., :-1]], dim=-1)
+        class_ap = (recall_delta * precision).sum(dim=-1).mean(dim=0)
+
+        has_targets = num_targets > 0
+        class_ap = class_ap.masked_fill(~has_targets, float("nan"))
+        return class_ap[has_targets].mean(), class_ap
+
+    def _valid_class(self, cls: Tensor) -> Tensor:
+        cls = cls[..., 0]
+        return (cls >= 0) & (cls < self.num_classes)
+
+    @staticmethod
+    def _greedy_match(ious: Tensor, scores: Tensor, thresholds: Tensor) -> Tensor:
+        # COCO matching: in order of decreasing score, each pred box is matched to the highest IoU target box
+        # not already matched at that threshold. Thresholds and examples are matched in parallel.
+        batch_size, num_pred, num_true = ious.shape
+        num_thresholds = thresholds.numel()
+        tp = ious.new_zeros(batch_size, num_thresholds, num_pred, dtype=torch.bool)
+        if not num_pred or not num_true:
+            return tp.transpose(-1, -2)
+
+        order = scores.argsort(dim=-1, descending=True)
+        ious = ious.gather(-2, order.unsqueeze(-1).expand_as(ious))
+        matched = ious.new_zeros(batch_size, num_thresholds, num_true, dtype=torch.bool)
+        min_iou = thresholds.view(1, -1, 1)
+
+        for i in range(num_pred):
+            iou = ious[:, i, :].unsqueeze(1).expand(-1, num_thresholds, -1)
+            candidates = (iou >= min_iou) & ~matched
+            best_iou, best_true = iou.masked_fill(~candidates, -1).max(dim=-1)
+            is_match = best_iou >= 0
+            tp[..., i] = is_match
+            matched |= torch.zeros_like(matched).scatter_(-1, best_true.unsqueeze(-1), is_match.unsqueeze(-1))
+
+        # restore the original pred box order
+        tp = tp.scatter(-1, order.unsqueeze(1).expand_as(tp), tp)
+        return tp.transpose(-1, -2)
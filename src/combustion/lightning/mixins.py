@@ -16,9 +16,14 @@ from torch import Tensor
 from torch.optim import Optimizer
 from torch.utils.data import DataLoader, Dataset, random_split
 
+from combustion.data import PersistentCachedDataset, hash_config
+
 
 _INSTANTIATE_KEYS = ["cls", "target", "_target_"]
 
+# keys in a dataset config that are used by the DataLoader rather than the dataset
+_DATALOADER_KEYS = ["num_workers", "pin_memory", "drop_last", "shuffle", "collate_fn", "batch_size"]
+
 
 def _is_instantiate_key(k: str) -> bool:
     return k in _INSTANTIATE_KEYS
@@ -370,6 +375,28 @@ class HydraMixin(ModelIO):
 
               # as a random split from training set by fraction
               # test: 0.1
+
+        A persistent on-disk cache of the deterministic stages of a dataset's transform pipeline can be
+        enabled by adding a ``cache`` section to a dataset config. The instantiated dataset, including any
+        transforms passed to it, is treated as deterministic and is wrapped in a
+        :class:`combustion.data.PersistentCachedDataset`. Random augmentations given under ``cache`` are
+        applied after loading from the cache. The cache key is a hash of the dataset config, excluding
+        DataLoader options and the ``cache`` section itself.
+
+        .. code-block:: yaml
+
+            dataset:
+              train:
+                target: torchvision.datasets.ImageFolder
+                params:
+                  root: path/to/data
+                  transform:
+                    target: torchvision.transforms.ToTensor
+                cache:
+                  path: /scratch/cache
+                  # optional random augmentations, run on every access
+                  transform:
+                    target: torchvision.transforms.RandomErasing
         """
         if self._has_datasets and not force:
             return self.train_ds, self.val_ds, self.test_ds
@@ -380,7 +407,7 @@ class HydraMixin(ModelIO):
         # training set is only needed if test set is a split from training
         test_only = "test_only" in self.hparams.trainer and self.hparams.trainer["test_only"]
         if test_only and not isinstance(dataset_cfg["test"], (int, float)):
-            test_ds = HydraMixin.instantiate(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
+            test_ds = HydraMixin._instantiate_dataset(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
             self.train_ds = None
             self.val_ds = None
             self.test_ds = test_ds
@@ -388,7 +415,7 @@ class HydraMixin(ModelIO):
             return self.train_ds, self.val_ds, self.test_ds
 
         train_ds: Optional[Dataset] = (
-            HydraMixin.instantiate(dataset_cfg["train"]) if "train" in dataset_cfg.keys() else None
+            HydraMixin._instantiate_dataset(dataset_cfg["train"]) if "train" in dataset_cfg.keys() else None
         )
 
         # determine sizes validation/test sets if specified as a fraction of training set
@@ -416,14 +443,18 @@ class HydraMixin(ModelIO):
         elif splits["validate"] is not None:
             lengths = (splits["train"], splits["validate"])
             train_ds, val_ds = random_split(train_ds, lengths)
-            test_ds = HydraMixin.instantiate(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
+            test_ds = HydraMixin._instantiate_dataset(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
         elif splits["test"] is not None:
             lengths = (splits["train"], splits["test"])
             train_ds, test_ds = random_split(train_ds, lengths)
-            val_ds = HydraMixin.instantiate(dataset_cfg["validate"]) if "validate" in dataset_cfg.keys() else None
+            val_ds = (
+                HydraMixin._instantiate_dataset(dataset_cfg["validate"]) if "validate" in dataset_cfg.keys() else None
+            )
         else:
-            val_ds = HydraMixin.instantiate(dataset_cfg["validate"]) if "validate" in dataset_cfg.keys() else None
-            test_ds = HydraMixin.instantiate(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
+            val_ds = (
+                HydraMixin._instantiate_dataset(dataset_cfg["validate"]) if "validate" in dataset_cfg.keys() else None
+            )
+            test_ds = HydraMixin._instantiate_dataset(dataset_cfg["test"]) if "test" in dataset_cfg.keys() else None
 
         self.train_ds = train_ds
         self.val_ds = val_ds
@@ -431,6 +462,29 @@ class HydraMixin(ModelIO):
         self._has_datasets = True
         return self.train_ds, self.val_ds, self.test_ds
 
+    @staticmethod
+    def _instantiate_dataset(config: Union[DictConfig, dict]) -> Dataset:
+        if isinstance(config, dict):
+            config = DictConfig(config)
+        if "cache" not in config.keys() or not config.get("cache"):
+            return HydraMixin.instantiate(config)
+
+        config = deepcopy(config)
+        OmegaConf.set_struct(config, False)
+        cache_config = config.pop("cache")
+        dataset = HydraMixin.instantiate(config)
+
+        key_config = OmegaConf.to_container(config, resolve=True)
+        for k in _DATALOADER_KEYS:
+            key_config.pop(k, None)
+
+        transform_kwargs = {
+            k: HydraMixin.instantiate(cache_config[k])
+            for k in ("transform", "target_transform", "transforms")
+            if cache_config.get(k, None) is not None
+        }
+        return PersistentCachedDataset(dataset, cache_config["path"], hash_config(key_config), **transform_kwargs)
+
     def train_dataloader(self) -> Optional[DataLoader]:
         train_ds, _, _ = self.get_datasets()
         return self._dataloader(train_ds, "train")
@@ -4,6 +4,7 @@
 from .bbox import (
     append_bbox_label,
     batch_box_target,
+    collate_box_target,
     combine_bbox_scores_class,
     combine_box_target,
     filter_bbox_classes,
@@ -17,15 +18,20 @@ from .centernet import AnchorsToPoints, PointsToAnchors
 from .contour import mask_to_polygon
 from .convert import to_8bit
 from .iou_assign import BinaryLabelIoU, CategoricalLabelIoU, ConfusionMatrixIoU
-from .nms import nms
+from .nms import box_iou, nms, soft_nms, weighted_box_fusion
+from .ragged import RaggedBoxTarget
 
 
 __all__ = [
     "AnchorsToPoints",
     "BinaryLabelIoU",
+    "box_iou",
     "nms",
+    "soft_nms",
+    "weighted_box_fusion",
     "mask_to_polygon",
     "PointsToAnchors",
+    "RaggedBoxTarget",
     "visualize_bbox",
     "to_8bit",
     "ConfusionMatrixIoU",
@@ -35,6 +41,7 @@ __all__ = [
     "combine_box_target",
     "combine_bbox_scores_class",
     "batch_box_target",
+    "collate_box_target",
     "unbatch_box_target",
     "flatten_box_target",
     "append_bbox_label",
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import numpy as np
 import torch
 import torch.nn as nn
 from torch import Tensor
@@ -78,7 +78,135 @@ class ClipBoxes(nn.Module):
         return boxes
 
 
+class AnchorDecoder(nn.Module):
+    r"""Fused post-processing stage that decodes anchor box regression deltas, clips the decoded
+    boxes to the image bounds, and discards anchors with a low score. This is equivalent to
+    :class:`AnchorBoxTransform` followed by :class:`ClipBoxes` and a score threshold, but anchors
+    failing the score threshold are dropped before decoding, so decoded boxes are only materialized
+    for anchors that will be passed on to non-maximal suppression. Inputs are not modified.
+
+    Each anchor is assigned the class with the highest score. Outputs are flattened over the batch,
+    with the example each box belongs to given by ``batch_idx``. This module is TorchScript compatible.
+
+    Args:
+        mean (:class:`torch.Tensor`, optional):
+            Mean used to normalize the regression deltas, as in :class:`AnchorBoxTransform`
+
+        std (:class:`torch.Tensor`, optional):
+            Standard deviation used to normalize the regression deltas, as in :class:`AnchorBoxTransform`
+
+        log_length (bool):
+            If ``True``, width and height deltas are given in log space, as in :class:`AnchorBoxTransform`
+
+        score_threshold (float):
+            Anchors with a maximum class score less than or equal to this value are discarded
+
+    Shape:
+        * ``anchors`` - :math:`(N, 4)` or :math:`(B, N, 4)` in format :math:`x_1, y_1, x_2, y_2`
+        * ``deltas`` - :math:`(B, N, 4)`
+        * ``scores`` - :math:`(B, N, C)` where :math:`C` is the number of classes
+        * Output - Tuple of ``boxes``, ``scores``, ``classes`` and ``batch_idx`` tensors, with shapes
+          :math:`(K, 4)`, :math:`(K)`, :math:`(K)`, and :math:`(K)`, where :math:`K` is the number of
+          anchors exceeding ``score_threshold``.
+
+    Example::
+
+        >>> decoder = AnchorDecoder(score_threshold=0.05, log_length=True)
+        >>> boxes, scores, classes, batch_idx = decoder(anchors, deltas, scores, height, width)
+        >>> keep = nms(boxes, scores, 0.5, classes=batch_idx * num_classes + classes)
+    """
+
+    def __init__(
+        self,
+        mean: Optional[Tensor] = None,
+        std: Optional[Tensor] = None,
+        log_length: bool = False,
+        score_threshold: float = 0.0,
+    ):
+        super(AnchorDecoder, self).__init__()
+        self.register_buffer("mean", mean)
+        self.register_buffer("std", std)
+        self.log_length = bool(log_length)
+        self.score_threshold = float(score_threshold)
+
+    def extra_repr(self) -> str:
+        return f"log_length={self.log_length}, score_threshold={self.score_threshold}"
+
+    def forward(
+        self, anchors: Tensor, deltas: Tensor, scores: Tensor, height: int, width: int
+    ) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        max_scores, classes = scores.max(dim=-1)
+        keep = (max_scores > self.score_threshold).nonzero()
+        batch_idx, anchor_idx = keep[:, 0], keep[:, 1]
+
+        # only anchors passing the threshold are gathered and decoded
+        if anchors.ndim == 2:
+            boxes = anchors[anchor_idx]
+        else:
+            boxes = anchors[batch_idx, anchor_idx]
+        deltas = deltas[batch_idx, anchor_idx]
+        max_scores = max_scores[batch_idx, anchor_idx]
+        classes = classes[batch_idx, anchor_idx]
+
+        # unapply mean/variance normalization on deltas
+        std = self.std
+        mean = self.mean
+        if std is not None:
+            deltas = deltas * std
+        if mean is not None:
+            deltas = deltas + mean
+
+        lengths = boxes[:, 2:] - boxes[:, :2]
+        centers = boxes[:, :2] + 0.5 * lengths
+        if self.log_length:
+            pred_lengths = deltas[:, 2:].exp() * lengths
+        else:
+            pred_lengths = deltas[:, 2:] * lengths
+        pred_centers = centers + deltas[:, :2] * lengths
+
+        pred_boxes = torch.cat([pred_centers - 0.5 * pred_lengths, pred_centers + 0.5 * pred_lengths], dim=-1)
+        # clip as in ClipBoxes
+        pred_boxes[:, :2].clamp_(min=0)
+        pred_boxes[:, 2].clamp_(max=width)
+        pred_boxes[:, 3].clamp_(max=height)
+        return pred_boxes, max_scores, classes, batch_idx
+
+
 class Anchors(nn.Module):
+    r"""Generates anchor boxes for each level of a feature pyramid, given an input image.
+
+    Generated anchors are cached, keyed by the image height / width and the device / dtype of the image, such that
+    repeated calls with images of the same size do not regenerate anchors. The cache holds at most ``cache_size``
+    entries, with the least recently used entry being evicted first. Anchors for image sizes given in ``precompute``
+    are generated when the module is created and are never evicted, which is useful for multi-scale training.
+
+    Args:
+        levels (list of ints):
+            Feature pyramid levels at which to generate anchors
+
+        strides (list of ints, optional):
+            Stride of each level. Defaults to :math:`2^{level}`.
+
+        sizes (list of ints, optional):
+            Base anchor size of each level. Defaults to :math:`2^{level + 2}`.
+
+        ratios (tensor, optional):
+            Anchor aspect ratios
+
+        scales (tensor, optional):
+            Anchor scales
+
+        cache_size (int):
+            Maximum number of cached anchor sets
+
+        precompute (list of tuples of ints, optional):
+            Image sizes :math:`(H, W)` for which anchors will be generated ahead of time
+
+    Shape:
+        * ``image`` - :math:`(*, H, W)`
+        * Output - :math:`(N, 4)` where :math:`N` is the total number of anchors over all levels.
+    """
+
     def __init__(
         self,
         levels: List[int],
@@ -86,49 +214,76 @@ class Anchors(nn.Module):
         sizes: Optional[List[int]] = None,
         ratios: Optional[List[int]] = None,
         scales: Optional[List[int]] = None,
+        cache_size: int = 8,
+        precompute: Optional[Iterable[Tuple[int, int]]] = None,
     ):
         super(Anchors, self).__init__()
+        if int(cache_size) < 0:
+            raise ValueError(f"Expected cache_size >= 0, found {cache_size}")
         self.levels = levels
         self.strides = [2 ** x for x in self.levels] if strides is None else strides
         self.sizes = [2 ** (x + 2) for x in self.levels] if sizes is None else sizes
         self.ratios = torch.tensor([0.5, 1, 2]) if ratios is None else ratios
         self.scales = torch.tensor([2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)]) if scales is None else scales
+        self.cache_size = int(cache_size)
+
+        # LRU cache of anchors keyed by (height, width, device, dtype)
+        self._cache: OrderedDict = OrderedDict()
 
-        # buffer for anchors based on last image shape
-        self._buffered_anchors = None
-        self._buffered_shape = None
+        # anchors for expected image sizes, keyed by (height, width) and stored on CPU
+        self._precomputed: Dict[Tuple[int, int], Tensor] = {}
+        for height, width in precompute or []:
+            self._precomputed[(int(height), int(width))] = self._create_anchors(
+                int(height), int(width), torch.device("cpu"), torch.get_default_dtype()
+            )
 
     @property
     def num_anchors(self):
         return len(self.ratios) * len(self.scales)
 
     def forward(self, image: Tensor) -> Tensor:
-        image_shape = image.shape[-2:]
+        height, width = image.shape[-2:]
+        key = (height, width, image.device, image.dtype)
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        # anchors previously generated for this image size on another device / dtype can be moved
+        source = self._precomputed.get((height, width), None)
+        if source is None:
+            source = next((v for k, v in self._cache.items() if k[:2] == (height, width)), None)
+
+        if source is not None:
+            anchors = source.to(device=image.device, dtype=image.dtype)
+        else:
+            anchors = self._create_anchors(height, width, image.device, image.dtype)
+
+        if self.cache_size:
+            self._cache[key] = anchors
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return anchors
 
-        # try restoring from buffer if image.shape == last_image.shape
-        if self._buffered_shape is not None and image_shape == self._buffered_shape:
-            return self._buffered_anchors
+    def clear_cache(self) -> None:
+        r"""Clears cached anchors. Precomputed anchors are retained."""
+        self._cache.clear()
 
-        image_shape = np.array(image_shape)
-        image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in self.levels]
-        image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in range(len(self.levels))]
+    def _create_anchors(self, height: int, width: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+        image_shapes = [
+            ((height + 2 ** x - 1) // (2 ** x), (width + 2 ** x - 1) // (2 ** x)) for x in range(len(self.levels))
+        ]
 
         all_anchors = []
-
         for idx, p in enumerate(self.levels):
             anchors = self._generate_anchors(base_size=self.sizes[idx], ratios=self.ratios, scales=self.scales)
-            anchors = anchors.type_as(image)
+            anchors = anchors.to(device=device, dtype=dtype)
             shifted_anchors = self._shift(image_shapes[idx], self.strides[idx], anchors)
 
             # snap anchor coords to int grid and drop repeated boxes
             shifted_anchors = shifted_anchors.round().unique(dim=0)
             all_anchors.append(shifted_anchors)
-        all_anchors = torch.cat(all_anchors, 0)
-
-        # set buffer state
-        self._buffered_anchors = all_anchors
-        self._buffered_shape = image.shape
-        return all_anchors
+        return torch.cat(all_anchors, 0)
 
     def _generate_anchors(self, base_size: int, ratios: List[float], scales: List[float]) -> Tensor:
         anchors = torch.zeros(self.num_anchors, 4)
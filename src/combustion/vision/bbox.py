@@ -10,6 +10,7 @@ from torch import Tensor
 from combustion.util import check_dimension, check_dimension_match, check_is_array, check_is_tensor, check_ndim_match
 
 from .convert import to_8bit
+from .ragged import RaggedBoxTarget
 
 
 PAD_VALUE: float = -1
@@ -233,7 +234,9 @@ def visualize_bbox(
     return result
 
 
-def split_box_target(target: Tensor, split_label: Union[bool, Iterable[int]] = False) -> Tuple[Tensor, ...]:
+def split_box_target(
+    target: Union[Tensor, RaggedBoxTarget], split_label: Union[bool, Iterable[int]] = False
+) -> Tuple[Union[Tensor, RaggedBoxTarget], ...]:
     r"""Split a bounding box label set into box coordinates and label tensors.
 
     .. note::
@@ -253,7 +256,12 @@ def split_box_target(target: Tensor, split_label: Union[bool, Iterable[int]] = F
           number of labels associated with each box.
 
         * Output - :math:`(*, N, 4)` and :math:`(*, N, C)`
+
+    If ``target`` is a :class:`combustion.vision.RaggedBoxTarget`, each output is also a ragged target.
     """
+    if isinstance(target, RaggedBoxTarget):
+        return tuple(target.with_values(x) for x in split_box_target(target.values, split_label))
+
     check_is_tensor(target, "target")
     bbox = target[..., :4]
     label = target[..., 4:]
@@ -280,7 +288,9 @@ def split_box_target(target: Tensor, split_label: Union[bool, Iterable[int]] = F
     return tuple([bbox] + final_label)
 
 
-def split_bbox_scores_class(target: Tensor, split_scores: Union[bool, Iterable[int]] = False) -> Tuple[Tensor, ...]:
+def split_bbox_scores_class(
+    target: Union[Tensor, RaggedBoxTarget], split_scores: Union[bool, Iterable[int]] = False
+) -> Tuple[Union[Tensor, RaggedBoxTarget], ...]:
     r"""Split a predicted bounding box into box coordinates, probability score, and predicted class.
     This implementation supports multiple score assignments for each box. It is expected that ``target``
     be ordered along the last dimension as ``bbox``, ``scores``, ``class``.
@@ -301,7 +311,12 @@ def split_bbox_scores_class(target: Tensor, split_scores: Union[bool, Iterable[i
         * ``target`` - :math:`(*, N, 4 + S + 1)` where :math:`N` is the number of boxes and :math:`S` is the
           number of scores associated with each box.
         * Output - :math:`(*, N, 4)`, :math:`(*, N, S)`, and :math:`(*, N, 1)`
+
+    If ``target`` is a :class:`combustion.vision.RaggedBoxTarget`, each output is also a ragged target.
     """
+    if isinstance(target, RaggedBoxTarget):
+        return tuple(target.with_values(x) for x in split_bbox_scores_class(target.values, split_scores))
+
     check_is_tensor(target, "target")
     bbox = target[..., :4]
     scores = target[..., 4:-1]
@@ -387,7 +402,9 @@ def combine_bbox_scores_class(bbox: Tensor, cls: Tensor, scores: Tensor, *extra_
     return torch.cat([bbox, scores, *extra_scores, cls], dim=-1)
 
 
-def batch_box_target(target: List[Tensor], pad_value: float = -1) -> Tensor:
+def batch_box_target(
+    target: List[Tensor], pad_value: float = -1, return_lengths: bool = False
+) -> Union[Tensor, Tuple[Tensor, Tensor]]:
     r"""Combine multiple distinct bounding box targets into a single batched target.
 
     Args:
@@ -397,38 +414,50 @@ def batch_box_target(target: List[Tensor], pad_value: float = -1) -> Tensor:
         pad_value (float):
             Padding value to use when creating the batch
 
+        return_lengths (bool):
+            If ``True``, also return the number of boxes in each example of the batch, excluding padding.
+            Boxes in unbatched inputs are always counted, even if their values equal ``pad_value``.
+
     Shape:
         * ``target`` - :math:`(*, N_i, 4 + C)` where :math:`N_i` is the number of boxes and :math:`C` is the
           number of labels associated with each box.
 
-        * Output - :math:`(B, N, 4 + c)`
+        * Output - :math:`(B, N, 4 + c)`, and :math:`(B)` if ``return_lengths`` is ``True``
     """
-    max_boxes = 0
-    for elem in target:
-        # check_is_tensor(elem, "target_elem")
-        max_boxes = max(max_boxes, elem.shape[-2])
+    # lengths of unbatched examples are known before padding
+    # already batched inputs may contain their own padding, which must be excluded from the count
+    if return_lengths:
+        lengths = [
+            torch.tensor([x.shape[-2]]) if x.ndim < 3 else (x != pad_value).any(dim=-1).sum(dim=-1).cpu()
+            for x in target
+        ]
 
     # add a batch dim if not present
     target = [x.unsqueeze(0) if x.ndim < 3 else x for x in target]
 
-    # compute output batch size
-    batch_size = torch.tensor([x.shape[0] for x in target]).sum().item()
+    # compute output shape in a single pass
+    batch_size, max_boxes = 0, 0
+    for elem in target:
+        batch_size += elem.shape[0]
+        max_boxes = max(max_boxes, elem.shape[-2])
 
-    # create empty output tensor of correct shape
+    # create output tensor of correct shape
     output_shape = (batch_size, max_boxes, target[0].shape[-1])
-    batch = torch.empty(*output_shape, device=target[0].device, dtype=target[0].dtype).fill_(pad_value)
+    batch = target[0].new_full(output_shape, pad_value)
 
     # fill output tensor
     start = 0
     for elem in target:
         end = start + elem.shape[0]
         batch[start:end, : elem.shape[-2], :] = elem
-        start += elem.shape[0]
+        start = end
 
+    if return_lengths:
+        return batch, torch.cat(lengths).to(batch.device)
     return batch
 
 
-def unbatch_box_target(target: Tensor, pad_value: float = -1) -> List[Tensor]:
+def unbatch_box_target(target: Union[Tensor, RaggedBoxTarget], pad_value: float = -1) -> List[Tensor]:
     r"""Splits a padded batch of bounding boxtarget tensors into a list of unpadded target tensors
 
     Args:
@@ -444,17 +473,61 @@ def unbatch_box_target(target: Tensor, pad_value: float = -1) -> List[Tensor]:
 
         * Output - :math:`(N, 4 + C)`
     """
+    if isinstance(target, RaggedBoxTarget):
+        return target.unbind()
+
     check_is_tensor(target, "target")
+    non_padded = (target != pad_value).any(dim=-1)
+    split_size = non_padded.sum(dim=-1).tolist()
+    return torch.split(target[non_padded], split_size, dim=0)
 
-    padding_indices = (target == pad_value).all(dim=-1)
-    non_padded_coords = (~padding_indices).nonzero(as_tuple=True)
 
-    flat_result = target[non_padded_coords]
-    split_size = non_padded_coords[0].unique(return_counts=True)[1]
-    return torch.split(flat_result, split_size.tolist(), dim=0)
+def collate_box_target(
+    examples: Iterable[Tuple[Tensor, ...]], pad_value: float = -1, ragged: bool = False
+) -> Tuple[Union[Tensor, RaggedBoxTarget], ...]:
+    r"""Collate function for examples with a variable number of bounding boxes, suitable for use as the
+    ``collate_fn`` of a :class:`torch.utils.data.DataLoader`. The final element of each example is
+    taken to be a bounding box target. Box targets are padded into a single batched target, and all
+    other elements are stacked along a new batch dimension.
+
+    The number of boxes in each example is returned as the final element of the output. Offsets
+    of each example in a flattened (unpadded) target can be computed as ``lengths.cumsum(dim=0) - lengths``.
+
+    Args:
+        examples (iterable of tuples of :class:`torch.Tensor`):
+            Examples to collate
+
+        pad_value (float):
+            Padding value to use when creating the batch
+
+        ragged (bool):
+            If ``True``, combine box targets into a :class:`combustion.vision.RaggedBoxTarget` rather
+            than padding them. In this case no lengths are returned, as they are given by the ragged target.
+
+    Shape:
+        * ``examples`` - Tuples of tensors, where the final tensor is of shape :math:`(N_i, 4 + C)`
+        * Output - Stacked tensors for all non-target elements, followed by the batched target of shape
+          :math:`(B, N, 4 + C)` and the number of boxes in each example of shape :math:`(B)`.
+
+    Example::
+
+        >>> loader = DataLoader(dataset, batch_size=8, collate_fn=collate_box_target)
+        >>> img, target, lengths = next(iter(loader))
+    """
+    examples = list(examples)
+    if not examples:
+        raise ValueError("Expected non-empty examples")
+
+    *others, target = zip(*examples)
+    others = [torch.stack(x, dim=0) for x in others]
+    if ragged:
+        return (*others, RaggedBoxTarget.from_list(target))
+
+    target, lengths = batch_box_target(list(target), pad_value=pad_value, return_lengths=True)
+    return (*others, target, lengths)
 
 
-def flatten_box_target(target: Tensor, pad_value: float = -1) -> List[Tensor]:
+def flatten_box_target(target: Union[Tensor, RaggedBoxTarget], pad_value: float = -1) -> Tensor:
     r"""Flattens a batch of bounding box target tensors, removing padded locations
 
     Args:
@@ -470,13 +543,18 @@ def flatten_box_target(target: Tensor, pad_value: float = -1) -> List[Tensor]:
 
         * Output - :math:`(N_{tot}, 4 + C)`
     """
+    if isinstance(target, RaggedBoxTarget):
+        return target.values
+
     check_is_tensor(target, "target")
     padding_indices = (target == pad_value).all(dim=-1)
     non_padded_coords = (~padding_indices).nonzero(as_tuple=True)
     return target[non_padded_coords]
 
 
-def append_bbox_label(old_label: Tensor, new_label: Tensor) -> Tensor:
+def append_bbox_label(
+    old_label: Union[Tensor, RaggedBoxTarget], new_label: Union[Tensor, RaggedBoxTarget]
+) -> Union[Tensor, RaggedBoxTarget]:
     r"""Adds a new label element to an existing bounding box target.
     The new label will be concatenated to the end of the last dimension in
     ``old_label``.
@@ -492,7 +570,17 @@ def append_bbox_label(old_label: Tensor, new_label: Tensor) -> Tensor:
         * ``old_label`` - :math:`(*, N, C_0)`
         * ``new_label`` - :math:`(B, N, C_1`)`
         * Output - :math:`(B, N, C_0 + C_1)`
+
+    If ``old_label`` and ``new_label`` are :class:`combustion.vision.RaggedBoxTarget` instances with matching
+    offsets, the output is also a ragged target.
     """
+    if isinstance(old_label, RaggedBoxTarget) or isinstance(new_label, RaggedBoxTarget):
+        if not (isinstance(old_label, RaggedBoxTarget) and isinstance(new_label, RaggedBoxTarget)):
+            raise TypeError("Expected both old_label and new_label to be RaggedBoxTarget")
+        if not torch.equal(old_label.offsets, new_label.offsets):
+            raise ValueError("Expected old_label and new_label to have matching offsets")
+        return old_label.with_values(append_bbox_label(old_label.values, new_label.values))
+
     check_is_tensor(old_label, "old_label")
     check_is_tensor(new_label, "new_label")
     check_ndim_match(old_label, new_label, "old_label", "new_label")
@@ -505,8 +593,11 @@ def append_bbox_label(old_label: Tensor, new_label: Tensor) -> Tensor:
 
 
 def filter_bbox_classes(
-    target: Tensor, keep_classes: Iterable[int], pad_value: float = -1, return_inverse: bool = False
-) -> Tensor:
+    target: Union[Tensor, RaggedBoxTarget],
+    keep_classes: Iterable[int],
+    pad_value: float = -1,
+    return_inverse: bool = False,
+) -> Union[Tensor, RaggedBoxTarget]:
     r"""Filters bounding boxes based on class, replacing bounding boxes that do not meet the criteria
     with padding. Integer class ids should be the last column in ``target``.
 
@@ -526,23 +617,30 @@ def filter_bbox_classes(
     Shape:
         * ``target`` - :math:`(*, N, C)`
         * Output - same as ``target``
+
+    If ``target`` is a :class:`combustion.vision.RaggedBoxTarget`, boxes that do not meet the criteria
+    are removed rather than replaced with padding.
     """
-    check_is_tensor(target, "target")
+    values = target.values if isinstance(target, RaggedBoxTarget) else target
+    check_is_tensor(values, "target")
     if not isinstance(keep_classes, Iterable):
         raise TypeError(f"Expected iterable for keep_classes, found {type(keep_classes)}")
     if not keep_classes:
         raise ValueError(f"Expected non-empty iterable for keep classes, found {keep_classes}")
 
-    locations_to_keep = torch.zeros_like(target[..., -1]).bool()
+    locations_to_keep = torch.zeros_like(values[..., -1]).bool()
     for keep_cls in keep_classes:
         if not isinstance(keep_cls, (float, int)):
             raise TypeError(f"Expected int or float for keep_classes elements, found {type(keep_cls)}")
-        locations_for_cls = torch.as_tensor(target[..., -1] == keep_cls)
+        locations_for_cls = torch.as_tensor(values[..., -1] == keep_cls)
         locations_to_keep.logical_or_(locations_for_cls)
 
     if return_inverse:
         locations_to_keep.logical_not_()
 
+    if isinstance(target, RaggedBoxTarget):
+        return target.masked_select(locations_to_keep)
+
     target = target.clone()
     target[~locations_to_keep] = -1
     return target
@@ -12,18 +12,6 @@ from combustion.util import alpha_blend, apply_colormap, check_is_tensor, check_
 from .convert import to_8bit
 
 
-try:
-    from kornia.feature import non_maxima_suppression2d
-except ImportError:
-
-    def non_maxima_suppression2d(*args, **kwargs):
-        raise ImportError(
-            "PointsToAnchors requires kornia. "
-            "Please install combustion with 'vision' extras using "
-            "pip install combustion [vision]"
-        )
-
-
 class AnchorsToPoints:
     r"""Transform that converts bounding boxes to CenterNet style labels
     as described in the paper `Objects as Points`_.
@@ -49,6 +37,14 @@ class AnchorsToPoints:
             The factor by which the radius of all possible anchor boxes with IoU > threshold
             will be divided to determine the Gaussian smoothing sigma. Default 3.
 
+        min_sigma (float, optional):
+            Lower bound on the Gaussian smoothing sigma. Default 1e-6.
+
+        truncate (float, optional):
+            If given, each Gaussian is only evaluated within ``truncate`` standard deviations of its
+            center, and is zero elsewhere. The cost of splatting then scales with box size rather than
+            with heatmap size. By default each Gaussian is evaluated over the entire heatmap.
+
     Shape:
         - Bounding boxes: :math:`(*, N, 4)` where :math:`*` means an optional batch dimension
           and :math:`N` is the number of bounding boxes
@@ -56,6 +52,10 @@ class AnchorsToPoints:
         - Output: :math:`(*, C + 4, H, W)` where :math:`C` is the number of classes, and :math:`H, W`
           are the height and width of the downsampled heatmap.
 
+    .. note::
+        Batched inputs are processed in a single pass. Examples with differing numbers of boxes
+        should be padded with a class of ``-1``, as produced by :func:`combustion.vision.batch_box_target`.
+
     .. _Objects as Points:
         https://arxiv.org/abs/1904.07850
     """
@@ -67,12 +67,14 @@ class AnchorsToPoints:
         iou_threshold: Optional[float] = 0.7,
         radius_div: Optional[float] = 3,
         min_sigma: float = 1e-6,
+        truncate: Optional[float] = None,
     ):
         self.num_classes = abs(int(num_classes))
         self.downsample = abs(int(downsample))
         self.iou_threshold = abs(float(iou_threshold))
         self.radius_div = abs(float(radius_div))
         self.min_sigma = abs(float(min_sigma))
+        self.truncate = abs(float(truncate)) if truncate is not None else None
 
     def __repr__(self):
         s = f"AnchorsToPoints(num_classes={self.num_classes}"
@@ -80,32 +82,32 @@ class AnchorsToPoints:
         s += f", iou={self.iou_threshold}"
         s += f", radius_div={self.radius_div}"
         s += f", min_sigma={self.min_sigma}"
+        if self.truncate is not None:
+            s += f", truncate={self.truncate}"
         s += ")"
         return s
 
     def __call__(self, bbox: Tensor, classes: Tensor, shape: Tuple[int, int]) -> Tensor:
-        original_ndim = bbox.ndim
-
-        # recurse on batched input
-        if original_ndim == 3:
-            results = []
-            for box, cls in zip(bbox, classes):
-                results.append(self(box, cls, shape))
-            return torch.stack(results, 0)
-
-        valid_indices = classes[..., -1] >= 0
-        bbox, classes = bbox[valid_indices], classes[valid_indices]
+        if bbox.ndim not in (2, 3):
+            raise ValueError(f"Expected bbox.ndim in (2, 3), found shape {bbox.shape}")
 
         # unsqueeze a batch dim if not present
-        bbox = bbox.view(bbox.shape[-2], 4)
-        classes = classes.view(classes.shape[-2], 1)
+        is_batched = bbox.ndim == 3
+        if not is_batched:
+            bbox, classes = bbox.unsqueeze(0), classes.unsqueeze(0)
+        batch_size = bbox.shape[0]
 
         # determine input/output height/width
         height, width = shape[-2:]
-        num_rois = bbox.shape[-2]
         out_height = height // self.downsample
         out_width = width // self.downsample
 
+        # drop padded boxes from all examples at once, tracking the example each box came from
+        valid_indices = classes[..., -1] >= 0
+        batch_idx = valid_indices.nonzero(as_tuple=False)[..., 0]
+        bbox = bbox[valid_indices].float()
+        classes = classes[valid_indices][..., -1].long()
+
         # regression targets for true box size
         x1, y1 = bbox[..., 0], bbox[..., 1]
         x2, y2 = bbox[..., 2], bbox[..., 3]
@@ -123,8 +125,6 @@ class AnchorsToPoints:
         center_y = (y2 + y1).div_(2)
 
         # all other steps are performed in the downsampled space p/R
-        # for t in (x1, y1, x2, y2):
-        # t.floor_divide_(self.downsample)
         x1 = x1.floor_divide(self.downsample)
         y1 = y1.floor_divide(self.downsample)
         x2 = x2.floor_divide(self.downsample)
@@ -139,14 +139,13 @@ class AnchorsToPoints:
         center_x = center_x.floor_divide(self.downsample)
         center_y = center_y.floor_divide(self.downsample)
 
-        # assign to reg targets tensor
-        reg_targets = torch.empty(4, out_height, out_width).type_as(bbox).fill_(-1).float()
+        # assign to reg targets tensor for every example in a single indexing op
+        reg_targets = bbox.new_full((batch_size, 4, out_height, out_width), -1)
         y_ind = center_y.long()
         x_ind = center_x.long()
-        reg_targets[0, y_ind, x_ind] = offset_target_x
-        reg_targets[1, y_ind, x_ind] = offset_target_y
-        reg_targets[2, y_ind, x_ind] = size_target_x
-        reg_targets[3, y_ind, x_ind] = size_target_y
+        reg_targets[batch_idx, :, y_ind, x_ind] = torch.stack(
+            [offset_target_x, offset_target_y, size_target_x, size_target_y], dim=-1
+        )
 
         # the next step is to splat downsampled true centers onto a heatmap using a gaussian dist.
         # the gaussian sigma is determined as follows:
@@ -168,21 +167,31 @@ class AnchorsToPoints:
         sigma = (
             (x2 - x1).mul_(self.iou_threshold).add_(x1).sub_(x2).div_(self.radius_div).abs_().clamp_min_(self.min_sigma)
         )
-        heatmap = self._gaussian_splat(num_rois, center_x, center_y, sigma, out_height, out_width)
 
-        # combine heatmaps of same classes within a batch using element-wise maximum
-        # TODO this isn't clean, can it be done without looping?
-        cls_targets = torch.zeros(self.num_classes, out_height, out_width).type_as(bbox).float()
-        for i in range(self.num_classes):
-            if (classes == i).any():
-                class_heatmap = heatmap[classes.view(num_rois) == i, ...].view(-1, out_height, out_width)
-                cls_targets[i, ...] = class_heatmap.max(dim=0).values
+        # classes outside of [0, num_classes) contribute regression targets but no heatmap
+        keep = classes < self.num_classes
+        center_x, center_y, sigma = center_x[keep], center_y[keep], sigma[keep]
+        target_rows = batch_idx[keep] * self.num_classes + classes[keep]
+
+        # combine heatmaps of same classes within each example using element-wise maximum
+        cls_targets = bbox.new_zeros(batch_size * self.num_classes, out_height * out_width)
+        if self.truncate is None:
+            num_rois = target_rows.numel()
+            heatmap = self._gaussian_splat(num_rois, center_x, center_y, sigma, out_height, out_width)
+            _scatter_max_(cls_targets, target_rows, heatmap.view(num_rois, -1))
+        else:
+            self._truncated_gaussian_splat(cls_targets, target_rows, center_x, center_y, sigma, out_height, out_width)
+        cls_targets = cls_targets.view(batch_size, self.num_classes, out_height, out_width)
 
-        output = torch.cat([cls_targets, reg_targets], 0)
+        output = torch.cat([cls_targets, reg_targets], 1)
+        if not is_batched:
+            output = output.squeeze(0)
         return output
 
     def _gaussian_splat(self, num_rois, center_x, center_y, sigma, out_height, out_width) -> Tensor:
-        mesh_y, mesh_x = torch.meshgrid(torch.arange(out_height), torch.arange(out_width))
+        mesh_y, mesh_x = torch.meshgrid(
+            torch.arange(out_height, device=center_x.device), torch.arange(out_width, device=center_x.device)
+        )
         mesh_x = mesh_x.expand(num_rois, -1, -1).type_as(center_x)
         mesh_y = mesh_y.expand(num_rois, -1, -1).type_as(center_y)
 
@@ -196,12 +205,131 @@ class AnchorsToPoints:
         maps = (square_diff_x + square_diff_y).div_(divisor).neg_().exp()
         return maps
 
+    def _truncated_gaussian_splat(
+        self, out: Tensor, rows: Tensor, center_x: Tensor, center_y: Tensor, sigma: Tensor, out_height, out_width
+    ) -> Tensor:
+        num_rois = rows.numel()
+        if not num_rois:
+            return out
+
+        # gaussians are bucketed by radius rounded up to a power of two, and each bucket is evaluated on a
+        # window sized for that bucket. a single large box then does not widen the window for every small box.
+        radius = sigma.mul(self.truncate).ceil_().long()
+        bucket = radius.clamp_min(1).float().log2().ceil_().long()
+        for b in bucket.unique().tolist():
+            mask = bucket == b
+            window = 2 ** b
+            args = (rows[mask], center_x[mask], center_y[mask], sigma[mask], radius[mask], out_height, out_width)
+
+            # windows covering more than the heatmap are cheaper to evaluate densely
+            if (2 * window + 1) ** 2 >= out_height * out_width:
+                self._masked_gaussian_splat(out, *args)
+            else:
+                self._windowed_gaussian_splat(out, *args, window)
+        return out
+
+    def _windowed_gaussian_splat(
+        self,
+        out: Tensor,
+        rows: Tensor,
+        center_x: Tensor,
+        center_y: Tensor,
+        sigma: Tensor,
+        radius: Tensor,
+        out_height: int,
+        out_width: int,
+        window: int,
+    ) -> Tensor:
+        # every gaussian is evaluated on a square window of offsets about its center, then masked to its own radius
+        num_rois = rows.numel()
+        radius = radius.view(num_rois, 1)
+        offsets = torch.arange(-window, window + 1, device=out.device)
+        offset_y, offset_x = torch.meshgrid(offsets, offsets)
+        offset_x = offset_x.reshape(1, -1)
+        offset_y = offset_y.reshape(1, -1)
+
+        x = center_x.long().view(num_rois, 1) + offset_x
+        y = center_y.long().view(num_rois, 1) + offset_y
+        keep = (offset_x.abs() <= radius) & (offset_y.abs() <= radius)
+        keep = keep & (x >= 0) & (x < out_width) & (y >= 0) & (y < out_height)
+
+        # centers lie on the grid, so squared distances depend only on the offsets
+        # Y = exp(-[(y - y_cent)**2 + (x - x_cent)**2] / [2 sigma ** 2])
+        square_diff = (offset_x.pow(2) + offset_y.pow(2)).type_as(sigma)
+        divisor = sigma.pow(2).mul_(2).view(num_rois, 1)
+        values = square_diff.div(divisor).neg_().exp_()
+
+        # element-wise maximum into the flattened (B * C, H * W) heatmap
+        index = rows.view(num_rois, 1).mul(out_height * out_width).add_(y * out_width).add_(x)
+        _scatter_max_(out.view(-1), index[keep], values[keep])
+        return out
+
+    def _masked_gaussian_splat(
+        self,
+        out: Tensor,
+        rows: Tensor,
+        center_x: Tensor,
+        center_y: Tensor,
+        sigma: Tensor,
+        radius: Tensor,
+        out_height: int,
+        out_width: int,
+    ) -> Tensor:
+        # every gaussian is evaluated over the full heatmap, then masked to the same square window
+        num_rois = rows.numel()
+        maps = self._gaussian_splat(num_rois, center_x, center_y, sigma, out_height, out_width)
+        radius = radius.view(num_rois, 1)
+        dist_x = (torch.arange(out_width, device=out.device).view(1, -1) - center_x.long().view(num_rois, 1)).abs_()
+        dist_y = (torch.arange(out_height, device=out.device).view(1, -1) - center_y.long().view(num_rois, 1)).abs_()
+        keep = (dist_y <= radius).unsqueeze(-1) & (dist_x <= radius).unsqueeze(-2)
+        maps.masked_fill_(~keep, 0)
+        _scatter_max_(out, rows, maps.view(num_rois, -1))
+        return out
+
+
+def _scatter_max_(out: Tensor, index: Tensor, src: Tensor) -> Tensor:
+    r"""In-place row-wise maximum of ``src`` into ``out``, i.e. ``out[index[i]] = max(out[index[i]], src[i])``.
+
+    Elements are ordered by destination and then by value with a single sort over a combined integer key,
+    after which the last element for each destination is its maximum. The cost does not depend on the
+    number of rows sharing a destination. ``out`` must be contiguous.
+
+    Shape:
+        - ``out``: :math:`(M, *)`
+        - ``index``: :math:`(N)`
+        - ``src``: :math:`(N, *)`
+    """
+    if not index.numel():
+        return out
+
+    # destination of each element in the flattened output
+    row_size = out[0].numel()
+    positions = torch.arange(row_size, device=index.device)
+    dest = index.view(-1, 1).mul(row_size).add(positions).view(-1)
+    values = src.reshape(-1)
+
+    # sort by destination, breaking ties by the rank of each value
+    num_elements = values.numel()
+    value_rank = torch.empty_like(dest)
+    value_rank[values.argsort()] = torch.arange(num_elements, device=dest.device)
+    order = dest.mul(num_elements).add_(value_rank).argsort()
+    dest, values = dest[order], values[order]
+
+    # the last element for each destination holds the maximum
+    is_last = torch.ones_like(dest, dtype=torch.bool)
+    is_last[:-1] = dest[1:] != dest[:-1]
+    dest, values = dest[is_last], values[is_last]
+
+    flat_out = out.view(-1)
+    flat_out[dest] = torch.max(flat_out[dest], values)
+    return out
+
 
 class PointsToAnchors:
     r"""Transform that converts CenterNet style labels to anchor boxes and class labels
     (i.e. reverses the transform performed by `AnchorsToPoints`) as described in the
     paper `Objects as Points`_. Anchor boxes are identified in the input as points
-    that are greater than their 8 neighbors. The maximum number of boxes returned is
+    that are the maximum of their 3x3 neighborhood. The maximum number of boxes returned is
     parameterized, and selection is performed based on classification score. A threshold
     is can also be set such that scores below this threshold will not contribute to the
     output.
@@ -227,7 +355,10 @@ class PointsToAnchors:
         - Output: :math:`(*, N, 6)` where :math:`*` means an optional batch dimension
           and :math:`N` is the number of output anchor boxes. Indices `0-3` of the output give
           the box coordinates :math:`(x1, y1, x2, y2)`, index `4` gives classification score,
-          and index `5` gives the class label.
+          and index `5` gives the class label. Batched outputs are padded with ``-1``.
+        - Indices: :math:`(*, N, 3)` giving the class, y and x index of each point that was mapped to a box, or
+          :math:`(B, N, 4)` for batched inputs where index `0` gives the batch index. Rows are ordered by position
+          in the heatmap.
 
     .. _Objects as Points:
         https://arxiv.org/abs/1904.07850
@@ -252,102 +383,85 @@ class PointsToAnchors:
         return s
 
     def __call__(self, points: Tensor, return_indices=False) -> Union[Tensor, Tuple[Tensor, Tensor]]:
-        # batched recursion
         if points.shape[-3] <= 4:
             raise ValueError(f"Expected points.shape[-3] > 4, found shape {points.shape}")
-        if points.ndim == 4:
-            return self._batched_recurse(points, return_indices)
-        elif points.ndim > 4:
+        if points.ndim > 4:
             raise ValueError(f"Expected points.ndim <=, found shape {points.ndim}")
 
-        classes, regressions = points[:-4, :, :], points[-4:, :, :]
-        height, width = classes.shape[-2:]
-        classes.shape[-3]
+        # unsqueeze a batch dim if not present
+        is_batched = points.ndim == 4
+        if not is_batched:
+            points = points.unsqueeze(0)
+
+        batch_size = points.shape[0]
+        classes, regressions = points[:, :-4, :, :], points[:, -4:, :, :]
+        num_classes, height, width = classes.shape[-3:]
 
-        # identify maxima as points greater than their 8 neighbors
-        classes = non_maxima_suppression2d(classes.unsqueeze(0), kernel_size=(3,) * 2).squeeze(0)
+        # identify maxima as points that are the maximum of their 3x3 neighborhood
+        pooled = F.max_pool2d(classes, kernel_size=3, stride=1, padding=1)
+        classes = classes.masked_fill(classes != pooled, 0)
 
         # extract class / center x / center y indices of top k scores over heatmap
+        classes = classes.reshape(batch_size, -1)
         if self.max_roi is not None:
-            topk = min(self.max_roi, classes.numel())
-            nms_scores, nms_idx = classes.view(-1).topk(topk, dim=-1)
+            topk = min(self.max_roi, classes.shape[-1])
+            nms_scores, nms_idx = classes.topk(topk, dim=-1)
         else:
-            nms_scores, nms_idx = classes.view(-1).sort(dim=-1, descending=True)
+            nms_scores, nms_idx = classes.sort(dim=-1, descending=True)
 
-        nms_idx = nms_idx[nms_scores > self.threshold]
-        nms_scores = nms_scores[nms_scores > self.threshold]
+        # scores are sorted, so points above threshold are a prefix of each row
+        # trim every row to the longest such prefix in the batch
+        keep = nms_scores > self.threshold
+        max_roi = int(keep.sum(dim=-1).max()) if batch_size else 0
+        nms_scores, nms_idx, keep = nms_scores[:, :max_roi], nms_idx[:, :max_roi], keep[:, :max_roi]
 
-        # build a mask of indices that were mapped to boxes
-        if return_indices:
-            final_indices = torch.zeros_like(classes.view(-1), dtype=torch.bool)
-            final_indices[nms_idx] = True
-            final_indices = final_indices.view_as(classes).nonzero(as_tuple=False)
-
-        # % / width
-        center_x = (nms_idx % (height * width) % width).unsqueeze(-1)
-        center_y = (nms_idx % (height * width) // width).unsqueeze(-1)
-        cls = (nms_idx // (height * width)).unsqueeze(-1)
+        # gather regression channels at each point
+        spatial_idx = nms_idx % (height * width)
+        regressions = regressions.reshape(batch_size, 4, -1).gather(-1, spatial_idx.unsqueeze(1).expand(-1, 4, -1))
+        offset_x, offset_y, size_x, size_y = regressions.unbind(dim=1)
 
-        offset_x = regressions[0, center_y, center_x]
-        offset_y = regressions[1, center_y, center_x]
-        size_x = regressions[2, center_y, center_x]
-        size_y = regressions[3, center_y, center_x]
+        center_x = spatial_idx % width
+        center_y = spatial_idx // width
+        cls = nms_idx // (height * width)
 
         # get upsampled centers by scaling up and applying offset
-        center_x = center_x.float().mul_(self.upsample).add_(offset_x)
-        center_y = center_y.float().mul_(self.upsample).add_(offset_y)
+        center_x = center_x.type_as(regressions).mul_(self.upsample).add_(offset_x)
+        center_y = center_y.type_as(regressions).mul_(self.upsample).add_(offset_y)
 
         # get box coordinates by applying height/width deltas about upsampled centers
         x1 = center_x - size_x.div(2)
         x2 = center_x + size_x.div(2)
         y1 = center_y - size_y.div(2)
         y2 = center_y + size_y.div(2)
-        assert (x1 <= x2).all()
-        assert (y1 <= y2).all()
-
-        output = torch.cat([x1, y1, x2, y2, nms_scores.unsqueeze(-1), cls.float()], dim=-1)
-        # output = output[nms_scores > self.threshold]
-        if return_indices:
-            return output, final_indices
-        else:
-            return output
-
-    def _batched_recurse(self, points: Tensor, return_indices: bool) -> Tensor:
-        assert points.ndim > 3
-        batch_size = points.shape[0]
+        assert (x1 <= x2)[keep].all()
+        assert (y1 <= y2)[keep].all()
 
-        # recurse on examples in batch
-        results = []
-        for elem in points:
-            results.append(self(elem, return_indices))
+        output = torch.stack([x1, y1, x2, y2, nms_scores.type_as(x1), cls.type_as(x1)], dim=-1)
+        output = output.masked_fill_(~keep.unsqueeze(-1), -1)
 
-        # split apart the result
         if return_indices:
-            boxes = [x[0] for x in results]
-            indices = [x[1] for x in results]
-        else:
-            boxes = results
-            indices = None
-
-        # determine maximum number of boxes in example for padding
-        max_roi = max([t.shape[0] for t in boxes])
-
-        # combine examples into output batch
-        output = torch.empty(batch_size, max_roi, 6).fill_(-1).type_as(points)
-        for i, result in enumerate(boxes):
-            num_roi = result.shape[-2]
-            output[i, :num_roi, :] = result
+            # indices are reported in (class, y, x) order rather than score order
+            numel = num_classes * height * width
+            sorted_idx = nms_idx.masked_fill(~keep, numel).sort(dim=-1).values
+            batch_idx = torch.arange(batch_size, device=points.device).view(-1, 1).expand_as(sorted_idx)
+            indices = torch.stack(
+                [
+                    batch_idx,
+                    sorted_idx // (height * width),
+                    sorted_idx % (height * width) // width,
+                    sorted_idx % width,
+                ],
+                dim=-1,
+            )
+            indices = indices.masked_fill_((sorted_idx == numel).unsqueeze(-1), -1)
+
+        if not is_batched:
+            output = output.squeeze(0)
+            if return_indices:
+                indices = indices[0, :, 1:]
 
         if return_indices:
-            output_indices = torch.empty(batch_size, max_roi, 4, device=output.device).fill_(-1).long()
-            for i, (src, dest) in enumerate(zip(indices, output_indices)):
-                # add batch index
-                batch_idx = torch.tensor([[i]]).type_as(src).expand(src.shape[-2], -1)
-                src = torch.cat([batch_idx, src], dim=-1)
-                dest[: src.shape[-2], :] = src.type_as(dest)
-
-        if return_indices:
-            return output, output_indices
+            return output, indices
         return output
 
 
@@ -601,6 +715,9 @@ class CenterNetMixin:
         per-class global heatmap maxima to binary labels indicating whether or not the class was
         present in the true label.
 
+        Batched inputs are processed in a single pass. Padded target boxes (where all values are
+        equal to ``pad_value``) and target classes outside of the heatmap are ignored.
+
         Args:
             pred (:class:`torch.Tensor`):
                 Predicted heatmap.
@@ -621,28 +738,23 @@ class CenterNetMixin:
         """
         check_is_tensor(pred, "pred")
         check_is_tensor(target, "target")
-        is_batch = pred.ndim > 3
         assert pred.shape[-3] > 4
-
-        if is_batch:
+        if pred.ndim > 3:
             assert target.ndim > 2, "pred batched but target not batched"
-            batch_result = []
-            for pred_i, target_i in zip(pred, target):
-                result = CenterNetMixin.get_global_pred_target_pairs(pred_i, target_i, pad_value)
-                batch_result.append(result)
-            return torch.stack(batch_result, dim=0)
-
-        # we might be operating on a batched example that was padded, so remove these padded locations
-        pad_locations = (target == -1).all(dim=-1)
-        target = target[~pad_locations, :]
 
         # get the global max probability for each class in the heatmap
         num_classes = pred.shape[-3] - 4
         max_pred_scores = CenterNetMixin.heatmap_max_score(pred)
 
+        # padded target boxes and classes outside the heatmap are redirected to an extra class that is dropped
+        target_class = target[..., -1]
+        valid = (target != pad_value).any(dim=-1) & (target_class >= 0) & (target_class < num_classes)
+        target_class = target_class.long().masked_fill(~valid, num_classes)
+
         # get boolean mask of which classes were present in the target
-        target_class_present = torch.zeros(num_classes, device=target.device).bool()
-        target_class_present[target[..., -1].unique().long()] = True
+        target_class_present = target_class.new_zeros(*target_class.shape[:-1], num_classes + 1)
+        target_class_present.scatter_(-1, target_class, 1)
+        target_class_present = target_class_present[..., :-1]
 
         assert max_pred_scores.shape == target_class_present.shape
         return torch.stack([max_pred_scores, target_class_present.type_as(max_pred_scores)], dim=-1)
@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 import torch
 from torch import Tensor
-from torchvision.ops import box_iou
+
+from .bbox import PAD_VALUE
+from .nms import box_iou
+from .ragged import RaggedBoxTarget
+
+
+BoxInput = Union[Tensor, RaggedBoxTarget]
 
 
 class ConfusionMatrixIoU:
     r"""Creates two boolean masks, one for true positivity of predicted boxes, and another for
-    false negativity of target boxes. In the case of multiple predicted boxes correctly overlapping
-    a target box, only the highest IoU box will be considered a true positive
+    false negativity of target boxes. Predicted boxes are assigned to correctly overlapping target boxes
+    one-to-one, greedily in order of decreasing IoU. Each predicted box and each target box is assigned at
+    most once, and target boxes left unassigned are false negatives.
 
     .. warning::
         This method is experimental
@@ -23,20 +30,27 @@ class ConfusionMatrixIoU:
         true_positive_limit (bool):
             By default, if multiple predicted boxes correctly overlap a target box only one predicted box will be
             considered a true positive. If ``true_positive_limit=False``, consider all correctly overlapping boxes
-            as true positives
+            as true positives, and only target boxes without any correctly overlapping box as false negatives
 
     Returns:
         Tuple of ``(true_positive_mask, false_negative_mask)``
 
     Input Shape
-        * ``pred_boxes`` - :math:`(N_p, 4)`
-        * ``pred_classes`` - :math:`(N_p, 1)`
-        * ``true_boxes`` - :math:`(N_t, 4)`
-        * ``true_classes`` - :math:`(N_t, 1)`
+        * ``pred_boxes`` - :math:`(*, N_p, 4)`
+        * ``pred_classes`` - :math:`(*, N_p, 1)`
+        * ``true_boxes`` - :math:`(*, N_t, 4)`
+        * ``true_classes`` - :math:`(*, N_t, 1)`
 
     Output Shape
-        * ``true_positive_mask`` - :math:`(N_p)`
-        * ``false_negative_mask`` - :math:`(N_t)`
+        * ``true_positive_mask`` - :math:`(*, N_p)`
+        * ``false_negative_mask`` - :math:`(*, N_t)`
+
+    Batched inputs are matched in a single pass, with boxes only matched to boxes from the same example.
+    Padded boxes (with coordinates equal to ``-1``) are never matched, and are ``False`` in both output masks.
+
+    Inputs may also be given as :class:`combustion.vision.RaggedBoxTarget` instances holding a batch of examples,
+    in which case the output masks are ragged targets with the same example boundaries as ``pred_boxes`` and
+    ``true_boxes`` respectively.
     """
 
     def __init__(self, iou_threshold: float = 0.5, true_positive_limit: bool = True):
@@ -46,47 +60,57 @@ class ConfusionMatrixIoU:
         self.true_positive_limit = bool(true_positive_limit)
 
     def __call__(
+        self,
+        pred_boxes: BoxInput,
+        pred_classes: BoxInput,
+        true_boxes: BoxInput,
+        true_classes: BoxInput,
+    ) -> Union[Tuple[Tensor, Tensor], Tuple[RaggedBoxTarget, RaggedBoxTarget]]:
+        self._validate_inputs(pred_boxes, pred_classes, true_boxes, true_classes)
+        fmt = _input_format(pred_boxes)
+        (pred_boxes, pred_classes), pred_valid = _as_batch(pred_boxes, pred_classes)
+        (true_boxes, true_classes), true_valid = _as_batch(true_boxes, true_classes)
+        tp, fn = self._match(pred_boxes, pred_classes, true_boxes, true_classes, pred_valid, true_valid)
+        return _restore_format(tp, pred_valid, fmt), _restore_format(fn, true_valid, fmt)
+
+    def _match(
         self,
         pred_boxes: Tensor,
         pred_classes: Tensor,
         true_boxes: Tensor,
         true_classes: Tensor,
+        pred_valid: Tensor,
+        true_valid: Tensor,
     ) -> Tuple[Tensor, Tensor]:
-        self._validate_inputs(pred_boxes, pred_classes, true_boxes, true_classes)
-
-        # init output buffers
-        box_dim = -2
-        pred_boxes.shape[box_dim]
-        true_boxes.shape[box_dim]
-        tp = torch.empty(pred_boxes.shape[-2], device=pred_boxes.device, dtype=torch.bool).fill_(False)
-        fn = torch.empty(true_boxes.shape[-2], device=true_boxes.device, dtype=torch.bool).fill_(True)
-
-        # get IoUs (IoU is set to 0 when below threshold or class mismatch)
+        # get IoUs (IoU is set to 0 when below threshold, class mismatch, or padding)
         ious = self._get_ious(pred_boxes, pred_classes, true_boxes, true_classes)
-
-        # get pred box index -> target box index mapping
-        pred_box_index, target_box_index = ious.nonzero(as_tuple=True)
-        pred_box_index.unsqueeze_(-1)
-        target_box_index.unsqueeze_(-1)
-
-        # create list of (pred_box_index, target_box_index, iou) sorted by descending IoU
-        ious = ious[pred_box_index, target_box_index]
-        iou_argsort_indices = ious.argsort(dim=0, descending=True).view(-1)
-        pred_box_index = pred_box_index[iou_argsort_indices]
-        target_box_index = target_box_index[iou_argsort_indices]
-
-        # for multiple pred boxes -> 1 target box, keep only the highest IoU match
-        if self.true_positive_limit:
-            unique_target_boxes, unique_indices = target_box_index.unique(return_inverse=True)
-            num_unique_target_boxes = unique_target_boxes.shape[0]
-            final_mapping = torch.empty(num_unique_target_boxes, 2, device=unique_indices.device, dtype=torch.long)
-            final_mapping[unique_indices, 0] = pred_box_index
-            final_mapping[unique_indices, 1] = target_box_index
-        else:
-            final_mapping = torch.cat([pred_box_index, target_box_index], dim=-1)
-
-        tp[final_mapping[..., 0]] = True
-        fn[final_mapping[..., 1]] = False
+        ious.masked_fill_(~(pred_valid.unsqueeze(-1) & true_valid.unsqueeze(-2)), 0)
+        matched = ious > 0
+
+        if not self.true_positive_limit:
+            # target boxes without any correctly overlapping predicted box are false negatives
+            tp = matched.any(dim=-1)
+            fn = true_valid & ~matched.any(dim=-2)
+            return tp, fn
+
+        # one-to-one assignment, taking the highest remaining IoU pair of each example in every step
+        batch_size, num_pred, num_true = ious.shape
+        tp = torch.zeros_like(pred_valid)
+        true_matched = torch.zeros_like(true_valid)
+        batch_idx = torch.arange(batch_size, device=ious.device)
+        for _ in range(min(num_pred, num_true)):
+            best_iou, best_idx = ious.reshape(batch_size, -1).max(dim=-1)
+            is_match = best_iou > 0
+            if not is_match.any():
+                break
+            example, best_idx = batch_idx[is_match], best_idx[is_match]
+            pred_idx, true_idx = best_idx // num_true, best_idx % num_true
+            tp[example, pred_idx] = True
+            true_matched[example, true_idx] = True
+            ious[example, pred_idx, :] = 0
+            ious[example, :, true_idx] = 0
+
+        fn = true_valid & ~true_matched
         return tp, fn
 
     def _get_ious(
@@ -96,47 +120,52 @@ class ConfusionMatrixIoU:
         true_boxes: Tensor,
         true_classes: Tensor,
     ) -> Tensor:
-        box_dim = -2
-        num_pred_boxes = pred_boxes.shape[box_dim]
-        num_true_boxes = true_boxes.shape[box_dim]
-
-        # get IoU for each pred box w.r.t. true box
+        # get IoU for each pred box w.r.t. true box within each example
         iou = box_iou(pred_boxes, true_boxes)
-        assert iou.shape[0] == pred_boxes.shape[box_dim]
-        assert iou.shape[1] == true_boxes.shape[box_dim]
 
-        # mask where where iou exceeds threshold
+        # mask where where iou exceeds threshold and pred class matches true class
         iou_mask = iou >= self.iou_threshold
-
-        # mask where pred class matches true class
-        pred_class_mask = pred_classes.expand(-1, num_true_boxes)
-        true_class_mask = true_classes.T.expand(num_pred_boxes, -1)
-        class_mask = pred_class_mask == true_class_mask
-
-        # logical and of IoU > threshold & pred_class = true_class
-        iou_mask.logical_and_(class_mask)
+        iou_mask.logical_and_(pred_classes == true_classes.transpose(-1, -2))
 
         # set IoU for bad classes and IoU < threshold to zero
-        iou[~iou_mask] = 0
-        return iou
+        return iou.masked_fill_(~iou_mask, 0)
 
     def _validate_inputs(
         self,
-        pred_boxes: Tensor,
-        pred_classes: Tensor,
-        true_boxes: Tensor,
-        true_classes: Tensor,
-        pred_scores: Optional[Tensor] = None,
+        pred_boxes: BoxInput,
+        pred_classes: BoxInput,
+        true_boxes: BoxInput,
+        true_classes: BoxInput,
+        pred_scores: Optional[BoxInput] = None,
     ) -> None:
         names = ["pred_boxes", "pred_classes", "true_boxes", "true_classes"]
-        tensors = [pred_boxes, pred_classes, true_boxes, true_classes]
-        for name, tensor in zip(names, tensors):
-            if tensor.ndim != 2:
-                raise RuntimeError(f"expected {name}.ndim == 2 but found {tensor.ndim}")
+        inputs = [pred_boxes, pred_classes, true_boxes, true_classes]
+        if pred_scores is not None:
+            names.append("pred_scores")
+            inputs.append(pred_scores)
+
+        is_ragged = isinstance(pred_boxes, RaggedBoxTarget)
+        for name, x in zip(names, inputs):
+            if isinstance(x, RaggedBoxTarget) != is_ragged:
+                raise TypeError(f"expected inputs to all be RaggedBoxTarget or all be Tensor, found {name}={type(x)}")
+
+        if is_ragged:
+            for name, x in zip(names, inputs):
+                if len(x) != len(pred_boxes):
+                    raise RuntimeError(f"bad batch size in {name} -> expected {len(pred_boxes)}, found {len(x)}")
+            tensors = [x.values for x in inputs]
+        else:
+            ndim = pred_boxes.ndim
+            for name, x in zip(names, inputs):
+                if x.ndim not in (2, 3) or x.ndim != ndim:
+                    raise RuntimeError(f"expected {name}.ndim == {ndim} and ndim in (2, 3), but found {x.ndim}")
+                if ndim == 3 and x.shape[0] != pred_boxes.shape[0]:
+                    raise RuntimeError(f"bad batch size in {name} -> expected {pred_boxes.shape[0]}, found {x.shape}")
+            tensors = inputs
 
         box_dim = -2
-        pred_num_boxes = pred_boxes.shape[box_dim]
-        true_num_boxes = true_boxes.shape[box_dim]
+        pred_num_boxes = tensors[0].shape[box_dim]
+        true_num_boxes = tensors[2].shape[box_dim]
 
         last_dims = [4, 1, 4, 1]
         num_boxes = [pred_num_boxes,] * 2 + [
@@ -150,12 +179,42 @@ class ConfusionMatrixIoU:
                 raise RuntimeError(f"bad last dimension in {name} -> expected {last_dim}, found shape {tensor.shape}")
 
         if pred_scores is not None:
-            if not pred_scores.shape[box_dim] == pred_num_boxes:
+            if not tensors[-1].shape[box_dim] == pred_num_boxes:
                 raise RuntimeError(
-                    f"bad num boxes in pred_scores -> expected {num_box}, found shape {pred_scores.shape}"
+                    f"bad num boxes in pred_scores -> expected {pred_num_boxes}, found shape {tensors[-1].shape}"
                 )
 
 
+def _as_batch(*inputs: BoxInput) -> Tuple[List[Tensor], Tensor]:
+    # converts a group of inputs with matching boxes to padded batches, along with a mask of non-padded boxes
+    first = inputs[0]
+    if isinstance(first, RaggedBoxTarget):
+        max_boxes = int(first.lengths.max()) if len(first) else 0
+        valid = torch.arange(max_boxes, device=first.device) < first.lengths.unsqueeze(-1)
+        return [x.to_padded(PAD_VALUE) for x in inputs], valid
+    elif first.ndim == 2:
+        valid = torch.ones(1, first.shape[-2], device=first.device, dtype=torch.bool)
+        return [x.unsqueeze(0) for x in inputs], valid
+    else:
+        valid = (first != PAD_VALUE).any(dim=-1)
+        return list(inputs), valid
+
+
+def _input_format(x: BoxInput) -> str:
+    if isinstance(x, RaggedBoxTarget):
+        return "ragged"
+    return "batched" if x.ndim == 3 else "unbatched"
+
+
+def _restore_format(x: Tensor, valid: Tensor, fmt: str) -> BoxInput:
+    # converts a padded batch result back into the format of the original input
+    if fmt == "ragged":
+        return RaggedBoxTarget.from_lengths(x[valid], valid.sum(dim=-1))
+    elif fmt == "unbatched":
+        return x.squeeze(0)
+    return x
+
+
 class BinaryLabelIoU(ConfusionMatrixIoU):
     r"""Given a set of predicted boxes (with scores and class labels) and a set of target boxes (with class labels),
     creates a mapping of predicted probabilities to target probabilities. This method is intented to take anchor box
@@ -183,6 +242,10 @@ class BinaryLabelIoU(ConfusionMatrixIoU):
         * ``pred_classes`` - :math:`(N_p, 1)`
         * ``true_boxes`` - :math:`(N_t, 4)`
         * ``true_classes`` - :math:`(N_t, 1)`
+
+    Inputs may be batched, either as padded tensors of shape :math:`(B, N, *)` or as
+    :class:`combustion.vision.RaggedBoxTarget` instances, in which case boxes are only matched to boxes from the
+    same example. Outputs are flattened over the batch, with all predicted boxes followed by all false negatives.
     """
 
     def __init__(self, iou_threshold: float = 0.5, true_positive_limit: bool = True):
@@ -190,13 +253,20 @@ class BinaryLabelIoU(ConfusionMatrixIoU):
 
     def __call__(
         self,
-        pred_boxes: Tensor,
-        pred_scores: Tensor,
-        pred_classes: Tensor,
-        true_boxes: Tensor,
-        true_classes: Tensor,
+        pred_boxes: BoxInput,
+        pred_scores: BoxInput,
+        pred_classes: BoxInput,
+        true_boxes: BoxInput,
+        true_classes: BoxInput,
     ) -> Tuple[Tensor, Tensor]:
-        tp, fn = super().__call__(pred_boxes, pred_classes, true_boxes, true_classes)
+        self._validate_inputs(pred_boxes, pred_classes, true_boxes, true_classes, pred_scores)
+        (pred_boxes, pred_scores, pred_classes), pred_valid = _as_batch(pred_boxes, pred_scores, pred_classes)
+        (true_boxes, true_classes), true_valid = _as_batch(true_boxes, true_classes)
+        tp, fn = self._match(pred_boxes, pred_classes, true_boxes, true_classes, pred_valid, true_valid)
+
+        # flatten over the batch
+        tp, pred_scores, pred_classes = tp[pred_valid], pred_scores[pred_valid], pred_classes[pred_valid]
+        fn, true_classes = fn[true_valid], true_classes[true_valid]
 
         num_pred_boxes = tp.numel()
         num_fn = fn.sum()
@@ -238,6 +308,10 @@ class CategoricalLabelIoU(ConfusionMatrixIoU):
         * ``pred_classes`` - :math:`(N_p, 1)`
         * ``true_boxes`` - :math:`(N_t, 4)`
         * ``true_classes`` - :math:`(N_t, 1)`
+
+    Inputs may be batched, either as padded tensors of shape :math:`(B, N, *)` or as
+    :class:`combustion.vision.RaggedBoxTarget` instances, in which case boxes are only matched to boxes from the
+    same example. Outputs are flattened over the batch, with all predicted boxes followed by all false negatives.
     """
 
     def __init__(self, iou_threshold: float = 0.5, true_positive_limit: bool = True):
@@ -245,13 +319,20 @@ class CategoricalLabelIoU(ConfusionMatrixIoU):
 
     def __call__(
         self,
-        pred_boxes: Tensor,
-        pred_scores: Tensor,
-        pred_classes: Tensor,
-        true_boxes: Tensor,
-        true_classes: Tensor,
+        pred_boxes: BoxInput,
+        pred_scores: BoxInput,
+        pred_classes: BoxInput,
+        true_boxes: BoxInput,
+        true_classes: BoxInput,
     ) -> Tuple[Tensor, Tensor, Tensor]:
-        tp, fn = super().__call__(pred_boxes, pred_classes, true_boxes, true_classes)
+        self._validate_inputs(pred_boxes, pred_classes, true_boxes, true_classes, pred_scores)
+        (pred_boxes, pred_scores, pred_classes), pred_valid = _as_batch(pred_boxes, pred_scores, pred_classes)
+        (true_boxes, true_classes), true_valid = _as_batch(true_boxes, true_classes)
+        tp, fn = self._match(pred_boxes, pred_classes, true_boxes, true_classes, pred_valid, true_valid)
+
+        # flatten over the batch
+        tp, pred_scores, pred_classes = tp[pred_valid], pred_scores[pred_valid], pred_classes[pred_valid]
+        fn, true_classes = fn[true_valid], true_classes[true_valid]
 
         num_pred_boxes = tp.numel()
         num_fn = fn.sum()
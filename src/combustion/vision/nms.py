@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from typing import Tuple
+from typing import Optional, Tuple, Union
 
 import torch
 from torch import Tensor
@@ -10,20 +10,25 @@ from torch import Tensor
 try:
     from torchvision.ops import nms as nms_torch
 except ImportError:
+    nms_torch = None
 
-    def nms_torch(*args, **kwargs):
-        raise ImportError(
-            "nms requires kornia. "
-            "Please install combustion with 'vision' extras using "
-            "pip install combustion [vision]"
-        )
 
-
-def nms(boxes: Tensor, scores: Tensor, iou_threshold: float) -> Tuple[Tensor, Tuple]:
+def nms(
+    boxes: Tensor,
+    scores: Tensor,
+    iou_threshold: float,
+    classes: Optional[Tensor] = None,
+    pre_nms_top_k: Optional[int] = None,
+    max_detections: Optional[int] = None,
+) -> Union[Tensor, Tuple[Tensor, Tensor]]:
     r"""Performs non-maximal suppression on anchor boxes as per `torchvision.ops.nms`.
     Supports batched or non-batched inputs, and returns a tuple of index tensors that
     can be used to index the input boxes / scores tensors.
 
+    Batched inputs are suppressed in a single call by offsetting the coordinates of each
+    example (and each class if ``classes`` is given) such that boxes from different groups
+    never overlap. If torchvision is not installed, a pure PyTorch implementation is used.
+
     Args:
         boxes (tensor):
             The anchor boxes to perform non-maximal suppression on.
@@ -35,12 +40,24 @@ def nms(boxes: Tensor, scores: Tensor, iou_threshold: float) -> Tuple[Tensor, Tu
             Value on the interval :math:`[0, 1]` giving the intersection over union
             threshold over which non-maximal boxes will be suppressed.
 
+        classes (tensor, optional):
+            If given, boxes will only suppress other boxes of the same class.
+
+        pre_nms_top_k (int, optional):
+            If given, only the ``pre_nms_top_k`` highest scoring boxes of each example
+            are considered for suppression. Remaining boxes are discarded.
+
+        max_detections (int, optional):
+            If given, at most ``max_detections`` boxes are kept for each example.
+
     Shape:
         - Boxes: :math:`(N, 4)` or :math:`(B, N, 4)` where :math:`B` is an optional batch
           dimension and `N` is the number of anchor boxes.
         - Scores: :math:`(N)` or :math:`(B, N)` where :math:`B` is an optional batch
           dimension and `N` is the number of anchor boxes.
+        - Classes: :math:`(N)`, :math:`(N, 1)`, :math:`(B, N)`, or :math:`(B, N, 1)`.
         - Output: Tensor tuple giving the maximal indices, each of shape :math:`(K)`.
+          Indices are ordered by example, then by decreasing score.
 
     Example::
 
@@ -55,18 +72,293 @@ def nms(boxes: Tensor, scores: Tensor, iou_threshold: float) -> Tuple[Tensor, Tu
         >>> nms_indices = nms(boxes, scores, threshold=0.5)
         >>> nms_boxes, nms_scores = boxes[nms_indices], scores[nms_indices]
     """
-    # batched recursion
-    if boxes.ndim == 3:
-        batch_size, num_boxes = boxes.shape[0:2]
-        outputs = []
-        for i, example in enumerate(zip(boxes, scores)):
-            nms_indices = nms_torch(*example, iou_threshold)
-            batch_idx = torch.empty_like(nms_indices).fill_(i)
-            outputs.append((batch_idx, nms_indices))
-
-        batch_indices = torch.cat(list(zip(*outputs))[0], 0)
-        box_indices = torch.cat(list(zip(*outputs))[1], 0)
+    if boxes.ndim not in (2, 3):
+        raise ValueError(f"Expected boxes.ndim in (2, 3), found shape {boxes.shape}")
+    if boxes.shape[-1] != 4:
+        raise ValueError(f"Expected boxes.shape[-1] == 4, found shape {boxes.shape}")
+    if scores.shape != boxes.shape[:-1]:
+        raise ValueError(f"Expected scores.shape == {boxes.shape[:-1]}, found shape {scores.shape}")
+
+    is_batched = boxes.ndim == 3
+    if not is_batched:
+        boxes, scores = boxes.unsqueeze(0), scores.unsqueeze(0)
+        classes = classes.unsqueeze(0) if classes is not None else None
+    if classes is not None:
+        classes = classes.reshape(scores.shape).long()
+
+    batch_size, num_boxes = scores.shape
+    box_idx = torch.arange(num_boxes, device=boxes.device).expand(batch_size, -1)
+
+    # keep only the top k candidates from each example
+    if pre_nms_top_k is not None and pre_nms_top_k < num_boxes:
+        scores, box_idx = scores.topk(pre_nms_top_k, dim=-1)
+        boxes = boxes.gather(1, box_idx.unsqueeze(-1).expand(-1, -1, 4))
+        classes = classes.gather(1, box_idx) if classes is not None else None
+        num_boxes = pre_nms_top_k
+
+    # each example / class is a group, and boxes in a group are offset such that no two groups overlap
+    group = torch.arange(batch_size, device=boxes.device).view(-1, 1).expand(-1, num_boxes)
+    if classes is not None:
+        classes = classes - classes.min() if classes.numel() else classes
+        num_classes = int(classes.max()) + 1 if classes.numel() else 1
+        group = group * num_classes + classes
+
+    # candidates were already limited by pre_nms_top_k above, so only those boxes reach either implementation
+    boxes, scores, group = boxes.reshape(-1, 4), scores.reshape(-1), group.reshape(-1)
+    if nms_torch is not None:
+        # offsets grow with the number of groups, so offset boxes in float64 to preserve precision
+        boxes, scores = boxes.double(), scores.double()
+        if boxes.numel():
+            offsets = group.double().mul_(boxes.max() - boxes.min() + 1).unsqueeze(-1)
+            boxes = boxes + offsets
+        keep = nms_torch(boxes, scores, iou_threshold)
+    else:
+        keep = _nms_fallback(boxes, scores, iou_threshold, group)
+
+    # kept indices are in order of decreasing score, reorder by example while preserving score order
+    batch_indices = keep // num_boxes
+    rank = torch.arange(keep.numel(), device=keep.device)
+    order = (batch_indices * keep.numel() + rank).argsort()
+    keep, batch_indices = keep[order], batch_indices[order]
+
+    if max_detections is not None:
+        # rank of each box within its example
+        is_first = torch.ones_like(batch_indices, dtype=torch.bool)
+        is_first[1:] = batch_indices[1:] != batch_indices[:-1]
+        rank = rank - rank.masked_fill(~is_first, 0).cummax(dim=0).values if rank.numel() else rank
+        keep, batch_indices = keep[rank < max_detections], batch_indices[rank < max_detections]
+
+    box_indices = box_idx.reshape(-1)[keep]
+    if is_batched:
         return batch_indices, box_indices
+    return box_indices
+
+
+def soft_nms(
+    target: Tensor,
+    method: str = "linear",
+    sigma: float = 0.5,
+    score_threshold: float = 0.0,
+    class_aware: bool = True,
+    pad_value: float = -1,
+) -> Tensor:
+    r"""Performs Soft-NMS on a box / score / class target, as produced by :class:`combustion.vision.PointsToAnchors`
+    or :func:`combustion.vision.combine_bbox_scores_class`. Rather than discarding boxes that overlap a higher scoring
+    box, Soft-NMS decays their scores as a function of the overlap. See `Soft-NMS`_ for more details.
+
+    Decay is computed in parallel for all boxes using the matrix formulation described in `SOLOv2`_. The decay
+    applied to a box is the strongest decay induced by any higher scoring box, where the decay induced by each
+    higher scoring box is compensated by the extent to which that box was itself suppressed.
+
+    Args:
+        target (:class:`torch.Tensor`):
+            Boxes, scores and classes to process
 
+        method (str):
+            The decay function to apply. Should be one of ``"linear"`` or ``"gaussian"``.
+
+        sigma (float):
+            Bandwidth of the Gaussian decay function. Ignored if ``method="linear"``.
+
+        score_threshold (float):
+            Boxes with a decayed score less than or equal to ``score_threshold`` are discarded.
+
+        class_aware (bool):
+            If ``True``, boxes will only decay scores of other boxes of the same class.
+
+        pad_value (float):
+            Value used for padding a batched ``target`` input.
+
+    Shape:
+        - ``target`` - :math:`(*, N, 6)` where :math:`*` means an optional batch dimension. Indices `0-3` give
+          the box coordinates :math:`(x1, y1, x2, y2)`, index `4` gives score and index `5` gives class.
+        - Output - :math:`(*, N', 6)` where :math:`N' \leq N`. Boxes are ordered by decreasing score and
+          padded with ``pad_value``.
+
+    .. _Soft-NMS:
+        https://arxiv.org/abs/1704.04503
+
+    .. _SOLOv2:
+        https://arxiv.org/abs/2003.10152
+    """
+    if method not in ("linear", "gaussian"):
+        raise ValueError(f"Expected method to be one of 'linear', 'gaussian', found {method}")
+    if sigma <= 0:
+        raise ValueError(f"Expected sigma > 0, found {sigma}")
+
+    target, valid, is_batched = _prepare_target(target, pad_value)
+    boxes, scores, classes = target[..., :4], target[..., 4], target[..., 5]
+
+    # iou[b, i, j] gives the overlap of box i with a lower scoring box j
+    iou = box_iou(boxes, boxes).masked_fill_(~_pair_mask(valid, classes, class_aware), 0).triu_(diagonal=1)
+
+    # the largest overlap of each box with a higher scoring box, used to compensate the decay it induces
+    compensate = iou.max(dim=-2).values.unsqueeze(-1)
+
+    if method == "linear":
+        decay = (1 - iou).div_((1 - compensate).clamp_min_(torch.finfo(iou.dtype).eps))
     else:
-        return nms_torch(boxes, scores, iou_threshold)
+        decay = (iou.pow(2) - compensate.pow(2)).div_(-sigma).exp_()
+    decay = decay.min(dim=-2).values.clamp_max_(1)
+
+    scores = scores * decay
+    target = torch.cat([boxes, scores.unsqueeze(-1), classes.unsqueeze(-1)], dim=-1)
+    valid = valid & (scores > score_threshold)
+    return _sort_and_pad(target, valid, pad_value, is_batched)
+
+
+def weighted_box_fusion(
+    target: Tensor, iou_threshold: float = 0.55, class_aware: bool = True, pad_value: float = -1
+) -> Tensor:
+    r"""Performs weighted box fusion on a box / score / class target, as produced by
+    :class:`combustion.vision.PointsToAnchors` or :func:`combustion.vision.combine_bbox_scores_class`.
+    Boxes are clustered, and each cluster is replaced by a single box with coordinates given by the score
+    weighted average of the coordinates in the cluster. See `Weighted Boxes Fusion`_ for more details.
+
+    Clusters are formed in parallel by assigning each box to the highest scoring box that survives
+    non-maximal suppression and overlaps it with IoU greater than ``iou_threshold``. The score of a fused
+    box is the average score over its cluster.
+
+    Args:
+        target (:class:`torch.Tensor`):
+            Boxes, scores and classes to process
+
+        iou_threshold (float):
+            Value on the interval :math:`[0, 1]` giving the intersection over union
+            threshold over which boxes will be clustered.
+
+        class_aware (bool):
+            If ``True``, boxes will only be clustered with other boxes of the same class.
+
+        pad_value (float):
+            Value used for padding a batched ``target`` input.
+
+    Shape:
+        - ``target`` - :math:`(*, N, 6)` where :math:`*` means an optional batch dimension. Indices `0-3` give
+          the box coordinates :math:`(x1, y1, x2, y2)`, index `4` gives score and index `5` gives class.
+        - Output - :math:`(*, N', 6)` where :math:`N' \leq N`. Boxes are ordered by decreasing score and
+          padded with ``pad_value``.
+
+    .. _Weighted Boxes Fusion:
+        https://arxiv.org/abs/1910.13302
+    """
+    target, valid, is_batched = _prepare_target(target, pad_value)
+    boxes, scores, classes = target[..., :4], target[..., 4], target[..., 5]
+    batch_size, num_boxes = scores.shape
+
+    # cluster heads are the boxes that survive NMS
+    batch_idx, box_idx = nms(
+        boxes, scores.masked_fill(~valid, float("-inf")), iou_threshold, classes=classes if class_aware else None
+    )
+    is_head = torch.zeros_like(valid)
+    is_head[batch_idx, box_idx] = True
+    is_head &= valid
+
+    # candidate[b, i, j] is True if box j can join the cluster headed by box i
+    candidate = box_iou(boxes, boxes) > iou_threshold
+    candidate &= _pair_mask(valid, classes, class_aware) & is_head.unsqueeze(-1)
+
+    # assign each box to the highest scoring candidate head
+    head_scores = scores.unsqueeze(-1).expand(-1, -1, num_boxes).masked_fill(~candidate, float("-inf"))
+    head = head_scores.argmax(dim=-2, keepdim=True)
+    has_head = candidate.any(dim=-2, keepdim=True)
+    assignment = torch.zeros_like(candidate, dtype=boxes.dtype).scatter_(-2, head, has_head.type_as(boxes))
+
+    # score weighted average of coordinates / average of scores over each cluster
+    weights = scores.clamp_min(0).unsqueeze(-1) * has_head.view(batch_size, num_boxes, 1)
+    eps = torch.finfo(boxes.dtype).eps
+    fused_boxes = assignment.bmm(weights * boxes).div_(assignment.bmm(weights).clamp_min_(eps))
+    fused_scores = assignment.bmm(scores.unsqueeze(-1)).div_(assignment.sum(dim=-1, keepdim=True).clamp_min_(1))
+
+    target = torch.cat([fused_boxes, fused_scores, classes.unsqueeze(-1)], dim=-1)
+    return _sort_and_pad(target, is_head, pad_value, is_batched)
+
+
+def _prepare_target(target: Tensor, pad_value: float) -> Tuple[Tensor, Tensor, bool]:
+    if target.ndim not in (2, 3):
+        raise ValueError(f"Expected target.ndim in (2, 3), found shape {target.shape}")
+    if target.shape[-1] != 6:
+        raise ValueError(f"Expected target.shape[-1] == 6, found shape {target.shape}")
+
+    is_batched = target.ndim == 3
+    if not is_batched:
+        target = target.unsqueeze(0)
+    valid = (target != pad_value).any(dim=-1)
+
+    # sort by decreasing score with padding last
+    order = target[..., 4].masked_fill(~valid, float("-inf")).argsort(dim=-1, descending=True)
+    target = target.gather(1, order.unsqueeze(-1).expand_as(target))
+    valid = valid.gather(1, order)
+    return target, valid, is_batched
+
+
+def _pair_mask(valid: Tensor, classes: Tensor, class_aware: bool) -> Tensor:
+    # mask of box pairs that are allowed to interact
+    mask = valid.unsqueeze(-1) & valid.unsqueeze(-2)
+    if class_aware:
+        mask &= classes.unsqueeze(-1) == classes.unsqueeze(-2)
+    return mask
+
+
+def _sort_and_pad(target: Tensor, valid: Tensor, pad_value: float, is_batched: bool) -> Tensor:
+    # sort by decreasing score with invalid boxes last, then trim to the largest number of valid boxes
+    order = target[..., 4].masked_fill(~valid, float("-inf")).argsort(dim=-1, descending=True)
+    target = target.gather(1, order.unsqueeze(-1).expand_as(target))
+    valid = valid.gather(1, order)
+
+    max_boxes = int(valid.sum(dim=-1).max()) if valid.numel() else 0
+    target = target[:, :max_boxes].masked_fill(~valid[:, :max_boxes].unsqueeze(-1), pad_value)
+    return target if is_batched else target.squeeze(0)
+
+
+def box_iou(boxes1: Tensor, boxes2: Tensor) -> Tensor:
+    r"""Computes the pairwise intersection over union between two sets of boxes. Unlike
+    :func:`torchvision.ops.box_iou`, leading batch dimensions are supported, in which case
+    IoU is only computed between boxes of the same example.
+
+    Args:
+        boxes1 (:class:`torch.Tensor`):
+            First set of boxes in format :math:`x_1, y_1, x_2, y_2`
+
+        boxes2 (:class:`torch.Tensor`):
+            Second set of boxes in format :math:`x_1, y_1, x_2, y_2`
+
+    Shape:
+        * ``boxes1`` - :math:`(*, N, 4)`
+        * ``boxes2`` - :math:`(*, M, 4)`
+        * Output - :math:`(*, N, M)`
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+
+    top_left = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    bottom_right = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
+    wh = (bottom_right - top_left).clamp_min_(0)
+    inter = wh[..., 0] * wh[..., 1]
+
+    union = area1[..., :, None] + area2[..., None, :] - inter
+    return inter / union.clamp_min(torch.finfo(inter.dtype).eps)
+
+
+def _nms_fallback(boxes: Tensor, scores: Tensor, iou_threshold: float, group: Optional[Tensor] = None) -> Tensor:
+    # greedy NMS matching torchvision.ops.nms, used when torchvision is unavailable
+    # boxes in different groups never suppress each other, so suppression is only computed within each group
+    if group is None:
+        group = torch.zeros_like(scores, dtype=torch.long)
+    _, counts = group.sort()[0].unique_consecutive(return_counts=True)
+
+    keep = [scores.new_empty(0, dtype=torch.long)]
+    for idx in group.argsort().split(counts.tolist()):
+        idx = idx[scores[idx].argsort(descending=True)]
+
+        # suppressed[i, j] is True if box i suppresses box j, for j of lower score than i
+        suppressed = (box_iou(boxes[idx], boxes[idx]).triu_(diagonal=1) > iou_threshold).cpu()
+        group_keep = torch.ones(idx.numel(), dtype=torch.bool)
+        for i in range(idx.numel()):
+            if group_keep[i]:
+                group_keep &= ~suppressed[i]
+        keep.append(idx[group_keep.to(idx.device)])
+
+    # kept boxes are returned in order of decreasing score, as in torchvision
+    keep = torch.cat(keep)
+    return keep[scores[keep].argsort(descending=True)]
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Iterable, Iterator, Tuple
+
+import torch
+from torch import Tensor
+
+from combustion.util import check_is_tensor
+
+
+class RaggedBoxTarget:
+    r"""Container for a batch of bounding box targets where each example has a variable number of boxes.
+    Boxes from all examples are stored contiguously in a single flat tensor, and example boundaries are
+    given by an offsets tensor. This avoids the memory overhead of padding every example to the size of
+    the most crowded example, and the cost of recovering valid boxes from padded inputs.
+
+    Boxes for example ``i`` are given by ``values[offsets[i] : offsets[i + 1]]``.
+
+    Args:
+        values (:class:`torch.Tensor`):
+            Flat tensor of boxes / labels from all examples in the batch
+
+        offsets (:class:`torch.Tensor`):
+            Offset of the first box of each example in ``values``, followed by the total number of boxes
+
+    Shape:
+        * ``values`` - :math:`(N_{tot}, *)` where :math:`N_{tot}` is the total number of boxes in the batch.
+        * ``offsets`` - :math:`(B + 1)` where :math:`B` is the batch size.
+
+    Example::
+
+        >>> target = RaggedBoxTarget.from_padded(padded_target)
+        >>> bbox, cls = split_box_target(target)
+        >>> padded_bbox = bbox.to_padded()
+    """
+
+    def __init__(self, values: Tensor, offsets: Tensor):
+        check_is_tensor(values, "values")
+        check_is_tensor(offsets, "offsets")
+        if offsets.ndim != 1 or not offsets.numel():
+            raise ValueError(f"Expected offsets of shape (B + 1), found shape {offsets.shape}")
+        self.values = values
+        self.offsets = offsets.long().to(values.device)
+
+    def __repr__(self):
+        return f"RaggedBoxTarget(batch_size={len(self)}, values={tuple(self.values.shape)})"
+
+    def __len__(self) -> int:
+        return self.offsets.numel() - 1
+
+    def __getitem__(self, pos: int) -> Tensor:
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError(pos)
+        low, high = self.offsets[pos : pos + 2].tolist()
+        return self.values[low:high]
+
+    def __iter__(self) -> Iterator[Tensor]:
+        return iter(self.unbind())
+
+    @property
+    def batch_size(self) -> int:
+        return len(self)
+
+    @property
+    def device(self) -> torch.device:
+        return self.values.device
+
+    @property
+    def lengths(self) -> Tensor:
+        r"""The number of boxes in each example of the batch."""
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def batch_index(self) -> Tensor:
+        r"""The index of the example to which each box in :attr:`values` belongs."""
+        return torch.arange(len(self), device=self.device).repeat_interleave(self.lengths)
+
+    @classmethod
+    def from_lengths(cls, values: Tensor, lengths: Tensor) -> "RaggedBoxTarget":
+        r"""Creates a ragged target from a flat tensor of boxes and the number of boxes in each example.
+
+        Args:
+            values (:class:`torch.Tensor`):
+                Flat tensor of boxes / labels from all examples in the batch
+
+            lengths (:class:`torch.Tensor`):
+                Number of boxes in each example
+
+        Shape:
+            * ``values`` - :math:`(N_{tot}, *)`
+            * ``lengths`` - :math:`(B)`
+        """
+        lengths = torch.as_tensor(lengths, device=values.device).long()
+        offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(dim=0)])
+        return cls(values, offsets)
+
+    @classmethod
+    def from_list(cls, target: Iterable[Tensor]) -> "RaggedBoxTarget":
+        r"""Creates a ragged target from a list of unbatched targets.
+
+        Args:
+            target (iterable of :class:`torch.Tensor`):
+                Targets to combine
+
+        Shape:
+            * ``target`` - :math:`(N_i, *)`
+        """
+        target = list(target)
+        if not target:
+            raise ValueError("Expected non-empty target")
+        lengths = [t.shape[0] for t in target]
+        return cls.from_lengths(torch.cat(target, dim=0), torch.tensor(lengths))
+
+    @classmethod
+    def from_padded(cls, target: Tensor, pad_value: float = -1) -> "RaggedBoxTarget":
+        r"""Creates a ragged target from a padded batch, as produced by :func:`combustion.vision.batch_box_target`.
+
+        Args:
+            target (:class:`torch.Tensor`):
+                Padded batch of targets
+
+            pad_value (float):
+                Value used for padding when creating the batch
+
+        Shape:
+            * ``target`` - :math:`(B, N, C)`
+        """
+        check_is_tensor(target, "target")
+        if target.ndim != 3:
+            raise ValueError(f"Expected target.ndim == 3, found shape {target.shape}")
+        non_padded = (target != pad_value).any(dim=-1)
+        return cls.from_lengths(target[non_padded], non_padded.sum(dim=-1))
+
+    def to_padded(self, pad_value: float = -1) -> Tensor:
+        r"""Converts this ragged target to a padded batch, as produced by :func:`combustion.vision.batch_box_target`.
+
+        Args:
+            pad_value (float):
+                Padding value to use when creating the batch
+
+        Shape:
+            * Output - :math:`(B, N, *)` where :math:`N` is the largest number of boxes in any example
+        """
+        lengths = self.lengths
+        max_boxes = int(lengths.max()) if len(self) else 0
+        output = self.values.new_full((len(self), max_boxes, *self.values.shape[1:]), pad_value)
+
+        batch_index = self.batch_index
+        position = torch.arange(self.values.shape[0], device=self.device) - self.offsets[batch_index]
+        output[batch_index, position] = self.values
+        return output
+
+    def unbind(self) -> Tuple[Tensor, ...]:
+        r"""Splits this ragged target into a tuple of unbatched targets."""
+        return torch.split(self.values, self.lengths.tolist(), dim=0)
+
+    def with_values(self, values: Tensor) -> "RaggedBoxTarget":
+        r"""Creates a ragged target with new values and the same example boundaries as this target.
+
+        Args:
+            values (:class:`torch.Tensor`):
+                The new values
+
+        Shape:
+            * ``values`` - :math:`(N_{tot}, *)`
+        """
+        if values.shape[0] != self.values.shape[0]:
+            raise ValueError(f"Expected values.shape[0] == {self.values.shape[0]}, found shape {values.shape}")
+        return self.__class__(values, self.offsets)
+
+    def masked_select(self, mask: Tensor) -> "RaggedBoxTarget":
+        r"""Creates a ragged target containing only the boxes where ``mask`` is ``True``.
+
+        Args:
+            mask (:class:`torch.Tensor`):
+                Boolean mask of boxes to keep
+
+        Shape:
+            * ``mask`` - :math:`(N_{tot})`
+        """
+        mask = mask.view(-1).bool()
+        lengths = torch.zeros(len(self), device=self.device, dtype=torch.long)
+        lengths.index_add_(0, self.batch_index, mask.long())
+        return self.from_lengths(self.values[mask], lengths)
+
+    def to(self, *args, **kwargs) -> "RaggedBoxTarget":
+        r"""Calls :func:`torch.Tensor.to` on the underlying values."""
+        return self.with_values(self.values.to(*args, **kwargs))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from combustion.data import CachedDataset, PersistentCachedDataset, TransformableDataset, hash_config
+
+
+class CountingDataset(TransformableDataset):
+    def __init__(self, length, **kwargs):
+        super().__init__(**kwargs)
+        self.length = length
+        self.loads = 0
+
+    def load_example(self, pos):
+        if pos >= self.length:
+            raise IndexError(pos)
+        self.loads += 1
+        return [torch.full((4,), float(pos)), torch.tensor([pos])]
+
+    def __getitem__(self, pos):
+        return self.apply_transforms(self.load_example(pos))
+
+    def __len__(self):
+        return self.length
+
+
+# each example is 4 float32 + 1 int64 = 24 bytes
+EXAMPLE_BYTES = 24
+
+
+@pytest.fixture(params=[False, True], ids=["local", "shared"])
+def shared(request):
+    return request.param
+
+
+def test_matches_wrapped_dataset(shared):
+    ds = CountingDataset(10, transform=lambda x: x * 2)
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    assert len(cached) == len(ds)
+    for _ in range(2):
+        for i in range(len(ds)):
+            for t1, t2 in zip(ds[i], cached[i]):
+                assert torch.equal(t1, t2)
+
+
+def test_hits_and_misses(shared):
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    for _ in range(3):
+        for i in range(len(ds)):
+            cached[i]
+    assert ds.loads == 10
+    stats = cached.stats
+    assert stats["misses"] == 10
+    assert stats["hits"] == 20
+    assert stats["evictions"] == 0
+    assert stats["nbytes"] > 0
+
+
+def test_lru_eviction():
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=3 * EXAMPLE_BYTES)
+    cached[0]
+    cached[1]
+    cached[2]
+    cached[0]
+    cached[3]
+    assert cached.stats["evictions"] == 1
+    assert cached.stats["nbytes"] == 3 * EXAMPLE_BYTES
+
+    # 1 was least recently used and should have been evicted
+    loads = ds.loads
+    cached[0]
+    assert ds.loads == loads
+    cached[1]
+    assert ds.loads == loads + 1
+
+
+def test_shared_eviction_bounded():
+    ds = CountingDataset(100)
+    cached = CachedDataset(ds, max_bytes=20000, shared=True)
+    for i in range(len(ds)):
+        cached[i]
+        assert cached.stats["nbytes"] <= 20000
+    assert cached.stats["evictions"] > 0
+
+
+def test_example_larger_than_cache(shared):
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=1, shared=shared)
+    cached[0]
+    cached[0]
+    assert cached.stats["misses"] == 2
+    assert cached.stats["nbytes"] == 0
+
+
+def test_random_transform_runs_every_access(shared):
+    ds = CountingDataset(10, transform=lambda x: x + torch.rand_like(x))
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    assert not torch.equal(cached[0][0], cached[0][0])
+
+
+def test_clone():
+    def inplace(x):
+        return x.add_(1)
+
+    ds = CountingDataset(10, transform=inplace)
+    cached = CachedDataset(ds, max_bytes=1024, clone=True)
+    assert torch.equal(cached[0][0], cached[0][0])
+
+
+def test_clear(shared):
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    cached[0]
+    cached.clear()
+    assert cached.stats["nbytes"] == 0
+    cached[0]
+    assert ds.loads == 2
+
+
+@pytest.mark.parametrize("num_workers", [2])
+def test_dataloader_stats(shared, num_workers):
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    dl = DataLoader(cached, batch_size=1, num_workers=num_workers)
+    for _ in range(2):
+        for _ in dl:
+            pass
+    stats = cached.stats
+    assert stats["hits"] + stats["misses"] == 20
+    if shared:
+        assert stats["misses"] == 10
+
+
+def test_requires_transformable_dataset():
+    with pytest.raises(TypeError):
+        CachedDataset([1, 2, 3], max_bytes=1024)
+
+
+
+def test_requires_load_example():
+    class NoLoadExample(TransformableDataset):
+        def __getitem__(self, pos):
+            return torch.rand(4)
+
+        def __len__(self):
+            return 10
+
+    with pytest.raises(TypeError, match="load_example"):
+        CachedDataset(NoLoadExample(), max_bytes=1024)
+
+
+def test_pickle(shared):
+    ds = CountingDataset(10)
+    cached = CachedDataset(ds, max_bytes=1024, shared=shared)
+    cached[0]
+    copy = pickle.loads(pickle.dumps(cached))
+    assert copy.stats == cached.stats
+    copy[0]
+    copy[1]
+    assert copy.stats["hits"] + copy.stats["misses"] == 3
+    assert cached.stats["hits"] + cached.stats["misses"] == 1
+
+
+class TestPersistentCachedDataset:
+    @pytest.fixture
+    def path(self, tmp_path):
+        return str(tmp_path)
+
+    def test_matches_wrapped_dataset(self, path):
+        ds = CountingDataset(10, transform=lambda x: x * 2)
+        cached = PersistentCachedDataset(ds, path, "key")
+        assert len(cached) == len(ds)
+        for _ in range(2):
+            for i in range(len(ds)):
+                for t1, t2 in zip(ds[i], cached[i]):
+                    assert torch.equal(t1, t2)
+
+    def test_computed_once(self, path):
+        ds = CountingDataset(10)
+        cached = PersistentCachedDataset(ds, path, "key")
+        for _ in range(3):
+            for i in range(len(ds)):
+                cached[i]
+        assert ds.loads == 10
+
+    def test_persists_across_instances(self, path):
+        ds = CountingDataset(10)
+        cached = PersistentCachedDataset(ds, path, "key")
+        for i in range(len(ds)):
+            cached[i]
+        del cached
+
+        ds2 = CountingDataset(10)
+        cached2 = PersistentCachedDataset(ds2, path, "key")
+        for i in range(len(ds2)):
+            for t1, t2 in zip(ds[i], cached2[i]):
+                assert torch.equal(t1, t2)
+        assert ds2.loads == 0
+
+    def test_key_change_recomputes(self, path):
+        ds = CountingDataset(10)
+        cached = PersistentCachedDataset(ds, path, "key1")
+        cached[0]
+        cached = PersistentCachedDataset(ds, path, "key2")
+        cached[0]
+        assert ds.loads == 2
+
+    def test_random_transform_runs_every_access(self, path):
+        ds = CountingDataset(10)
+        cached = PersistentCachedDataset(ds, path, "key", transform=lambda x: x + torch.rand_like(x))
+        assert not torch.equal(cached[0][0], cached[0][0])
+        assert ds.loads == 1
+
+    def test_sees_examples_from_other_processes(self, path):
+        ds = CountingDataset(10)
+        writer = PersistentCachedDataset(ds, path, "key")
+        reader = PersistentCachedDataset(CountingDataset(10), path, "key", refresh_interval=0)
+        writer[3]
+        reader[3]
+        assert reader.dataset.loads == 0
+
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    def test_dataloader(self, path, num_workers):
+        ds = CountingDataset(10)
+        cached = PersistentCachedDataset(ds, path, "key")
+        dl = DataLoader(cached, batch_size=1, num_workers=num_workers)
+        for _ in range(2):
+            result = sorted(int(label.item()) for _, label in dl)
+            assert result == list(range(10))
+
+        # a fresh instance in this process sees examples written by the workers
+        ds2 = CountingDataset(10)
+        cached2 = PersistentCachedDataset(ds2, path, "key")
+        for i in range(len(ds2)):
+            cached2[i]
+        assert ds2.loads == 0
+
+
+@pytest.mark.parametrize(
+    "c1,c2,equal",
+    [
+        pytest.param({"a": 1, "b": 2}, {"b": 2, "a": 1}, True),
+        pytest.param({"a": 1, "b": 2}, {"a": 1, "b": 3}, False),
+        pytest.param("foo", "foo", True),
+    ],
+)
+def test_hash_config(c1, c2, equal):
+    assert (hash_config(c1) == hash_config(c2)) == equal
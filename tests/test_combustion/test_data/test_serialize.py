@@ -4,6 +4,7 @@
 import builtins
 import math
 import os
+import pickle
 from pathlib import Path
 from shutil import copyfile
 
@@ -12,7 +13,7 @@ import torch
 from torch.utils.data import DataLoader, Dataset, IterableDataset
 
 # from combustion.data import AbstractDataset
-from combustion.data import HDF5Dataset, SerializeMixin, TorchDataset
+from combustion.data import HDF5Dataset, MMapDataset, PackedDataset, SerializeMixin, TorchDataset, save_packed
 
 
 def check_file_exists(filepath):
@@ -23,6 +24,20 @@ def check_file_exists(filepath):
         pytest.fail(f"file {path.name} not found in {path.parent}, contents {contents}")
 
 
+class IndexDataset(Dataset, SerializeMixin):
+    # defined at module level so it can be pickled for parallel saving
+    def __init__(self, length):
+        self.length = length
+
+    def __getitem__(self, index):
+        if index >= self.length:
+            raise IndexError(index)
+        return torch.full((1, 10, 10), float(index)), torch.tensor([index])
+
+    def __len__(self):
+        return self.length
+
+
 @pytest.fixture
 def h5py():
     return pytest.importorskip("h5py", reason="test requires h5py")
@@ -197,23 +212,78 @@ class TestSerialize:
         assert len(ds) == 10
 
     @pytest.mark.ci_skip
-    @pytest.mark.parametrize(
-        "num_workers",
-        [
-            pytest.param(1),
-            pytest.param(4, marks=pytest.mark.xfail(reason="parallel hdf5")),
-        ],
-    )
+    @pytest.mark.parametrize("num_workers", [1, 4])
     def test_dataloader(self, h5py, torch, tmp_path, dataset, input_file, data, num_workers):
         path = input_file
         new_dataset = dataset.__class__.load(path)
-        dataloader = DataLoader(new_dataset, batch_size=1)
+        dataloader = DataLoader(new_dataset, num_workers=num_workers, batch_size=1)
 
         for i in range(100):
             for e1, e2 in zip(dataloader, new_dataset):
                 for t1, t2 in zip(e1, e2):
                     assert torch.allclose(t1, t2)
 
+    @pytest.mark.ci_skip
+    @pytest.mark.parametrize("num_workers", [2, 4])
+    def test_dataloader_stress(self, h5py, torch, tmp_path, num_workers):
+        # larger examples spread over many reads make interleaved access between workers likely
+        data = [(torch.rand(3, 32, 32), torch.tensor([i])) for i in range(64)]
+
+        class DatasetImpl(Dataset, SerializeMixin):
+            def __getitem__(self, index):
+                return data[index]
+
+            def __len__(self):
+                return len(data)
+
+        path = os.path.join(tmp_path, "stress.h5")
+        DatasetImpl().save(path, fmt="hdf5", verbose=False)
+        new_dataset = HDF5Dataset(path)
+
+        # read in the parent first so any handle would be inherited by forked workers
+        expected = [new_dataset[i] for i in range(len(new_dataset))]
+        dataloader = DataLoader(new_dataset, num_workers=num_workers, batch_size=3, shuffle=True)
+
+        for _ in range(5):
+            seen = set()
+            for frames, labels in dataloader:
+                for frame, label in zip(frames, labels):
+                    index = int(label.item())
+                    seen.add(index)
+                    assert torch.equal(frame, expected[index][0])
+            assert seen == set(range(len(data)))
+
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    def test_save_parallel(self, h5py, torch, tmp_path, save_path, num_workers):
+        dataset = IndexDataset(10)
+        kwargs = {"num_shards": 3} if self.fmt in ("hdf5", "packed") else {}
+        dataset.save(save_path, fmt=self.fmt, verbose=False, num_workers=num_workers, **kwargs)
+
+        new_dataset = SerializeMixin.load(save_path, fmt=self.fmt)
+        assert len(new_dataset) == len(dataset)
+        for i in range(len(dataset)):
+            for t1, t2 in zip(dataset[i], new_dataset[i]):
+                assert torch.allclose(t1.float(), t2.float())
+
+    def test_save_parallel_iterable(self, h5py, tmp_path, save_path):
+        class DatasetImpl(IterableDataset, SerializeMixin):
+            def __iter__(self):
+                return iter(IndexDataset(10))
+
+            def __len__(self):
+                return 10
+
+        with pytest.raises(ValueError):
+            DatasetImpl().save(save_path, fmt=self.fmt, verbose=False, num_workers=2)
+
+    def test_pickle(self, h5py, torch, tmp_path, dataset, input_file, data):
+        new_dataset = dataset.__class__.load(input_file)
+        new_dataset[0]
+        restored = pickle.loads(pickle.dumps(new_dataset))
+        for e1, e2 in zip(data, restored):
+            for t1, t2 in zip(e1, e2):
+                assert torch.allclose(t1.float(), t2.float())
+
 
 class TestTorchSerialize(TestSerialize):
     fmt = "torch"
@@ -305,8 +375,222 @@ class TestTorchSerialize(TestSerialize):
     def test_preserves_attributes(self):
         pass
 
+    def test_dataloader_stress(self):
+        pass
+
+    def test_save_shards(self):
+        pass
+
+    def test_set_shard_metadata(self):
+        pass
+
+
+class TestPackedSerialize(TestSerialize):
+    fmt = "packed"
+
+    @pytest.fixture
+    def input_file(self, torch, tmp_path, dataset):
+        path = os.path.join(tmp_path, "packed")
+        save_packed(dataset, path, shard_size=3, verbose=False)
+        return path
+
+    @pytest.fixture
+    def save_path(self, tmp_path):
+        return os.path.join(tmp_path, "foo")
+
+    def test_save(self, tmp_path, dataset, save_path):
+        dataset.save(save_path, fmt=self.fmt)
+        check_file_exists(os.path.join(save_path, PackedDataset.INDEX_FILE))
+        check_file_exists(os.path.join(save_path, "shard_0.pack"))
+
+    def test_load(self, torch, tmp_path, dataset, input_file, data):
+        new_dataset = dataset.__class__.load(input_file)
+        assert isinstance(new_dataset, PackedDataset)
+        assert len(new_dataset) == len(data)
+        for e1, e2 in zip(data, new_dataset):
+            for t1, t2 in zip(e1, e2):
+                assert torch.allclose(t1, t2)
+
+    @pytest.mark.parametrize(
+        "num_shards,shard_size,expected",
+        [
+            pytest.param(2, None, 2),
+            pytest.param(None, 3, 4),
+            pytest.param(None, None, 1),
+            pytest.param(2, 2, None, marks=pytest.mark.xfail(raises=ValueError)),
+            pytest.param(0, None, None, marks=pytest.mark.xfail(raises=ValueError)),
+            pytest.param(None, 0, None, marks=pytest.mark.xfail(raises=ValueError)),
+        ],
+    )
+    def test_save_shards(self, torch, tmp_path, dataset, data, num_shards, shard_size, expected, save_path):
+        dataset.save(save_path, fmt=self.fmt, num_shards=num_shards, shard_size=shard_size)
+        for shard in range(expected):
+            check_file_exists(os.path.join(save_path, f"shard_{shard}.pack"))
+        assert not os.path.exists(os.path.join(save_path, f"shard_{expected}.pack"))
+
+        new_dataset = PackedDataset(save_path)
+        assert len(new_dataset) == len(data)
+        for i in reversed(range(len(data))):
+            for t1, t2 in zip(data[i], new_dataset[i]):
+                assert torch.allclose(t1, t2)
+
+    def test_index_error(self, input_file, data):
+        new_dataset = PackedDataset(input_file)
+        with pytest.raises(IndexError):
+            new_dataset[len(data)]
+
+    @pytest.mark.parametrize("num_workers", [1, 4])
+    def test_dataloader(self, torch, tmp_path, dataset, input_file, data, num_workers):
+        new_dataset = dataset.__class__.load(input_file)
+        dataloader = DataLoader(new_dataset, num_workers=num_workers, batch_size=1)
+
+        for i in range(10):
+            for e1, e2 in zip(dataloader, new_dataset):
+                for t1, t2 in zip(e1, e2):
+                    assert torch.allclose(t1, t2)
+
+    # skip these inherited tests
+    def test_preserves_attributes(self):
+        pass
+
+    def test_dataloader_stress(self):
+        pass
+
+    def test_set_shard_metadata(self):
+        pass
+
+
+class TestMMapSerialize(TestSerialize):
+    fmt = "mmap"
+
+    @pytest.fixture
+    def input_file(self, torch, tmp_path, dataset):
+        path = os.path.join(tmp_path, "mmap")
+        dataset.save(path, fmt=self.fmt, verbose=False)
+        return path
+
+    @pytest.fixture
+    def save_path(self, tmp_path):
+        return os.path.join(tmp_path, "foo")
+
+    def test_save(self, tmp_path, dataset, save_path):
+        dataset.save(save_path, fmt=self.fmt)
+        check_file_exists(os.path.join(save_path, "data_0.npy"))
+        check_file_exists(os.path.join(save_path, "data_1.npy"))
+
+    def test_load(self, torch, tmp_path, dataset, input_file, data):
+        new_dataset = dataset.__class__.load(input_file)
+        assert isinstance(new_dataset, MMapDataset)
+        assert len(new_dataset) == len(data)
+        for e1, e2 in zip(data, new_dataset):
+            for t1, t2 in zip(e1, e2):
+                assert t1.dtype == t2.dtype
+                assert torch.allclose(t1, t2)
+
+    def test_zero_copy(self, torch, input_file):
+        new_dataset = MMapDataset(input_file)
+        e1, e2 = new_dataset[0], new_dataset[0]
+        assert e1[0].data_ptr() == e2[0].data_ptr()
+
+    def test_shape_mismatch(self, torch, tmp_path):
+        class DatasetImpl(Dataset, SerializeMixin):
+            def __getitem__(self, index):
+                return torch.rand(index + 1)
+
+            def __len__(self):
+                return 2
+
+        with pytest.raises(ValueError):
+            DatasetImpl().save(os.path.join(tmp_path, "foo"), fmt=self.fmt, verbose=False)
+
+    @pytest.mark.parametrize("num_workers", [1, 4])
+    def test_dataloader(self, torch, tmp_path, dataset, input_file, data, num_workers):
+        new_dataset = dataset.__class__.load(input_file)
+        dataloader = DataLoader(new_dataset, num_workers=num_workers, batch_size=1)
+
+        for i in range(10):
+            for e1, e2 in zip(dataloader, new_dataset):
+                for t1, t2 in zip(e1, e2):
+                    assert torch.allclose(t1, t2)
+
+    # skip these inherited tests
+    def test_preserves_attributes(self):
+        pass
+
+    def test_dataloader_stress(self):
+        pass
+
     def test_save_shards(self):
         pass
 
     def test_set_shard_metadata(self):
         pass
+
+    def test_save_parallel_iterable(self):
+        pass
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "float32", "int64"])
+def test_hdf5_preserves_dtype(h5py, torch, tmp_path, dtype):
+    dtype = getattr(torch, dtype)
+    data = [(torch.randint(0, 255, (3, 8, 8)).to(dtype), torch.tensor([i])) for i in range(10)]
+
+    class DatasetImpl(Dataset, SerializeMixin):
+        def __getitem__(self, index):
+            return data[index]
+
+        def __len__(self):
+            return len(data)
+
+    path = os.path.join(tmp_path, "foo.h5")
+    DatasetImpl().save(path, fmt="hdf5", verbose=False)
+    new_dataset = HDF5Dataset(path)
+    for e1, e2 in zip(data, new_dataset):
+        for t1, t2 in zip(e1, e2):
+            assert t1.dtype == t2.dtype
+            assert torch.equal(t1, t2)
+
+
+@pytest.mark.parametrize(
+    "compression,compression_opts,chunks",
+    [
+        pytest.param(None, None, 4),
+        pytest.param("gzip", 4, None),
+        pytest.param("gzip", None, 2),
+        pytest.param("lzf", None, True),
+    ],
+)
+@pytest.mark.parametrize("write_batch_size", [1, 3, 32])
+@pytest.mark.parametrize("num_shards", [None, 2])
+def test_hdf5_chunks_compression(
+    h5py, torch, tmp_path, compression, compression_opts, chunks, write_batch_size, num_shards
+):
+    dataset = IndexDataset(10)
+    path = os.path.join(tmp_path, "foo.h5")
+    dataset.save(
+        path,
+        fmt="hdf5",
+        verbose=False,
+        num_shards=num_shards,
+        chunks=chunks,
+        compression=compression,
+        compression_opts=compression_opts,
+        write_batch_size=write_batch_size,
+    )
+
+    shard = path if num_shards is None else os.path.join(tmp_path, "foo_1.h5")
+    with h5py.File(shard, "r") as f:
+        assert f["data_0"].compression == compression
+        if isinstance(chunks, int) and not isinstance(chunks, bool):
+            assert f["data_0"].chunks == (chunks, 1, 10, 10)
+
+    new_dataset = HDF5Dataset(path)
+    assert len(new_dataset) == len(dataset)
+    for i in range(len(dataset)):
+        for t1, t2 in zip(dataset[i], new_dataset[i]):
+            assert torch.equal(t1, t2)
+
+
+def test_save_kwargs_unsupported_fmt(torch, tmp_path):
+    with pytest.raises(TypeError):
+        IndexDataset(10).save(os.path.join(tmp_path, "foo"), fmt="torch", compression="gzip")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from combustion.data import SerializeMixin, StreamingDataset
+
+
+class IndexDataset(Dataset, SerializeMixin):
+    def __init__(self, length):
+        self.length = length
+
+    def __getitem__(self, index):
+        if index >= self.length:
+            raise IndexError(index)
+        return torch.full((1, 4, 4), float(index)), torch.tensor([index])
+
+    def __len__(self):
+        return self.length
+
+
+@pytest.fixture(params=["packed", "hdf5"])
+def fmt(request):
+    if request.param == "hdf5":
+        pytest.importorskip("h5py", reason="test requires h5py")
+    return request.param
+
+
+@pytest.fixture
+def path(tmp_path, fmt):
+    path = os.path.join(tmp_path, "foo.h5" if fmt == "hdf5" else "foo")
+    IndexDataset(40).save(path, fmt=fmt, num_shards=8, verbose=False)
+    return path
+
+
+def labels(examples):
+    return [int(label.item()) for _, label in examples]
+
+
+def test_sequential_read(path, fmt):
+    ds = StreamingDataset(path, shuffle_shards=False)
+    assert ds.fmt == fmt
+    assert len(ds) == 40
+    assert labels(ds) == list(range(40))
+    for frame, label in ds:
+        assert torch.allclose(frame, torch.full((1, 4, 4), float(label.item())))
+
+
+@pytest.mark.parametrize("shuffle_buffer", [0, 1, 8, 100])
+def test_shuffle_buffer(path, shuffle_buffer):
+    ds = StreamingDataset(path, shuffle_buffer=shuffle_buffer)
+    result = labels(ds)
+    assert sorted(result) == list(range(40))
+    if shuffle_buffer > 1:
+        assert result != list(range(40))
+
+
+def test_set_epoch(path):
+    ds = StreamingDataset(path, shuffle_buffer=8)
+    epoch0 = labels(ds)
+    assert labels(ds) == epoch0
+    ds.set_epoch(1)
+    assert labels(ds) != epoch0
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 4])
+def test_dataloader_workers(path, num_workers):
+    ds = StreamingDataset(path, shuffle_buffer=4)
+    dl = DataLoader(ds, batch_size=1, num_workers=num_workers)
+    result = [int(label.item()) for _, label in dl]
+    assert sorted(result) == list(range(40))
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 4])
+def test_ranks_disjoint(path, world_size):
+    seen = []
+    total = 0
+    for rank in range(world_size):
+        ds = StreamingDataset(path, rank=rank, world_size=world_size)
+        result = labels(ds)
+        assert len(result) == len(ds)
+        total += len(ds)
+        seen += result
+    assert total == 40
+    assert sorted(seen) == list(range(40))
+
+
+def test_more_workers_than_shards(path):
+    ds = StreamingDataset(path, rank=15, world_size=16)
+    assert len(ds) == 0
+    with pytest.warns(UserWarning):
+        result = labels(ds)
+    assert result == []
+
+
+@pytest.mark.parametrize("rank,world_size", [(-1, 1), (2, 2)])
+def test_invalid_rank(path, rank, world_size):
+    with pytest.raises(ValueError):
+        StreamingDataset(path, rank=rank, world_size=world_size)
+
+
+def test_transforms(path):
+    ds = StreamingDataset(
+        path,
+        transform=lambda x: x * 0,
+        target_transform=lambda x: x + 100,
+        shuffle_shards=False,
+    )
+    frame, label = next(iter(ds))
+    assert (frame == 0).all()
+    assert label.item() == 100
+
+
+def test_repr(path):
+    ds = StreamingDataset(path, shuffle_buffer=8, transform=lambda x: x)
+    print(repr(ds))
+
+
+def test_hdf5_relative_path(tmp_path, monkeypatch):
+    pytest.importorskip("h5py", reason="test requires h5py")
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("out")
+    IndexDataset(40).save(os.path.join("out", "data.h5"), fmt="hdf5", num_shards=4, verbose=False)
+
+    ds = StreamingDataset(os.path.join("out", "data.h5"), shuffle_shards=False)
+    assert labels(ds) == list(range(40))
+
+    # shards are located relative to the master file, so the dataset can be moved
+    os.rename("out", "moved")
+    ds = StreamingDataset(os.path.join(tmp_path, "moved", "data.h5"), shuffle_shards=False)
+    assert labels(ds) == list(range(40))
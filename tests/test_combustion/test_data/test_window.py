@@ -79,3 +79,178 @@ def test_call(window_type, before, after, num, torch):
         assert x.shape == frame_shape
         assert y.shape == label_shape
     assert len(list(window(examples))) == num - before - after
+
+
+@pytest.mark.parametrize(
+    "window_type,before,after,is_view",
+    [
+        pytest.param(DenseWindow, 1, 0, True, id="dense_1->0"),
+        pytest.param(DenseWindow, 0, 1, True, id="dense_0->1"),
+        pytest.param(DenseWindow, 2, 2, True, id="dense_2->2"),
+        pytest.param(SparseWindow, 1, 0, True, id="sparse_1->0"),
+        pytest.param(SparseWindow, 0, 2, True, id="sparse_0->2"),
+        pytest.param(SparseWindow, 2, 2, True, id="sparse_2->2"),
+        pytest.param(SparseWindow, 1, 3, False, id="sparse_1->3"),
+    ],
+)
+@pytest.mark.parametrize("channels", [False, True])
+def test_unfold_matches_call(window_type, before, after, is_view, channels, torch):
+    num = 10
+    window = window_type(before, after)
+    frames = torch.rand(num, 3, 4)
+    labels = torch.rand(num, 3, 4)
+    examples = list(zip(frames, labels))
+
+    if channels:
+        frames, labels = frames.unsqueeze(0), labels.unsqueeze(0)
+    windows, center_labels = window.unfold(frames, labels)
+    assert windows.shape[0] == window.estimate_size(num)
+    assert center_labels.shape[0] == window.estimate_size(num)
+
+    for i, (expected_frames, expected_label) in enumerate(window(examples)):
+        expected_frames = expected_frames.rename(None)
+        expected_label = expected_label.rename(None)
+        if not channels:
+            expected_frames, expected_label = expected_frames[0], expected_label[0]
+        assert torch.allclose(windows[i], expected_frames)
+        assert torch.allclose(center_labels[i], expected_label)
+
+    assert (windows.storage().data_ptr() == frames.storage().data_ptr()) == is_view
+
+
+def test_unfold_too_few_frames(torch):
+    window = DenseWindow(2, 2)
+    with pytest.raises(ValueError):
+        window.unfold(torch.rand(4, 3, 3))
+
+
+@pytest.mark.parametrize("window_type", [DenseWindow, SparseWindow])
+@pytest.mark.parametrize("labels", [True, False])
+def test_windowed_dataset_tensor(window_type, labels, torch):
+    from combustion.data import WindowedDataset
+
+    window = window_type(1, 1)
+    frames = torch.rand(1, 10, 4, 4)
+    label_tensor = torch.rand(1, 10, 4, 4) if labels else None
+    ds = WindowedDataset(frames, window, label_tensor)
+    assert len(ds) == 8
+
+    example = ds[3]
+    if labels:
+        example, label = example
+        assert torch.allclose(label, label_tensor[:, 4])
+    assert example.shape == (1, 3, 4, 4)
+    assert torch.allclose(example, frames[:, 3:6])
+
+    with pytest.raises(IndexError):
+        ds[8]
+
+
+class FrameDataset:
+    def __init__(self, frames, labels=None):
+        self.frames = frames
+        self.labels = labels
+        self.loads = []
+
+    def __getitem__(self, pos):
+        self.loads.append(pos)
+        if self.labels is None:
+            return self.frames[pos]
+        return self.frames[pos], self.labels[pos]
+
+    def __len__(self):
+        return len(self.frames)
+
+
+@pytest.mark.parametrize(
+    "window_type,before,after",
+    [
+        pytest.param(DenseWindow, 1, 0, id="dense_1->0"),
+        pytest.param(DenseWindow, 2, 2, id="dense_2->2"),
+        pytest.param(SparseWindow, 2, 2, id="sparse_2->2"),
+        pytest.param(SparseWindow, 1, 3, id="sparse_1->3"),
+    ],
+)
+@pytest.mark.parametrize("labels", [True, False])
+def test_windowed_dataset_matches_tensor(window_type, before, after, labels, torch):
+    from combustion.data import WindowedDataset
+
+    window = window_type(before, after)
+    frames = torch.rand(10, 4, 4)
+    label_tensor = torch.rand(10, 4, 4) if labels else None
+    expected = WindowedDataset(frames, window, label_tensor)
+    ds = WindowedDataset(FrameDataset(frames, label_tensor), window)
+    assert len(ds) == len(expected) == window.estimate_size(10)
+
+    for i in reversed(range(len(ds))):
+        if labels:
+            for t1, t2 in zip(ds[i], expected[i]):
+                assert torch.allclose(t1, t2)
+        else:
+            assert torch.allclose(ds[i], expected[i])
+
+
+@pytest.mark.parametrize("cache_size,expected_loads", [(None, 10), (0, 24)])
+def test_windowed_dataset_frame_cache(cache_size, expected_loads, torch):
+    from combustion.data import WindowedDataset
+
+    window = DenseWindow(1, 1)
+    source = FrameDataset(torch.rand(10, 4, 4))
+    ds = WindowedDataset(source, window, cache_size=cache_size)
+    for i in range(len(ds)):
+        ds[i]
+    assert len(source.loads) == expected_loads
+
+
+@pytest.mark.parametrize("cache_size,expected_loads", [(None, 20), (3, 48)])
+def test_windowed_dataset_sparse_frame_cache(cache_size, expected_loads, torch):
+    from combustion.data import WindowedDataset
+
+    # the default cache holds the window's span of 5 frames, so every frame is loaded once
+    window = SparseWindow(2, 2)
+    source = FrameDataset(torch.rand(20, 4, 4))
+    ds = WindowedDataset(source, window, cache_size=cache_size)
+    for i in range(len(ds)):
+        ds[i]
+    assert len(source.loads) == expected_loads
+
+
+def test_windowed_dataset_only_loads_window(torch):
+    from combustion.data import WindowedDataset
+
+    source = FrameDataset(torch.rand(100, 4, 4))
+    ds = WindowedDataset(source, SparseWindow(2, 2))
+    ds[50]
+    assert sorted(source.loads) == [50, 52, 54]
+
+
+def test_windowed_dataset_labels_with_dataset(torch):
+    from combustion.data import WindowedDataset
+
+    with pytest.raises(ValueError):
+        WindowedDataset(FrameDataset(torch.rand(10, 4, 4)), DenseWindow(1, 1), labels=torch.rand(10, 4, 4))
+
+
+@pytest.mark.parametrize(
+    "window_type,before,after",
+    [
+        pytest.param(DenseWindow, 1, 0, id="dense_1->0"),
+        pytest.param(DenseWindow, 0, 1, id="dense_0->1"),
+        pytest.param(DenseWindow, 2, 2, id="dense_2->2"),
+        pytest.param(SparseWindow, 1, 0, id="sparse_1->0"),
+        pytest.param(SparseWindow, 2, 2, id="sparse_2->2"),
+        pytest.param(SparseWindow, 1, 3, id="sparse_1->3"),
+    ],
+)
+def test_windowed_dataset_frame_order(window_type, before, after, torch):
+    from combustion.data import WindowedDataset
+
+    # each frame is filled with its own index
+    frames = torch.arange(20).float().view(20, 1, 1, 1).expand(-1, 1, 2, 2)
+    window = window_type(before, after)
+    ds = WindowedDataset(FrameDataset(frames), window)
+
+    for center in range(max(before, 7), 20 - after):
+        expected = torch.tensor(sorted(window.indices(center))).float()
+        assert list(window.indices(center)) == sorted(window.indices(center))
+        assert torch.equal(ds[center - before][0, :, 0, 0], expected)
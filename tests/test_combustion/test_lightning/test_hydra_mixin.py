@@ -330,6 +330,36 @@ def test_get_datasets(cfg, check):
     assert isinstance(getattr(model, check), torch.utils.data.Dataset)
 
 
+def test_get_datasets_cache(cfg, tmp_path):
+    from combustion.data import PersistentCachedDataset
+
+    cfg.dataset.train["cache"] = {"path": str(tmp_path)}
+    model = HydraMixin.create_model(cfg)
+    model.get_datasets()
+    assert isinstance(model.train_ds, PersistentCachedDataset)
+    assert not isinstance(model.val_ds, PersistentCachedDataset)
+
+    x1, y1 = model.train_ds[0]
+    model.get_datasets(force=True)
+    x2, y2 = model.train_ds[0]
+    assert torch.equal(x1, x2)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # changing batch size should not change the cache key
+    cfg.dataset.train["batch_size"] = 4
+    model = HydraMixin.create_model(cfg)
+    model.get_datasets()
+    model.train_ds[0]
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # changing the dataset should
+    cfg.dataset.train.params["image_size"] = [1, 32, 32]
+    model = HydraMixin.create_model(cfg)
+    model.get_datasets()
+    model.train_ds[0]
+    assert len(list(tmp_path.iterdir())) == 2
+
+
 @pytest.mark.parametrize("force", [True, False])
 def test_get_datasets_forced(cfg, force, mocker):
     model = HydraMixin.create_model(cfg)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+
+@pytest.fixture
+def binned_box_updates():
+    r"""Box metric updates with distinct prediction scores that each fall in their own score bin,
+    along with the number of bins required. Returns a tuple of ``(updates, num_bins)`` where
+    ``updates`` is a list of ``(pred, target)`` pairs.
+    """
+    torch.random.manual_seed(42)
+    num_updates, num_pred, num_target = 4, 20, 10
+    total_pred = num_updates * num_pred
+
+    # bin 0 is left for the zero score assigned to missed target boxes
+    num_bins = total_pred + 2
+    scores = (torch.randperm(total_pred).float() + 1.5) / num_bins
+
+    updates = []
+    for i in range(num_updates):
+        xy = torch.randint(0, 32, (num_pred, 2)).float()
+        pred_boxes = torch.cat([xy, xy + 4], dim=-1)
+        pred_cls = torch.randint(0, 3, (num_pred, 1)).float()
+        pred_scores = scores[i * num_pred : (i + 1) * num_pred, None]
+        pred = torch.cat([pred_boxes, pred_scores, pred_cls], dim=-1)
+
+        # targets overlap a subset of predictions, some with a mismatched class
+        target_boxes = pred_boxes[:num_target] + torch.rand(num_target, 4)
+        wrong_cls = (pred_cls[:num_target] + 1) % 3
+        target_cls = torch.where(torch.rand(num_target, 1) < 0.7, pred_cls[:num_target], wrong_cls)
+        target = torch.cat([target_boxes, target_cls], dim=-1)
+        updates.append((pred, target))
+
+    return updates, num_bins
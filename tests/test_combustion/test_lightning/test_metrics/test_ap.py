@@ -11,7 +11,8 @@ from combustion.lightning.metrics import BoxAveragePrecision
 class TestBoxAveragePrecision:
     @pytest.mark.parametrize("true_positive_limit", [True, False])
     @pytest.mark.parametrize("pos_label", [None, 0, 1, 2])
-    def test_all_correct(self, true_positive_limit, pos_label):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_all_correct(self, num_bins, true_positive_limit, pos_label):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -31,14 +32,17 @@ class TestBoxAveragePrecision:
             ]
         ).float()
 
-        metric = BoxAveragePrecision(iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit)
+        metric = BoxAveragePrecision(
+            iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit, num_bins=num_bins
+        )
 
         value = metric(pred, target)
         assert value == 1.0
 
     @pytest.mark.parametrize("true_positive_limit", [True, False])
     @pytest.mark.parametrize("pos_label", [None, 0, 1, 2])
-    def test_all_wrong(self, true_positive_limit, pos_label):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_all_wrong(self, num_bins, true_positive_limit, pos_label):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -58,7 +62,9 @@ class TestBoxAveragePrecision:
             ]
         ).float()
 
-        metric = BoxAveragePrecision(iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit)
+        metric = BoxAveragePrecision(
+            iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit, num_bins=num_bins
+        )
 
         value = metric(pred, target)
         assert value == 0.5
@@ -74,7 +80,8 @@ class TestBoxAveragePrecision:
             pytest.param(True, 0.5, 2, 0.3333),
         ],
     )
-    def test_real_example(self, true_positive_limit, iou_threshold, pos_label, expected):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_real_example(self, num_bins, true_positive_limit, iou_threshold, pos_label, expected):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -103,8 +110,75 @@ class TestBoxAveragePrecision:
         ).float()
 
         metric = BoxAveragePrecision(
-            iou_threshold=iou_threshold, pos_label=pos_label, true_positive_limit=true_positive_limit
+            iou_threshold=iou_threshold,
+            pos_label=pos_label,
+            true_positive_limit=true_positive_limit,
+            num_bins=num_bins,
         )
         value = metric(pred, target)
         expected = torch.tensor(expected)
         assert torch.allclose(value, expected, atol=1e-3)
+
+    @pytest.mark.parametrize("pos_label", [None, 1])
+    def test_binned_matches_exact(self, binned_box_updates, pos_label):
+        updates, num_bins = binned_box_updates
+        exact = BoxAveragePrecision(pos_label=pos_label, compute_on_step=False)
+        binned = BoxAveragePrecision(pos_label=pos_label, num_bins=num_bins, compute_on_step=False)
+        for pred, target in updates:
+            exact.update(pred, target)
+            binned.update(pred, target)
+
+        assert binned.positive_hist.shape == binned.negative_hist.shape == (num_bins,)
+        assert torch.allclose(binned.compute(), exact.compute(), atol=1e-5)
+
+    def test_invalid_num_bins(self):
+        with pytest.raises(ValueError):
+            BoxAveragePrecision(num_bins=0)
+
+    @pytest.fixture
+    def batch(self):
+        pred1 = torch.tensor(
+            [
+                [0, 0, 2, 2, 0.9, 0],
+                [2, 2, 4, 4, 0.8, 1],
+                [5, 5, 9, 9, 0.15, 0],
+                [10, 10, 12, 12, 0.1, 1],
+            ]
+        ).float()
+        target1 = torch.tensor([[0, 0, 2, 2, 0], [2, 2, 4, 4, 1], [5, 5, 9, 9, 1]]).float()
+        pred2 = torch.tensor(
+            [
+                [1, 1, 4, 4, 0.6, 1],
+                [5, 5, 9, 9, 0.05, 0],
+                [20, 20, 30, 30, 0.7, 0],
+            ]
+        ).float()
+        target2 = torch.tensor([[1, 1, 4, 4, 1], [5, 5, 9, 9, 0]]).float()
+        return (pred1, target1), (pred2, target2)
+
+    @pytest.mark.parametrize("pos_label", [None, 0, 1])
+    @pytest.mark.parametrize("pred_box_limit", [None, 2])
+    def test_batched_input(self, batch, pos_label, pred_box_limit):
+        (pred1, target1), (pred2, target2) = batch
+        kwargs = {"pos_label": pos_label, "pred_box_limit": pred_box_limit, "compute_on_step": False}
+
+        metric = BoxAveragePrecision(**kwargs)
+        metric.update(pred1, target1)
+        metric.update(pred2, target2)
+        expected = metric.compute()
+
+        metric = BoxAveragePrecision(**kwargs)
+        pred = torch.nn.utils.rnn.pad_sequence([pred1, pred2], batch_first=True, padding_value=-1)
+        target = torch.nn.utils.rnn.pad_sequence([target1, target2], batch_first=True, padding_value=-1)
+        metric.update(pred, target)
+        assert torch.allclose(metric.compute(), expected)
+
+    @pytest.mark.parametrize("pred_box_limit", [1, 2, 3])
+    def test_pred_box_limit(self, batch, pred_box_limit):
+        (pred, target), _ = batch
+        metric = BoxAveragePrecision(pred_box_limit=pred_box_limit)
+        value = metric(pred[torch.randperm(pred.shape[0])], target)
+
+        # scores in pred are sorted, so the first K boxes are the top K
+        expected = BoxAveragePrecision()(pred[:pred_box_limit], target)
+        assert torch.allclose(value, expected)
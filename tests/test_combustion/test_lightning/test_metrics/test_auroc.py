@@ -44,11 +44,27 @@ class TestAUROC:
         score = metric.compute()
         assert torch.allclose(score, expected, atol=1e-4)
 
+    def test_state_chunks(self):
+        pred = torch.tensor([0.1, 0.7, 0.3, 0.4, 0.9])
+        target = torch.tensor([0, 1, 1, 0, 1])
+        metric = AUROC(compute_on_step=False)
+        for i in range(0, 5, 2):
+            metric.update(pred[i : i + 2], target[i : i + 2])
+        assert len(metric.pred) == len(metric.true) == 3
+
+        expected = torch.tensor(0.8333)  # computed via sklearn
+        assert torch.allclose(metric.compute(), expected, atol=1e-4)
+
+        # states are concatenated tensors after a distributed sync
+        metric.pred, metric.true = pred, target
+        assert torch.allclose(metric.compute(), expected, atol=1e-4)
+
 
 class TestBoxAUROC:
     @pytest.mark.parametrize("true_positive_limit", [True, False])
     @pytest.mark.parametrize("pos_label", [None, 0, 1, 2])
-    def test_all_correct(self, true_positive_limit, pos_label):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_all_correct(self, num_bins, true_positive_limit, pos_label):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -69,7 +85,9 @@ class TestBoxAUROC:
             ]
         ).float()
 
-        metric = BoxAUROC(iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit)
+        metric = BoxAUROC(
+            iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit, num_bins=num_bins
+        )
 
         value = metric(pred, target)
         if pos_label == 2.0 or pos_label is None:
@@ -80,7 +98,8 @@ class TestBoxAUROC:
 
     @pytest.mark.parametrize("true_positive_limit", [True, False])
     @pytest.mark.parametrize("pos_label", [None, 0, 1, 2])
-    def test_all_wrong(self, true_positive_limit, pos_label):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_all_wrong(self, num_bins, true_positive_limit, pos_label):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -100,7 +119,9 @@ class TestBoxAUROC:
             ]
         ).float()
 
-        metric = BoxAUROC(iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit)
+        metric = BoxAUROC(
+            iou_threshold=0.5, pos_label=pos_label, true_positive_limit=true_positive_limit, num_bins=num_bins
+        )
 
         value = metric(pred, target)
         assert value == 0.0
@@ -116,7 +137,8 @@ class TestBoxAUROC:
             pytest.param(True, 0.5, 2, 0.0),
         ],
     )
-    def test_real_example(self, true_positive_limit, iou_threshold, pos_label, expected):
+    @pytest.mark.parametrize("num_bins", [None, 100])
+    def test_real_example(self, num_bins, true_positive_limit, iou_threshold, pos_label, expected):
         torch.random.manual_seed(42)
 
         # assume we predicted a set of boxes (x1, y1, x2, y2, class)
@@ -144,7 +166,28 @@ class TestBoxAUROC:
             ]
         ).float()
 
-        metric = BoxAUROC(iou_threshold=iou_threshold, pos_label=pos_label, true_positive_limit=true_positive_limit)
+        metric = BoxAUROC(
+            iou_threshold=iou_threshold,
+            pos_label=pos_label,
+            true_positive_limit=true_positive_limit,
+            num_bins=num_bins,
+        )
         value = metric(pred, target)
         expected = torch.tensor(expected)
         assert torch.allclose(value, expected, atol=1e-3)
+
+    @pytest.mark.parametrize("pos_label", [None, 1])
+    def test_binned_matches_exact(self, binned_box_updates, pos_label):
+        updates, num_bins = binned_box_updates
+        exact = BoxAUROC(pos_label=pos_label, compute_on_step=False)
+        binned = BoxAUROC(pos_label=pos_label, num_bins=num_bins, compute_on_step=False)
+        for pred, target in updates:
+            exact.update(pred, target)
+            binned.update(pred, target)
+
+        assert binned.positive_hist.shape == binned.negative_hist.shape == (num_bins,)
+        assert torch.allclose(binned.compute(), exact.compute(), atol=1e-5)
+
+    def test_invalid_num_bins(self):
+        with pytest.raises(ValueError):
+            BoxAUROC(num_bins=0)
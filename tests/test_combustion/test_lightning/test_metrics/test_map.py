@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from combustion.lightning.metrics import BoxMeanAveragePrecision
+
+
+class TestBoxMeanAveragePrecision:
+    @pytest.fixture
+    def pred(self):
+        return torch.tensor(
+            [
+                [10, 10, 12, 12, 0.9, 0],  # false positive
+                [0, 0, 2, 2, 0.8, 0],  # tp target[0]
+                [4, 4, 6, 6, 0.7, 0],  # tp target[1]
+                [0, 0, 10, 6.3, 0.5, 1],  # tp target[2] with IoU 0.63
+                [20, 20, 22, 22, 0.6, 2],  # no targets of class 2
+            ]
+        ).float()
+
+    @pytest.fixture
+    def target(self):
+        return torch.tensor(
+            [
+                [0, 0, 2, 2, 0],
+                [4, 4, 6, 6, 0],
+                [0, 0, 10, 10, 1],
+            ]
+        ).float()
+
+    def test_all_correct(self, target):
+        pred = torch.cat([target[..., :4], torch.ones(3, 1), target[..., -1:]], dim=-1)
+        metric = BoxMeanAveragePrecision(num_classes=2)
+        mean_ap, class_ap = metric(pred, target)
+        assert mean_ap == 1.0
+        assert (class_ap == 1.0).all()
+
+    def test_real_example(self, pred, target):
+        metric = BoxMeanAveragePrecision(num_classes=3)
+        mean_ap, class_ap = metric(pred, target)
+
+        # class 0 precision of 1/2 is interpolated up to 2/3 at recall 1/2
+        # class 1 box is a true positive for thresholds 0.50, 0.55, 0.60
+        assert torch.allclose(class_ap[:2], torch.tensor([2 / 3, 0.3]), atol=1e-4)
+        assert class_ap[2].isnan()
+        assert torch.allclose(mean_ap, torch.tensor((2 / 3 + 0.3) / 2), atol=1e-4)
+
+    @pytest.mark.parametrize(
+        "iou_threshold,expected",
+        [
+            pytest.param(0.5, [2 / 3, 1.0]),
+            pytest.param(0.75, [2 / 3, 0.0]),
+        ],
+    )
+    def test_single_threshold(self, pred, target, iou_threshold, expected):
+        metric = BoxMeanAveragePrecision(num_classes=2, iou_thresholds=[iou_threshold])
+        _, class_ap = metric(pred, target)
+        assert torch.allclose(class_ap, torch.tensor(expected), atol=1e-4)
+
+    def test_coco_duplicate_detection(self):
+        # COCO matches the higher scoring duplicate first, even though the other box has higher IoU
+        pred = torch.tensor(
+            [
+                [0, 0, 10, 7.8, 0.9, 0],  # IoU 0.78
+                [0, 0, 10, 10, 0.8, 0],  # IoU 1.0
+            ]
+        )
+        target = torch.tensor([[0, 0, 10, 10, 0]]).float()
+        metric = BoxMeanAveragePrecision(num_classes=1)
+        mean_ap, _ = metric(pred, target)
+
+        # AP is 1.0 for thresholds <= 0.75 where the first box matches
+        # for thresholds >= 0.8 the first box is a false positive and the second a true positive
+        assert torch.allclose(mean_ap, torch.tensor((6 * 1.0 + 4 * 0.5) / 10), atol=1e-4)
+
+    def test_coco_crowded_targets(self):
+        # the first box is the best match for both targets, but may only match one of them
+        pred = torch.tensor(
+            [
+                [0.5, 0, 10.5, 10, 0.9, 0],  # IoU 0.90 with target[0], 0.74 with target[1]
+                [2, 0, 12, 7, 0.8, 0],  # IoU 0.70 with target[1], 0.49 with target[0]
+            ]
+        )
+        target = torch.tensor([[0, 0, 10, 10, 0], [2, 0, 12, 10, 0]]).float()
+        metric = BoxMeanAveragePrecision(num_classes=1, iou_thresholds=[0.5])
+        mean_ap, _ = metric(pred, target)
+        assert torch.allclose(mean_ap, torch.tensor(1.0))
+
+    def test_batched_input(self, pred, target):
+        metric = BoxMeanAveragePrecision(num_classes=3, compute_on_step=False)
+        metric.update(pred, target)
+        expected = metric.compute()
+
+        batch_pred = torch.full((2, 4, 6), -1.0)
+        batch_pred[0, :3] = pred[:3]
+        batch_pred[1, :2] = pred[3:]
+        batch_target = torch.full((2, 2, 5), -1.0)
+        batch_target[0, :2] = target[:2]
+        batch_target[1, :1] = target[2:]
+
+        metric = BoxMeanAveragePrecision(num_classes=3, compute_on_step=False)
+        metric.update(batch_pred, batch_target)
+        mean_ap, class_ap = metric.compute()
+        assert torch.allclose(mean_ap, expected[0])
+        assert torch.allclose(class_ap, expected[1], equal_nan=True)
+
+    def test_pred_box_limit(self, pred, target):
+        metric = BoxMeanAveragePrecision(num_classes=3, pred_box_limit=2)
+        _, class_ap = metric(pred, target)
+
+        # only the false positive and target[0] predictions are retained
+        assert torch.allclose(class_ap[:2], torch.tensor([0.25, 0.0]), atol=1e-4)
+
+    def test_state_size(self, pred, target):
+        metric = BoxMeanAveragePrecision(num_classes=3, num_bins=16, compute_on_step=False)
+        for _ in range(10):
+            metric.update(pred, target)
+        assert metric.true_positive_hist.shape == (10, 3, 16)
+        assert metric.false_positive_hist.shape == (10, 3, 16)
+        assert metric.num_targets.tolist() == [20, 10, 0]
+
+    def test_no_predictions(self, target):
+        metric = BoxMeanAveragePrecision(num_classes=2)
+        mean_ap, class_ap = metric(torch.empty(0, 6), target)
+        assert mean_ap == 0.0
+        assert (class_ap == 0.0).all()
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            pytest.param({"num_classes": 0}, id="num_classes"),
+            pytest.param({"num_classes": 2, "num_bins": 0}, id="num_bins"),
+            pytest.param({"num_classes": 2, "iou_thresholds": [0.0]}, id="iou_thresholds"),
+            pytest.param({"num_classes": 2, "iou_thresholds": []}, id="empty_iou_thresholds"),
+        ],
+    )
+    def test_invalid_args(self, kwargs):
+        with pytest.raises(ValueError):
+            BoxMeanAveragePrecision(**kwargs)
@@ -5,7 +5,7 @@ import pytest
 import torch
 
 from combustion.testing import cuda_or_skip
-from combustion.vision.anchors import AnchorBoxTransform, Anchors, ClipBoxes
+from combustion.vision.anchors import AnchorBoxTransform, AnchorDecoder, Anchors, ClipBoxes
 
 
 @pytest.fixture(params=[(32, 32), (64, 64), (32, 16)])
@@ -111,3 +111,134 @@ def test_memory(levels):
     num_levels = len(levels)
 
     assert memory_delta <= anchors.numel() * num_anchors * bytes_per_float * coords_per_box * num_levels * 4
+
+
+def test_anchor_cache_hit(levels):
+    layer = Anchors(levels)
+    anchors1 = layer(torch.rand(1, 3, 32, 32))
+    anchors2 = layer(torch.rand(2, 3, 32, 32))
+    assert anchors1 is anchors2
+
+    anchors3 = layer(torch.rand(1, 3, 64, 32))
+    assert anchors3 is not anchors1
+    assert layer(torch.rand(1, 3, 32, 32)) is anchors1
+
+
+def test_anchor_cache_matches_uncached(levels):
+    cached = Anchors(levels)
+    uncached = Anchors(levels, cache_size=0)
+    for shape in [(32, 32), (64, 32), (32, 32), (16, 48)]:
+        image = torch.rand(1, 3, *shape)
+        assert torch.equal(cached(image), uncached(image))
+    assert len(uncached._cache) == 0
+
+
+def test_anchor_cache_keyed_by_dtype(levels):
+    layer = Anchors(levels)
+    anchors_float = layer(torch.rand(1, 3, 32, 32))
+    anchors_double = layer(torch.rand(1, 3, 32, 32).double())
+    assert anchors_float.dtype == torch.float
+    assert anchors_double.dtype == torch.double
+    assert torch.allclose(anchors_float.double(), anchors_double)
+
+
+def test_anchor_cache_size(levels):
+    layer = Anchors(levels, cache_size=2)
+    first = layer(torch.rand(1, 3, 16, 16))
+    layer(torch.rand(1, 3, 32, 32))
+    layer(torch.rand(1, 3, 48, 48))
+    assert len(layer._cache) == 2
+    assert layer(torch.rand(1, 3, 16, 16)) is not first
+
+    layer.clear_cache()
+    assert len(layer._cache) == 0
+
+
+def test_anchor_precompute(levels):
+    layer = Anchors(levels, precompute=[(32, 32), (64, 64)])
+    expected = Anchors(levels, cache_size=0)
+    for shape in [(32, 32), (64, 64)]:
+        image = torch.rand(1, 3, *shape)
+        assert torch.equal(layer(image), expected(image))
+
+
+@cuda_or_skip
+def test_anchor_cache_keyed_by_device(levels):
+    layer = Anchors(levels)
+    cpu_anchors = layer(torch.rand(1, 3, 32, 32))
+    cuda_anchors = layer(torch.rand(1, 3, 32, 32).cuda())
+    assert cuda_anchors.device != cpu_anchors.device
+    assert torch.equal(cuda_anchors.cpu(), cpu_anchors)
+
+
+class TestAnchorDecoder:
+    @pytest.fixture
+    def inputs(self):
+        torch.random.manual_seed(42)
+        anchors = Anchors([1, 2])(torch.rand(1, 3, 32, 32))
+        num_anchors = anchors.shape[0]
+        deltas = torch.rand(2, num_anchors, 4).sub_(0.5)
+        scores = torch.rand(2, num_anchors, 3)
+        return anchors, deltas, scores
+
+    def reference(self, anchors, deltas, scores, score_threshold, **kwargs):
+        batch_anchors = anchors.unsqueeze(0).expand(deltas.shape[0], -1, -1)
+        boxes = AnchorBoxTransform(**kwargs)(batch_anchors, deltas)
+        boxes = ClipBoxes()(boxes, torch.empty(1, 1, 32, 32))
+        max_scores, classes = scores.max(dim=-1)
+        keep = max_scores > score_threshold
+        return boxes[keep], max_scores[keep], classes[keep], keep.nonzero()[:, 0]
+
+    @pytest.mark.parametrize("log_length", [True, False])
+    @pytest.mark.parametrize("std", [None, torch.tensor([0.1, 0.1, 0.2, 0.2])])
+    @pytest.mark.parametrize("score_threshold", [0.0, 0.5, 1.0])
+    def test_matches_unfused(self, inputs, log_length, std, score_threshold):
+        anchors, deltas, scores = inputs
+        decoder = AnchorDecoder(std=std, log_length=log_length, score_threshold=score_threshold)
+        output = decoder(anchors, deltas, scores, 32, 32)
+        expected = self.reference(anchors, deltas, scores, score_threshold, std=std, log_length=log_length)
+        for out, exp in zip(output, expected):
+            assert out.shape == exp.shape
+            assert torch.allclose(out, exp, atol=1e-5)
+
+    @pytest.mark.parametrize("scale", [-100.0, 100.0])
+    def test_matches_unfused_off_image(self, inputs, scale):
+        anchors, deltas, scores = inputs
+        deltas = deltas.sign() * scale
+        output = AnchorDecoder()(anchors, deltas, scores, 32, 32)
+        expected = self.reference(anchors, deltas, scores, 0.0)
+        for out, exp in zip(output, expected):
+            assert torch.allclose(out, exp)
+
+    def test_batched_anchors(self, inputs):
+        anchors, deltas, scores = inputs
+        decoder = AnchorDecoder(score_threshold=0.5)
+        batch_anchors = anchors.unsqueeze(0).expand(2, -1, -1)
+        for out, exp in zip(decoder(batch_anchors, deltas, scores, 32, 32), decoder(anchors, deltas, scores, 32, 32)):
+            assert torch.equal(out, exp)
+
+    def test_inputs_not_modified(self, inputs):
+        anchors, deltas, scores = inputs
+        deltas.mul_(100)
+        originals = [t.clone() for t in (anchors, deltas, scores)]
+        boxes, _, _, _ = AnchorDecoder()(anchors, deltas, scores, 32, 32)
+        assert (boxes[:, :2] >= 0).all()
+        assert (boxes[:, 2:] <= 32).all()
+        for t, orig in zip((anchors, deltas, scores), originals):
+            assert torch.equal(t, orig)
+
+    def test_script(self, inputs):
+        anchors, deltas, scores = inputs
+        decoder = AnchorDecoder(std=torch.tensor([0.1, 0.1, 0.2, 0.2]), log_length=True, score_threshold=0.3)
+        scripted = torch.jit.script(decoder)
+        for out, exp in zip(scripted(anchors, deltas, scores, 32, 32), decoder(anchors, deltas, scores, 32, 32)):
+            assert torch.equal(out, exp)
+
+    @cuda_or_skip
+    def test_cuda(self, inputs):
+        anchors, deltas, scores = inputs
+        decoder = AnchorDecoder(std=torch.tensor([0.1, 0.1, 0.2, 0.2]), score_threshold=0.3)
+        expected = decoder(anchors, deltas, scores, 32, 32)
+        output = decoder.cuda()(anchors.cuda(), deltas.cuda(), scores.cuda(), 32, 32)
+        for out, exp in zip(output, expected):
+            assert torch.allclose(out.cpu(), exp, atol=1e-5)
@@ -10,6 +10,7 @@ import torch
 from combustion.vision import (
     append_bbox_label,
     batch_box_target,
+    collate_box_target,
     combine_bbox_scores_class,
     combine_box_target,
     filter_bbox_classes,
@@ -284,6 +285,57 @@ class TestBboxHelpers:
         assert torch.allclose(target[0, :2, ...], split_batch[0])
         assert torch.allclose(target[1], split_batch[1])
 
+    def test_unbatch_box_target_empty_example(self):
+        torch.random.manual_seed(42)
+        target = torch.randint(0, 10, (3, 3, 6))
+        target[1].fill_(-1)
+        target[2, 1:].fill_(-1)
+
+        split_batch = unbatch_box_target(target)
+        assert len(split_batch) == 3
+        assert torch.allclose(target[0], split_batch[0])
+        assert split_batch[1].shape == (0, 6)
+        assert torch.allclose(target[2, :1], split_batch[2])
+
+    def test_batch_box_target_return_lengths(self):
+        torch.random.manual_seed(42)
+        target1 = torch.randint(0, 10, (3, 6))
+        target2 = torch.randint(0, 10, (0, 6))
+        target3 = torch.randint(0, 10, (2, 2, 6))
+        target3[1, 1].fill_(-1)
+
+        batch, lengths = batch_box_target([target1, target2, target3], return_lengths=True)
+        assert batch.shape == (4, 3, 6)
+        assert lengths.tolist() == [3, 0, 2, 1]
+        assert [x.shape[0] for x in unbatch_box_target(batch)] == lengths.tolist()
+
+    def test_batch_box_target_lengths_include_pad_valued_rows(self):
+        target1 = torch.tensor([[-1, -1, -1, -1, -1], [0, 0, 2, 2, 1]])
+        target2 = torch.tensor([[0, 0, 2, 2, 1]])
+        batch, lengths = batch_box_target([target1, target2], return_lengths=True)
+        assert batch.shape == (2, 2, 5)
+        assert lengths.tolist() == [2, 1]
+
+    def test_collate_box_target(self):
+        torch.random.manual_seed(42)
+        examples = [
+            (torch.rand(3, 8, 8), torch.randint(0, 10, (2, 5))),
+            (torch.rand(3, 8, 8), torch.randint(0, 10, (4, 5))),
+            (torch.rand(3, 8, 8), torch.randint(0, 10, (0, 5))),
+        ]
+        img, target, lengths = collate_box_target(examples)
+        assert img.shape == (3, 3, 8, 8)
+        assert torch.allclose(img[1], examples[1][0])
+        assert target.shape == (3, 4, 5)
+        assert lengths.tolist() == [2, 4, 0]
+
+        offsets = lengths.cumsum(dim=0) - lengths
+        flat = flatten_box_target(target)
+        for i, (offset, length) in enumerate(zip(offsets.tolist(), lengths.tolist())):
+            expected = examples[i][1]
+            assert torch.allclose(target[i, :length], expected)
+            assert torch.allclose(flat[offset : offset + length], expected)
+
     @pytest.mark.parametrize("pad_value", [-1, -2])
     def test_flatten_box_target(self, pad_value):
         torch.random.manual_seed(42)
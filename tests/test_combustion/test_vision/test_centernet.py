@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import math
+
 import pytest
 import torch
 
 from combustion.testing import cuda_or_skip
 from combustion.vision import AnchorsToPoints, PointsToAnchors
-from combustion.vision.centernet import CenterNetMixin
+from combustion.vision.centernet import CenterNetMixin, _scatter_max_
 
 
 @pytest.fixture(params=[None, 1, 2])
@@ -358,6 +360,28 @@ class TestCenterNetMixin:
         assert torch.allclose(result[..., 0], expected_pred)
         assert torch.allclose(result[..., 1], expected_target)
 
+    @pytest.mark.parametrize("pad_value", [-1, -2])
+    def test_get_global_pred_target_pairs_padded_batch(self, pad_value):
+        torch.random.manual_seed(42)
+        num_classes = 3
+        pred_heatmap = torch.rand(3, num_classes + 4, 10, 10)
+
+        target = torch.full((3, 3, 5), float(pad_value))
+        target[0, 0] = torch.tensor([0, 0, 2, 2, 0])
+        target[0, 1] = torch.tensor([3, 3, 6, 6, 2])
+        target[1, 0] = torch.tensor([5, 5, 10, 9, 1])
+        target[1, 1] = torch.tensor([1, 1, 4, 4, 5])  # class not in heatmap
+        # target[2] has no boxes
+
+        mixin = CenterNetMixin()
+        result = mixin.get_global_pred_target_pairs(pred_heatmap, target, pad_value=pad_value)
+
+        expected_pred = pred_heatmap[..., :-4, :, :].flatten(start_dim=-2).max(dim=-1).values
+        expected_target = torch.tensor([[1.0, 0.0, 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 0.0]])
+        assert result.shape == (3, num_classes, 2)
+        assert torch.allclose(result[..., 0], expected_pred)
+        assert torch.allclose(result[..., 1], expected_target)
+
     def test_split_regression(self):
         torch.random.manual_seed(42)
         regression = torch.rand(3, 4, 10, 10)
@@ -413,3 +437,118 @@ class TestCenterNetMixin:
             expected = heatmap[..., tuple(real_keep_classes), :, :]
 
         assert torch.allclose(result, expected)
+
+
+def test_anchors_to_points_batched_matches_unbatched():
+    torch.random.manual_seed(42)
+    image_shape = (64, 64)
+    num_classes = 3
+    label = torch.empty(3, 12, 5)
+    label[..., 0] = torch.randint(0, 32, label[..., 0].shape)
+    label[..., 1] = torch.randint(0, 32, label[..., 1].shape)
+    label[..., 2] = torch.randint(32, 64, label[..., 2].shape)
+    label[..., 3] = torch.randint(32, 64, label[..., 3].shape)
+    label[..., 4] = torch.randint(0, num_classes, label[..., 4].shape)
+
+    # pad examples to differing numbers of boxes
+    label[0, 8:] = -1
+    label[2, :] = -1
+    bbox, classes = label[..., :4], label[..., 4:]
+
+    layer = AnchorsToPoints(num_classes, 2)
+    output = layer(bbox, classes, image_shape)
+    for i in range(3):
+        expected = layer(bbox[i], classes[i], image_shape)
+        assert torch.allclose(output[i], expected)
+    assert (output[2, :num_classes] == 0).all()
+
+
+def test_anchors_to_points_same_class_max():
+    image_shape = (32, 32)
+    num_classes = 2
+    bbox = torch.tensor([[0.0, 0.0, 10.0, 10.0], [12.0, 12.0, 30.0, 30.0], [4.0, 4.0, 20.0, 20.0]])
+    classes = torch.tensor([[1.0], [1.0], [1.0]])
+
+    layer = AnchorsToPoints(num_classes, 2)
+    output = layer(bbox, classes, image_shape)
+    expected = torch.stack([layer(b[None], c[None], image_shape)[1] for b, c in zip(bbox, classes)]).max(dim=0).values
+    assert torch.allclose(output[1], expected)
+    assert (output[0] == 0).all()
+
+
+
+def test_scatter_max_many_rows_one_destination():
+    torch.random.manual_seed(42)
+    out = torch.rand(4, 8, 8)
+    index = torch.cat([torch.zeros(200, dtype=torch.long), torch.tensor([2, 3, 3])])
+    src = torch.rand(index.numel(), 8, 8)
+
+    expected = out.clone()
+    for i, row in zip(index, src):
+        expected[i] = torch.max(expected[i], row)
+
+    _scatter_max_(out, index, src)
+    assert torch.equal(out, expected)
+
+
+def test_anchors_to_points_many_boxes_one_class():
+    torch.random.manual_seed(42)
+    image_shape = (64, 64)
+    mins = torch.randint(0, 48, (100, 2)).float()
+    bbox = torch.cat([mins, mins + torch.randint(2, 16, (100, 2)).float()], dim=-1)
+    classes = torch.zeros(100, 1)
+
+    layer = AnchorsToPoints(2, 2)
+    output = layer(bbox, classes, image_shape)
+    expected = torch.stack([layer(b[None], c[None], image_shape)[0] for b, c in zip(bbox, classes)]).max(dim=0).values
+    assert torch.allclose(output[0], expected)
+    assert (output[1] == 0).all()
+
+
+@pytest.mark.parametrize("truncate", [3.0, 4.0])
+def test_anchors_to_points_truncated_splat(bbox, classes, num_classes, image_shape, truncate):
+    dense = AnchorsToPoints(num_classes, 2)
+    truncated = AnchorsToPoints(num_classes, 2, truncate=truncate)
+    expected = dense(bbox, classes, image_shape)
+    output = truncated(bbox, classes, image_shape)
+
+    # values outside the window are below exp(-truncate ** 2 / 2)
+    tol = math.exp(-(truncate ** 2) / 2)
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=tol)
+    assert torch.allclose(output[..., num_classes:, :, :], expected[..., num_classes:, :, :])
+    assert (output <= expected + 1e-6).all()
+
+
+
+def test_truncated_splat_mixed_box_sizes():
+    torch.random.manual_seed(42)
+    image_shape = (128, 128)
+    num_classes = 2
+    mins = torch.randint(0, 112, (20, 2)).float()
+    small = torch.cat([mins, mins + torch.randint(2, 8, (20, 2)).float()], dim=-1)
+    large = torch.tensor([[0.0, 0.0, 128.0, 128.0], [16.0, 16.0, 80.0, 96.0]])
+    bbox = torch.cat([small, large])
+    classes = (torch.arange(bbox.shape[0]) % num_classes).float().view(-1, 1)
+
+    truncate = 3.0
+    dense = AnchorsToPoints(num_classes, 2)
+    truncated = AnchorsToPoints(num_classes, 2, truncate=truncate)
+    expected = dense(bbox, classes, image_shape)
+    output = truncated(bbox, classes, image_shape)
+
+    tol = math.exp(-(truncate ** 2) / 2)
+    assert torch.allclose(output, expected, atol=tol)
+    assert (output[:num_classes] <= expected[:num_classes] + 1e-6).all()
+    assert (output[:num_classes].flatten(1).max(dim=-1).values == 1.0).all()
+
+
+def test_truncated_splat_keeps_peaks():
+    image_shape = (32, 32)
+    bbox = torch.tensor([[0.0, 0.0, 10.0, 10.0], [12.0, 12.0, 30.0, 30.0]])
+    classes = torch.tensor([[0.0], [0.0]])
+    layer = AnchorsToPoints(1, 2, truncate=3.0)
+    output = layer(bbox, classes, image_shape)
+    assert output[0, 2, 2] == 1.0
+    assert output[0, 10, 10] == 1.0
+    assert output[0, 0, 15] == 0.0
@@ -4,7 +4,7 @@
 import pytest
 import torch
 
-from combustion.vision import BinaryLabelIoU, ConfusionMatrixIoU
+from combustion.vision import BinaryLabelIoU, CategoricalLabelIoU, ConfusionMatrixIoU, batch_box_target
 
 
 class TestConfusionMatrixIoU:
@@ -61,8 +61,9 @@ class TestConfusionMatrixIoU:
         layer = ConfusionMatrixIoU(true_positive_limit=true_positive_limit)
         tp, fn = layer(pred_box, pred_cls, true_box, true_cls)
 
+        # only the highest IoU box is a true positive
         if true_positive_limit:
-            assert torch.allclose(tp.long(), torch.tensor([0, 1, 0, 0, 1]))
+            assert torch.allclose(tp.long(), torch.tensor([0, 1, 0, 1, 0]))
         else:
             assert torch.allclose(tp.long(), torch.tensor([0, 1, 0, 1, 1]))
         assert torch.allclose(fn.long(), torch.tensor([1, 0, 0, 1, 1, 1]))
@@ -99,10 +100,101 @@ class TestBinaryLabelIoU:
 
         if true_positive_limit:
             expected_pred = torch.tensor([0.5000, 0.2500, 0.7500, 0.0010, 0.2000, 0.0000, 0.0000, 0.0000, 0.0000])
-            expected_true = torch.tensor([0.0, 1.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 1.0])
+            expected_true = torch.tensor([0.0, 1.0, 0.0, 1.0, 0.0, 1.0, 1.0, 1.0, 1.0])
         else:
             expected_pred = torch.tensor([0.5000, 0.2500, 0.7500, 0.0010, 0.2000, 0.0000, 0.0000, 0.0000, 0.0000])
             expected_true = torch.tensor([0.0, 1.0, 0.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0])
 
         assert torch.allclose(expected_pred, pred)
         assert torch.allclose(expected_true, true)
+
+
+def random_boxes(num_boxes, num_classes=2):
+    xy = torch.rand(num_boxes, 2).mul_(20)
+    wh = torch.rand(num_boxes, 2).mul_(10).add_(1)
+    cls = torch.randint(0, num_classes, (num_boxes, 1)).float()
+    return torch.cat([xy, xy + wh], dim=-1), cls
+
+
+@pytest.fixture
+def batch():
+    torch.random.manual_seed(42)
+    preds, trues = [], []
+    for num_pred, num_true in [(6, 4), (0, 3), (8, 0), (5, 5)]:
+        true_boxes, true_cls = random_boxes(num_true)
+        pred_boxes, pred_cls = random_boxes(num_pred)
+        # place some predictions near targets so that matches occur
+        num_near = min(num_pred, num_true)
+        pred_boxes[:num_near] = true_boxes[:num_near] + torch.rand(num_near, 4).sub_(0.5)
+        pred_cls[:num_near] = true_cls[:num_near]
+        pred_scores = torch.rand(num_pred, 1)
+        preds.append(torch.cat([pred_boxes, pred_scores, pred_cls], dim=-1))
+        trues.append(torch.cat([true_boxes, true_cls], dim=-1))
+    return preds, trues
+
+
+class TestBatchedMatching:
+    @pytest.mark.parametrize("true_positive_limit", [True, False])
+    def test_confusion_matrix_batched(self, batch, true_positive_limit):
+        preds, trues = batch
+        pred, true = batch_box_target(preds), batch_box_target(trues)
+        layer = ConfusionMatrixIoU(true_positive_limit=true_positive_limit)
+        tp, fn = layer(pred[..., :4], pred[..., -1:], true[..., :4], true[..., -1:])
+        assert tp.shape == pred.shape[:-1]
+        assert fn.shape == true.shape[:-1]
+
+        for i, (p, t) in enumerate(zip(preds, trues)):
+            expected_tp, expected_fn = layer(p[..., :4], p[..., -1:], t[..., :4], t[..., -1:])
+            assert torch.equal(tp[i, : len(p)], expected_tp)
+            assert not tp[i, len(p) :].any()
+            assert torch.equal(fn[i, : len(t)], expected_fn)
+            assert not fn[i, len(t) :].any()
+
+    @pytest.mark.parametrize("true_positive_limit", [True, False])
+    def test_categorical_batched(self, batch, true_positive_limit):
+        preds, trues = batch
+        pred, true = batch_box_target(preds), batch_box_target(trues)
+        layer = CategoricalLabelIoU(true_positive_limit=true_positive_limit)
+        score, binary, cls = layer(pred[..., :4], pred[..., 4:5], pred[..., -1:], true[..., :4], true[..., -1:])
+
+        # compare with unbatched results, which order all predictions before all false negatives
+        expected = [layer(p[..., :4], p[..., 4:5], p[..., -1:], t[..., :4], t[..., -1:]) for p, t in zip(preds, trues)]
+        num_pred = sum(len(p) for p in preds)
+        for actual, index in zip((score, binary, cls), range(3)):
+            expected_pred = torch.cat([e[index][: len(p)] for e, p in zip(expected, preds)])
+            expected_fn = torch.cat([e[index][len(p) :] for e, p in zip(expected, preds)])
+            assert torch.equal(actual[:num_pred], expected_pred)
+            assert torch.equal(actual[num_pred:], expected_fn)
+
+    def test_highest_iou_match(self):
+        true_box = torch.tensor([[[0.0, 0.0, 10.0, 10.0]]])
+        pred_box = torch.tensor([[[0.0, 0.0, 9.0, 9.0], [0.0, 0.0, 10.0, 10.5], [0.0, 0.0, 8.0, 8.0]]])
+        true_cls = torch.zeros(1, 1, 1)
+        pred_cls = torch.zeros(1, 3, 1)
+        tp, fn = ConfusionMatrixIoU()(pred_box, pred_cls, true_box, true_cls)
+        assert tp.tolist() == [[False, True, False]]
+        assert fn.tolist() == [[False]]
+
+    @pytest.mark.parametrize("true_positive_limit", [True, False])
+    def test_one_to_one_assignment(self, true_positive_limit):
+        # the single predicted box correctly overlaps both target boxes, but may only be assigned to one
+        true_box = torch.tensor([[[0.0, 0.0, 10.0, 10.0], [0.0, 0.0, 10.0, 8.0]]])
+        pred_box = torch.tensor([[[0.0, 0.0, 10.0, 9.5]]])
+        true_cls = torch.zeros(1, 2, 1)
+        pred_cls = torch.zeros(1, 1, 1)
+        tp, fn = ConfusionMatrixIoU(true_positive_limit=true_positive_limit)(pred_box, pred_cls, true_box, true_cls)
+        assert tp.tolist() == [[True]]
+        if true_positive_limit:
+            assert fn.tolist() == [[False, True]]
+        else:
+            assert fn.tolist() == [[False, False]]
+
+    def test_assignment_in_iou_order(self):
+        # pred[0] best overlaps target[0], leaving target[1] for pred[1]
+        true_box = torch.tensor([[[0.0, 0.0, 10.0, 10.0], [2.0, 0.0, 12.0, 10.0]]])
+        pred_box = torch.tensor([[[0.5, 0.0, 10.5, 10.0], [2.0, 0.0, 12.0, 7.0]]])
+        true_cls = torch.zeros(1, 2, 1)
+        pred_cls = torch.zeros(1, 2, 1)
+        tp, fn = ConfusionMatrixIoU()(pred_box, pred_cls, true_box, true_cls)
+        assert tp.tolist() == [[True, True]]
+        assert fn.tolist() == [[False, False]]
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import importlib
+
+import pytest
 import torch
 
-from combustion.vision import nms
+from combustion.vision import nms, soft_nms, weighted_box_fusion
+from combustion.vision.nms import _nms_fallback
 
 
 def test_nms_batched():
@@ -72,3 +76,182 @@ def test_nms_unbatched():
             (1, 2),
         ],
     )
+
+
+@pytest.fixture
+def random_boxes():
+    torch.random.manual_seed(42)
+    xy = torch.rand(4, 50, 2).mul_(100)
+    wh = torch.rand(4, 50, 2).mul_(30).add_(1)
+    boxes = torch.cat([xy, xy + wh], dim=-1)
+    scores = torch.rand(4, 50)
+    classes = torch.randint(0, 3, (4, 50))
+    return boxes, scores, classes
+
+
+def test_nms_batched_matches_per_example(random_boxes):
+    boxes, scores, _ = random_boxes
+    batch_idx, box_idx = nms(boxes, scores, 0.5)
+    for i in range(boxes.shape[0]):
+        expected = nms(boxes[i], scores[i], 0.5)
+        assert torch.equal(box_idx[batch_idx == i], expected)
+    assert (batch_idx[1:] >= batch_idx[:-1]).all()
+
+
+def test_nms_class_aware(random_boxes):
+    boxes, scores, classes = random_boxes
+    batch_idx, box_idx = nms(boxes, scores, 0.5, classes=classes)
+    for i in range(boxes.shape[0]):
+        result = box_idx[batch_idx == i]
+        for cls in range(3):
+            mask = classes[i] == cls
+            expected = torch.nonzero(mask, as_tuple=False).view(-1)[nms(boxes[i, mask], scores[i, mask], 0.5)]
+            actual = result[classes[i, result] == cls]
+            assert torch.equal(actual, expected)
+
+
+@pytest.mark.parametrize("max_detections", [1, 5])
+def test_nms_max_detections(random_boxes, max_detections):
+    boxes, scores, _ = random_boxes
+    batch_idx, box_idx = nms(boxes, scores, 0.5, max_detections=max_detections)
+    full_batch_idx, full_box_idx = nms(boxes, scores, 0.5)
+    for i in range(boxes.shape[0]):
+        expected = full_box_idx[full_batch_idx == i][:max_detections]
+        assert torch.equal(box_idx[batch_idx == i], expected)
+
+
+def test_nms_pre_nms_top_k(random_boxes):
+    boxes, scores, _ = random_boxes
+    batch_idx, box_idx = nms(boxes, scores, 0.5, pre_nms_top_k=10)
+    for i in range(boxes.shape[0]):
+        top_k = scores[i].topk(10).indices
+        result = box_idx[batch_idx == i]
+        assert all(x in top_k for x in result.tolist())
+        assert torch.equal(result, top_k[nms(boxes[i, top_k], scores[i, top_k], 0.5)])
+
+
+def test_nms_fallback(random_boxes):
+    torchvision = pytest.importorskip("torchvision")
+    boxes, scores, _ = random_boxes
+    for box, score in zip(boxes, scores):
+        expected = torchvision.ops.nms(box, score, 0.5)
+        assert torch.equal(_nms_fallback(box, score, 0.5), expected)
+
+
+def test_nms_without_torchvision(random_boxes, mocker):
+    boxes, scores, classes = random_boxes
+    expected = nms(boxes, scores, 0.5, classes=classes)
+    # combustion.vision.nms resolves to the function, so patch the module directly
+    mocker.patch.object(importlib.import_module("combustion.vision.nms"), "nms_torch", None)
+    actual = nms(boxes, scores, 0.5, classes=classes)
+    assert torch.equal(actual[0], expected[0])
+    assert torch.equal(actual[1], expected[1])
+
+
+def test_nms_many_groups_precision(mocker):
+    pytest.importorskip("torchvision")
+    torch.random.manual_seed(42)
+    # small boxes on large images, with enough examples / classes that float32 offsets would lose precision
+    xy = torch.rand(32, 200, 2).mul_(1333)
+    wh = torch.rand(32, 200, 2).mul_(3).add_(0.5)
+    boxes = torch.cat([xy, xy + wh], dim=-1)
+    scores = torch.rand(32, 200)
+    classes = torch.randint(0, 80, (32, 200))
+    expected = nms(boxes, scores, 0.5, classes=classes)
+
+    # the fallback handles each group separately without offsets
+    mocker.patch.object(importlib.import_module("combustion.vision.nms"), "nms_torch", None)
+    actual = nms(boxes, scores, 0.5, classes=classes)
+    assert torch.equal(actual[0], expected[0])
+    assert torch.equal(actual[1], expected[1])
+
+
+def test_nms_fallback_groups(random_boxes):
+    boxes, scores, classes = random_boxes
+    box, score, group = boxes[0], scores[0], classes[0]
+    keep = _nms_fallback(box, score, 0.5, group)
+    assert (score[keep][:-1] >= score[keep][1:]).all()
+    for cls in range(3):
+        idx = (group == cls).nonzero().view(-1)
+        expected = idx[_nms_fallback(box[idx], score[idx], 0.5)]
+        assert torch.equal(keep[group[keep] == cls], expected)
+
+
+@pytest.fixture
+def box_target():
+    # two overlapping class 0 boxes, one distant class 0 box, one class 1 box overlapping the first
+    target = torch.tensor(
+        [
+            [
+                [0.0, 0.0, 10.0, 10.0, 0.9, 0.0],
+                [1.0, 1.0, 11.0, 11.0, 0.8, 0.0],
+                [50.0, 50.0, 60.0, 60.0, 0.7, 0.0],
+                [0.0, 0.0, 10.0, 10.0, 0.6, 1.0],
+            ],
+            [
+                [0.0, 0.0, 10.0, 10.0, 0.5, 0.0],
+                [-1.0, -1.0, -1.0, -1.0, -1.0, -1.0],
+                [-1.0, -1.0, -1.0, -1.0, -1.0, -1.0],
+                [-1.0, -1.0, -1.0, -1.0, -1.0, -1.0],
+            ],
+        ]
+    )
+    return target
+
+
+@pytest.mark.parametrize("method", ["linear", "gaussian"])
+def test_soft_nms(box_target, method):
+    output = soft_nms(box_target, method=method)
+    assert output.shape == (2, 4, 6)
+
+    # non-overlapping and other class boxes keep their score, the overlapping box is decayed
+    first = output[0]
+    assert torch.allclose(first[0], box_target[0, 0])
+    assert torch.allclose(first[1], box_target[0, 2])
+    assert torch.allclose(first[2], box_target[0, 3])
+    assert first[3, 4] < 0.8
+    assert torch.allclose(first[3, :4], box_target[0, 1, :4])
+
+    assert torch.allclose(output[1, 0], box_target[1, 0])
+    assert (output[1, 1:] == -1).all()
+
+
+def test_soft_nms_linear_decay(box_target):
+    # the class 1 box is an exact duplicate of a higher scoring box, so it decays to zero and is dropped
+    output = soft_nms(box_target[0], method="linear", class_aware=False)
+    iou = 81.0 / 119.0
+    assert torch.allclose(output[..., 4], torch.tensor([0.9, 0.7, 0.8 * (1 - iou)]), atol=1e-5)
+
+
+def test_soft_nms_threshold(box_target):
+    output = soft_nms(box_target, method="linear", score_threshold=0.5)
+    assert output.shape == (2, 3, 6)
+    assert (output[0, :, 4] > 0.5).all()
+
+
+def test_soft_nms_unbatched(box_target):
+    output = soft_nms(box_target[0])
+    assert output.shape == (4, 6)
+    assert torch.allclose(output, soft_nms(box_target)[0])
+
+
+def test_weighted_box_fusion(box_target):
+    output = weighted_box_fusion(box_target, iou_threshold=0.5)
+    assert output.shape == (2, 3, 6)
+
+    # the two overlapping class 0 boxes are fused with a score weighted average
+    expected_box = (0.9 * box_target[0, 0, :4] + 0.8 * box_target[0, 1, :4]) / 1.7
+    assert torch.allclose(output[0, 0, :4], expected_box)
+    assert torch.allclose(output[0, 0, 4], torch.tensor(0.85))
+    assert output[0, 0, 5] == 0
+    assert torch.allclose(output[0, 1], box_target[0, 2])
+    assert torch.allclose(output[0, 2], box_target[0, 3])
+
+    assert torch.allclose(output[1, 0], box_target[1, 0])
+    assert (output[1, 1:] == -1).all()
+
+
+def test_weighted_box_fusion_class_agnostic(box_target):
+    output = weighted_box_fusion(box_target[0], iou_threshold=0.5, class_aware=False)
+    assert output.shape == (2, 6)
+    assert torch.allclose(output[0, 4], torch.tensor((0.9 + 0.8 + 0.6) / 3))
@@ -154,3 +154,72 @@ def test_corner_case():
         ]
     )
     assert torch.allclose(expected, output)
+
+
+@pytest.mark.parametrize("max_roi", [5, None])
+@pytest.mark.parametrize("threshold", [0.0, 0.5])
+def test_batched_matches_unbatched(max_roi, threshold):
+    torch.random.manual_seed(42)
+    points = torch.rand(3, 7, 16, 16)
+    points[1, :3].mul_(0.6)
+    layer = PointsToAnchors(2, max_roi, threshold)
+    output, indices = layer(points, return_indices=True)
+
+    assert output.ndim == 3
+    assert indices.shape[:-1] == output.shape[:-1]
+    assert indices.shape[-1] == 4
+    for i, example in enumerate(points):
+        expected, expected_indices = layer(example, return_indices=True)
+        num_roi = expected.shape[0]
+        assert torch.allclose(output[i, :num_roi], expected)
+        assert (output[i, num_roi:] == -1).all()
+        assert (indices[i, :num_roi, 0] == i).all()
+        assert (indices[i, :num_roi, 1:] == expected_indices).all()
+        assert (indices[i, num_roi:] == -1).all()
+
+
+def test_return_indices_locate_boxes():
+    points = torch.zeros(6, 8, 8)
+    points[0, 2, 3] = 0.9
+    points[1, 5, 1] = 0.8
+    points[-4:].fill_(1.0)
+    layer = PointsToAnchors(1, max_roi=10)
+    output, indices = layer(points, return_indices=True)
+    assert output.shape == (2, 6)
+    assert indices.tolist() == [[0, 2, 3], [1, 5, 1]]
+    assert output[:, -1].tolist() == [0.0, 1.0]
+    assert torch.allclose(output[:, 4], torch.tensor([0.9, 0.8]))
+
+
+def test_known_peaks():
+    points = torch.zeros(5, 8, 8)
+    heatmap = points[0]
+
+    # isolated peak with a lower neighborhood
+    heatmap[1:4, 2:5] = 0.5
+    heatmap[2, 3] = 0.9
+
+    # plateau of equal scores, each of which is a maximum of its neighborhood
+    heatmap[5, 5:7] = 0.7
+
+    # peaks on the border and in the corner
+    heatmap[0, 7] = 0.8
+    heatmap[0, 6] = 0.4
+    heatmap[1, 7] = 0.4
+    heatmap[7, 0] = 0.6
+
+    points[-2:].fill_(2.0)
+    layer = PointsToAnchors(1, max_roi=10)
+    output, indices = layer(points, return_indices=True)
+
+    assert indices.tolist() == [[0, 0, 7], [0, 2, 3], [0, 5, 5], [0, 5, 6], [0, 7, 0]]
+    assert torch.allclose(output[:, 4], torch.tensor([0.9, 0.8, 0.7, 0.7, 0.6]))
+    assert (output[:, 5] == 0).all()
+
+    # boxes are centered on each peak
+    centers = torch.stack([output[:, [0, 2]].mean(dim=-1), output[:, [1, 3]].mean(dim=-1)], dim=-1)
+    expected = torch.tensor([[3.0, 2.0], [7.0, 0.0], [5.0, 5.0], [6.0, 5.0], [0.0, 7.0]])
+    assert torch.allclose(centers[[0, 1, 4]], expected[[0, 1, 4]])
+
+    # order within the plateau is unspecified
+    assert sorted(centers[2:4].tolist()) == expected[2:4].tolist()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from combustion.vision import (
+    BinaryLabelIoU,
+    ConfusionMatrixIoU,
+    RaggedBoxTarget,
+    append_bbox_label,
+    batch_box_target,
+    collate_box_target,
+    filter_bbox_classes,
+    flatten_box_target,
+    split_box_target,
+    unbatch_box_target,
+)
+
+
+@pytest.fixture
+def targets():
+    torch.random.manual_seed(42)
+    lengths = [3, 0, 5, 1]
+    result = []
+    for length in lengths:
+        xy = torch.rand(length, 2).mul_(50)
+        wh = torch.rand(length, 2).mul_(20).add_(1)
+        cls = torch.randint(0, 3, (length, 1)).float()
+        result.append(torch.cat([xy, xy + wh, cls], dim=-1))
+    return result
+
+
+@pytest.fixture
+def ragged(targets):
+    return RaggedBoxTarget.from_list(targets)
+
+
+def test_from_list(ragged, targets):
+    assert len(ragged) == 4
+    assert ragged.lengths.tolist() == [3, 0, 5, 1]
+    assert ragged.offsets.tolist() == [0, 3, 3, 8, 9]
+    assert ragged.batch_index.tolist() == [0, 0, 0, 2, 2, 2, 2, 2, 3]
+    for i, expected in enumerate(targets):
+        assert torch.equal(ragged[i], expected)
+    assert torch.equal(ragged[-1], targets[-1])
+
+
+def test_padded_round_trip(ragged, targets):
+    padded = ragged.to_padded()
+    assert torch.equal(padded, batch_box_target(targets))
+
+    result = RaggedBoxTarget.from_padded(padded)
+    assert torch.equal(result.values, ragged.values)
+    assert torch.equal(result.offsets, ragged.offsets)
+
+
+@pytest.mark.parametrize("pad_value", [-1, -2])
+def test_to_padded_pad_value(ragged, pad_value):
+    padded = ragged.to_padded(pad_value)
+    assert padded.shape == (4, 5, 5)
+    assert (padded[1] == pad_value).all()
+    assert (padded[0, 3:] == pad_value).all()
+
+
+def test_unbind(ragged, targets):
+    for result, expected in zip(unbatch_box_target(ragged), targets):
+        assert torch.equal(result, expected)
+    assert torch.equal(flatten_box_target(ragged), torch.cat(targets))
+
+
+def test_split_and_append(ragged):
+    bbox, cls = split_box_target(ragged)
+    assert isinstance(bbox, RaggedBoxTarget)
+    assert bbox.values.shape == (9, 4)
+    assert cls.values.shape == (9, 1)
+    assert torch.equal(bbox.offsets, ragged.offsets)
+
+    combined = append_bbox_label(bbox, cls)
+    assert torch.equal(combined.values, ragged.values)
+    assert torch.equal(combined.offsets, ragged.offsets)
+
+
+def test_append_mismatched_offsets(ragged):
+    other = RaggedBoxTarget.from_lengths(ragged.values, torch.tensor([9, 0, 0, 0]))
+    with pytest.raises(ValueError):
+        append_bbox_label(ragged, other)
+
+
+@pytest.mark.parametrize("return_inverse", [False, True])
+def test_filter_bbox_classes(ragged, targets, return_inverse):
+    result = filter_bbox_classes(ragged, [0, 2], return_inverse=return_inverse)
+    assert len(result) == len(ragged)
+    for i, target in enumerate(targets):
+        keep = (target[..., -1] == 0) | (target[..., -1] == 2)
+        if return_inverse:
+            keep = ~keep
+        assert torch.equal(result[i], target[keep])
+
+
+def test_collate_ragged(targets):
+    examples = [(torch.rand(3, 8, 8), t) for t in targets]
+    img, target = collate_box_target(examples, ragged=True)
+    assert img.shape == (4, 3, 8, 8)
+    assert isinstance(target, RaggedBoxTarget)
+    assert target.lengths.tolist() == [3, 0, 5, 1]
+
+
+def test_confusion_matrix_iou(ragged, targets):
+    torch.random.manual_seed(0)
+    pred = [t + torch.rand_like(t).mul_(2).sub_(1) * torch.tensor([1.0, 1.0, 1.0, 1.0, 0.0]) for t in targets]
+    pred_ragged = RaggedBoxTarget.from_list(pred)
+    pred_boxes, pred_cls = split_box_target(pred_ragged)
+    true_boxes, true_cls = split_box_target(ragged)
+
+    layer = ConfusionMatrixIoU()
+    tp, fn = layer(pred_boxes, pred_cls, true_boxes, true_cls)
+    assert torch.equal(tp.offsets, pred_ragged.offsets)
+    assert torch.equal(fn.offsets, ragged.offsets)
+    for i, (p, t) in enumerate(zip(pred, targets)):
+        expected_tp, expected_fn = layer(p[..., :4], p[..., 4:], t[..., :4], t[..., 4:])
+        assert torch.equal(tp[i], expected_tp)
+        assert torch.equal(fn[i], expected_fn)
+
+
+def test_binary_label_iou(ragged):
+    bbox, cls = split_box_target(ragged)
+    scores = bbox.with_values(torch.rand(bbox.values.shape[0], 1))
+    pred, target = BinaryLabelIoU()(bbox, scores, cls, bbox, cls)
+    assert pred.shape == target.shape
+    assert torch.equal(pred[:9], scores.values.view(-1))
+    assert (target[9:] == 1).all()